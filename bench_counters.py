@@ -0,0 +1,76 @@
+"""
+Бенчмарк админ-статистики: COUNT(*)/SUM по таблицам против таблицы counters.
+
+База заполняется как в bench_indexes.py (все миграции применены, счетчики
+выставляет сверка), затем замеряются прежние агрегаты админки и чтение
+счетчиков, а также время одной сверки CounterAudit.
+
+Запуск: python bench_counters.py --rows 1000000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+AGGREGATES = [
+    "SELECT COUNT(*) FROM users",
+    "SELECT COUNT(*) FROM payments",
+    "SELECT COUNT(*) FROM vpn_keys",
+    "SELECT COUNT(*) FROM subscriptions WHERE is_active = 1",
+    "SELECT SUM(balance_kopecks) FROM users",
+]
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+async def verify_once(audit, database):
+    try:
+        await audit.run()
+    finally:
+        await database.dispose_async_engine()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20, help="повторов каждого замера")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench_counters.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+        import bench_indexes
+        import counters
+        import database
+        from migrations import migrate
+
+        migrate(database.engine, database.Base.metadata)
+        conn = sqlite3.connect(path)
+        bench_indexes.fill(conn, args.rows, args.seed)
+
+        audit = counters.CounterAudit(repair=True)
+        verify = timed(lambda: asyncio.run(verify_once(audit, database)), 1)
+        db = database.SessionLocal()
+        snapshot = timed(lambda: counters.snapshot_sync(db), args.repeat)
+        db.close()
+        aggregates = timed(lambda: [conn.execute(sql).fetchall() for sql in AGGREGATES], args.repeat)
+        conn.close()
+
+    print(f"Строк: {args.rows}")
+    print(f"COUNT(*)/SUM по таблицам: {aggregates * 1000:9.2f} мс на открытие статистики")
+    print(f"таблица counters:         {snapshot * 1000:9.2f} мс на открытие статистики")
+    print(f"сверка CounterAudit:      {verify * 1000:9.2f} мс (раз в COUNTERS_VERIFY_INTERVAL)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Бенчмарк слоя данных обработчиков: синхронная SessionLocal внутри async def
+против AsyncSession (queries.py) при одновременных пользователях.
+
+Каждый пользователь проходит сценарий /start (регистрация), "Мои ключи",
+"Баланс"; между шагами - ответ в Telegram (имитируется задержкой).
+Параллельно тикает задача-пульс: ее опоздание показывает, насколько
+запросы к БД блокируют event loop (остальные пользователи ждут).
+
+Запуск: python bench_db.py --users 300 --reply-latency 0.02
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def sync_scenario(database, telegram_id, reply_latency):
+    """Старый путь: синхронная сессия прямо в корутине"""
+    db = database.SessionLocal()
+    try:
+        if not db.query(database.User).filter_by(telegram_id=telegram_id).first():
+            db.add(database.User(telegram_id=telegram_id, username=f"u{telegram_id}", balance=0.0))
+            db.commit()
+    finally:
+        db.close()
+    await asyncio.sleep(reply_latency)
+
+    db = database.SessionLocal()
+    try:
+        user = db.query(database.User).filter_by(telegram_id=telegram_id).first()
+        db.query(database.VPNKey).filter_by(user_id=user.id).all()
+    finally:
+        db.close()
+    await asyncio.sleep(reply_latency)
+
+    db = database.SessionLocal()
+    try:
+        db.query(database.User).filter_by(telegram_id=telegram_id).first()
+    finally:
+        db.close()
+    await asyncio.sleep(reply_latency)
+
+
+async def async_scenario(database, queries, telegram_id, reply_latency):
+    """Новый путь: AsyncSession, запросы не держат event loop"""
+    async with database.async_session() as db:
+        await queries.upsert_user(db, telegram_id, f"u{telegram_id}")
+    await asyncio.sleep(reply_latency)
+
+    async with database.async_session() as db:
+        user = await queries.get_user(db, telegram_id)
+        await queries.user_keys(db, user.id)
+    await asyncio.sleep(reply_latency)
+
+    async with database.async_session() as db:
+        await queries.get_user(db, telegram_id)
+    await asyncio.sleep(reply_latency)
+
+
+async def measure(title, scenario, users):
+    lags = []
+    stop = asyncio.Event()
+
+    async def pulse():
+        # Плановый тик раз в 5 мс; опоздание = время, когда loop был занят
+        while not stop.is_set():
+            planned = time.perf_counter() + 0.005
+            await asyncio.sleep(0.005)
+            lags.append(max(0.0, time.perf_counter() - planned))
+
+    async def user(i):
+        started = time.perf_counter()
+        await scenario(i)
+        return time.perf_counter() - started
+
+    ticker = asyncio.create_task(pulse())
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(user(i) for i in range(1, users + 1)))
+    wall = time.perf_counter() - started
+    stop.set()
+    await ticker
+
+    print(f"{title:<18} {users * 3 / wall:8.0f} запросов/с  "
+          f"p50={percentile(latencies, 50) * 1000:8.1f} мс  p99={percentile(latencies, 99) * 1000:8.1f} мс  "
+          f"задержка loop: p99={percentile(lags, 99) * 1000:6.1f} мс, max={max(lags) * 1000:6.1f} мс")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--reply-latency", type=float, default=0.02, help="ответ Telegram, сек")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        import config
+        config.Config.DATABASE_URL = os.environ["DATABASE_URL"]
+        import database
+        import queries
+        database.init_db()
+
+        print(f"Пользователей: {args.users}, ответ Telegram: {args.reply_latency * 1000:.0f} мс")
+        await measure("sync SessionLocal",
+                      lambda i: sync_scenario(database, i, args.reply_latency), args.users)
+        await measure("AsyncSession",
+                      lambda i: async_scenario(database, queries, 100000 + i, args.reply_latency), args.users)
+        await database.dispose_async_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+"""
+Бенчмарк индексов горячих запросов на большой базе (по умолчанию миллион строк).
+
+База создается миграциями до версии 2 (без индексов), заполняется
+синтетическими пользователями, платежами, подписками и ключами, затем
+запросы замеряются до и после миграции 3. Для каждого запроса печатается
+план SQLite (EXPLAIN QUERY PLAN): SCAN - полный проход по таблице,
+SEARCH ... USING INDEX - поиск по индексу.
+
+Запуск: python bench_indexes.py --rows 1000000
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Запросы в том виде, в каком их строят queries.py и админка
+QUERIES = [
+    ("check_subscriptions",
+     "SELECT id, user_id FROM subscriptions WHERE end_date < ? AND is_active = 1",
+     lambda now, user_id: (now,)),
+    ("admin_payments",
+     "SELECT id, amount, status FROM payments ORDER BY created_at DESC LIMIT 10",
+     lambda now, user_id: ()),
+    ("pending_payments",
+     "SELECT id, amount FROM payments WHERE user_id = ? AND status = 'pending'",
+     lambda now, user_id: (user_id,)),
+    ("user_keys",
+     "SELECT id, key FROM vpn_keys WHERE user_id = ?",
+     lambda now, user_id: (user_id,)),
+]
+
+
+def fill(conn, rows, seed):
+    """Синтетические данные: rows платежей, подписок и ключей, rows/10 пользователей"""
+    rnd = random.Random(seed)
+    users = max(1, rows // 10)
+    start = datetime(2024, 1, 1)
+    now = datetime(2026, 1, 1)
+    span = int((now - start).total_seconds())
+
+    def moment():
+        return start + timedelta(seconds=rnd.randrange(span))
+
+    conn.executemany(
+        "INSERT INTO users (id, telegram_id, username, balance, trial_used, created_at) VALUES (?, ?, ?, 0, 0, ?)",
+        ((i, 10_000_000 + i, f"user{i}", moment()) for i in range(1, users + 1)))
+    conn.executemany(
+        "INSERT INTO payments (user_id, amount, currency, payment_id, status, payment_method, created_at) "
+        "VALUES (?, ?, 'RUB', ?, ?, 'yookassa', ?)",
+        ((rnd.randint(1, users), 199.0, f"p{i}", "pending" if rnd.random() < 0.02 else "succeeded", moment())
+         for i in range(rows)))
+    # Большинство подписок давно закрыто; активных ~5%, истекших среди них - малая доля
+    conn.executemany(
+        "INSERT INTO subscriptions (user_id, tariff, price, start_date, end_date, is_active) VALUES (?, '1 месяц', 199, ?, ?, ?)",
+        ((rnd.randint(1, users), moment(), now + timedelta(days=rnd.randint(-3, 30)), rnd.random() < 0.05)
+         for _ in range(rows)))
+    conn.executemany(
+        "INSERT INTO vpn_keys (user_id, key_id, key, name, server_id, created_at, is_active) VALUES (?, ?, ?, 'key', 'main', ?, 1)",
+        ((rnd.randint(1, users), str(i), f"ss://bench{i}", moment()) for i in range(rows)))
+    conn.commit()
+    return users, now
+
+
+def measure(conn, now, users, repeat, seed):
+    rnd = random.Random(seed)
+    results = {}
+    for name, sql, params in QUERIES:
+        plan = " | ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params(now, 1)))
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, params(now, rnd.randint(1, users))).fetchall()
+        results[name] = ((time.perf_counter() - started) / repeat, plan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20, help="повторов каждого запроса")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        import config
+        config.Config.DATABASE_URL = os.environ["DATABASE_URL"]
+        import database
+        import migrations
+
+        migrations.migrate(database.engine, database.Base.metadata, target=2)
+        raw = database.engine.raw_connection()
+        started = time.perf_counter()
+        users, now = fill(raw, args.rows, args.seed)
+        print(f"Строк: {args.rows} в payments/subscriptions/vpn_keys, пользователей: {users} "
+              f"(заполнение {time.perf_counter() - started:.1f} с)")
+
+        before = measure(raw, now, users, args.repeat, args.seed)
+        raw.close()
+
+        started = time.perf_counter()
+        migrations.migrate(database.engine, database.Base.metadata)
+        print(f"Миграция 3 (индексы): {time.perf_counter() - started:.1f} с\n")
+
+        raw = database.engine.raw_connection()
+        raw.execute("ANALYZE")
+        after = measure(raw, now, users, args.repeat, args.seed)
+        raw.close()
+        database.engine.dispose()
+
+    for name, _, _ in QUERIES:
+        (old, old_plan), (new, new_plan) = before[name], after[name]
+        print(f"{name:<20} {old * 1000:9.2f} мс -> {new * 1000:8.3f} мс  (x{old / new:,.0f})")
+        print(f"  без индексов: {old_plan}")
+        print(f"  с индексами:  {new_plan}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Бенчмарк клавиатур: сборка разметки на каждый апдейт против каталога.
+
+Для каждого меню замеряются время и выделения памяти (tracemalloc) на
+одну выдачу: прежним способом (сборщик keyboards._build_* вызывается
+каждый раз) и через keyboards.get_catalog(). Отдельно - типичный апдейт
+"главное меню + тарифы".
+
+Запуск: python bench_keyboards.py --repeat 20000
+"""
+import argparse
+import logging
+import time
+import tracemalloc
+
+import keyboards
+
+MENUS = [
+    ("main_menu", keyboards._build_main_menu, lambda: keyboards.main_menu()),
+    ("tariffs", keyboards._build_tariffs, lambda: keyboards.tariffs_keyboard()),
+    ("deposit_amounts", keyboards._build_deposit_amounts, lambda: keyboards.deposit_amounts_keyboard()),
+    ("back_to_main", keyboards._build_back_to_main, lambda: keyboards.back_to_main()),
+    ("admin", keyboards._build_admin, lambda: keyboards.admin_keyboard()),
+]
+
+
+def measure(fn, repeat):
+    """(мкс на вызов, выделено байт на вызов, блоков на вызов)"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [fn() for _ in range(repeat // 10 or 1)]  # результаты живы до снимка
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    size = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    # сам список kept - не заслуга сборщика
+    size -= kept.__sizeof__()
+    return elapsed / repeat * 1e6, max(size, 0) / len(kept), max(blocks - 1, 0) / len(kept)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20_000, help="выдач каждого меню")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    keyboards.get_catalog().warm()
+    print(f"{'меню':<16} {'сборка':>22} {'каталог':>22}")
+    for name, build, cached in MENUS:
+        old = measure(lambda: build(False, False, keyboards.DEFAULT_LOCALE), args.repeat)
+        new = measure(cached, args.repeat)
+        print(f"{name:<16} {old[0]:6.1f} мкс {old[1]:7.0f} Б {old[2]:4.0f} бл"
+              f"   {new[0]:6.1f} мкс {new[1]:5.0f} Б {new[2]:3.0f} бл")
+
+    old = measure(lambda: (keyboards._build_main_menu(False, False, "ru"),
+                           keyboards._build_tariffs(False, False, "ru")), args.repeat)
+    new = measure(lambda: (keyboards.main_menu(), keyboards.tariffs_keyboard()), args.repeat)
+    print(f"\nапдейт (меню + тарифы): сборка {old[0]:.1f} мкс / {old[1]:.0f} Б, "
+          f"каталог {new[0]:.1f} мкс / {new[1]:.0f} Б")
+    print(f"каталог: {keyboards.get_catalog().metrics()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Бенчмарк клиентов Outline API на локальном fake_outline_server.
+
+Все пользователи нажимают кнопку одновременно, задержка считается от
+момента нажатия до ответа обработчика. Сравниваются:
+  - RealOutlineAPI и синхронный OutlinesAPI (блокируют event loop);
+  - AsyncOutlinesAPI на общем пуле соединений;
+  - OutlineServer (circuit breaker + идемпотентные повторы);
+  - OutlineBatch (ограничение параллельности и rate limit).
+
+Каждый клиент получает свой свежий сервер с одним и тем же seed,
+поэтому задержки и ошибки воспроизводятся от прогона к прогону.
+
+Запуск: python bench_outline.py --users 200 --latency lognormal:0.02,0.5 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import time
+
+import config
+from fake_outline_server import FakeOutlineServer
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_sync(create, users):
+    """Старый путь: блокирующий вызов прямо из корутины"""
+    started = time.perf_counter()
+
+    async def handler(i):
+        ok = bool(create(f"bench {i}"))
+        return time.perf_counter() - started, ok
+
+    return await asyncio.gather(*(handler(i) for i in range(users)))
+
+
+async def run_async(create, users):
+    """Новый путь: await на общем пуле соединений"""
+    started = time.perf_counter()
+
+    async def handler(i):
+        ok = bool(await create(f"bench {i}"))
+        return time.perf_counter() - started, ok
+
+    return await asyncio.gather(*(handler(i) for i in range(users)))
+
+
+async def run_batch(batch, users):
+    """Один пакетный вызов на всех пользователей"""
+    started = time.perf_counter()
+    results = await batch.create_keys([f"bench {i}" for i in range(users)], limit_gb=5)
+    elapsed = time.perf_counter() - started
+    return [(elapsed, r.ok) for r in results]
+
+
+def report(title, samples, server):
+    latencies = [latency for latency, _ in samples]
+    failed = sum(1 for _, ok in samples if not ok)
+    wall = max(latencies)
+    print(f"{title:<24} {len(samples) / wall:8.0f} оп/с  "
+          f"p50={percentile(latencies, 50) * 1000:8.1f} мс  "
+          f"p99={percentile(latencies, 99) * 1000:8.1f} мс  "
+          f"max={wall * 1000:8.1f} мс  "
+          f"ошибок={failed} (500: {server.errors}, обрывов: {server.drops})")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", default="fixed:0.02",
+                        help="fixed:S | uniform:A,B | exp:MEAN | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--max-keys", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)  # логи каждого запроса и ошибки искажают замер
+    config.Config.OUTLINES_API_KEY = "bench"
+    config.Config.OUTLINES_BACKOFF_BASE = 0.05
+
+    import outlines_api
+    from outline_batch import OutlineBatch
+    from outline_cluster import OutlineCluster, OutlineServer
+    from real_outline_api import RealOutlineAPI
+
+    def fresh_server():
+        server = FakeOutlineServer(args.latency, args.error_rate, args.drop_rate, args.max_keys, args.seed)
+        server.start_in_thread()
+        config.Config.OUTLINES_API_URL = f"http://127.0.0.1:{server.port}"
+        config.Config.OUTLINES_SERVER_ID = "bench"
+        return server
+
+    print(f"Пользователей: {args.users}, задержка: {args.latency}, "
+          f"ошибок: {args.error_rate:.1%}, обрывов: {args.drop_rate:.1%}, seed: {args.seed}")
+
+    server = fresh_server()
+    with contextlib.redirect_stdout(io.StringIO()):  # RealOutlineAPI печатает каждый ключ
+        real = RealOutlineAPI(server.url("bench"), "bench")
+        samples = await run_sync(real.create_key, args.users)
+    report("RealOutlineAPI (sync)", samples, server)
+    server.stop_thread()
+
+    server = fresh_server()
+    sync_api = outlines_api.OutlinesAPI()
+    report("OutlinesAPI (sync)", await run_sync(lambda name: sync_api.create_key(name, limit_gb=5), args.users), server)
+    server.stop_thread()
+
+    server = fresh_server()
+    api = outlines_api.AsyncOutlinesAPI()
+    await api.get_server_info()  # прогрев пула
+    report("AsyncOutlinesAPI", await run_async(lambda name: api.create_key(name, limit_gb=5), args.users), server)
+    server.stop_thread()
+
+    server = fresh_server()
+    outline = OutlineServer("bench", server.url("bench"), "bench")
+    report("OutlineServer", await run_async(lambda name: outline.create_key(name, limit_gb=5), args.users), server)
+    server.stop_thread()
+
+    server = fresh_server()
+    batch = OutlineBatch(OutlineCluster([OutlineServer("bench", server.url("bench"), "bench")]), rate_per_server=0)
+    report("OutlineBatch", await run_batch(batch, args.users), server)
+    server.stop_thread()
+
+    await outlines_api.close_http_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""
+Бенчмарк листания админских списков: OFFSET против keyset-курсора.
+
+Таблица users заполняется синтетическими строками, затем для нескольких
+номеров страниц замеряется выборка страницы прежним способом
+(ORDER BY id LIMIT n OFFSET page*n плюс COUNT(*) для числа страниц) и через
+queries.page_sync (WHERE id < курсор ORDER BY id DESC LIMIT n+1).
+
+Запуск: python bench_pagination.py --rows 1000000 --page-size 5
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--page-size", type=int, default=5)
+    parser.add_argument("--pages", default="1,50,5000,100000", help="номера страниц через запятую")
+    parser.add_argument("--repeat", type=int, default=20, help="повторов каждого замера")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench_pagination.db')}"
+        from sqlalchemy import func, select
+
+        import database
+        import queries
+        from migrations import migrate
+
+        migrate(database.engine, database.Base.metadata)
+        with database.engine.begin() as conn:
+            conn.execute(database.User.__table__.insert(), [
+                {"telegram_id": 10_000_000 + i, "username": f"user{i}", "balance": 0.0}
+                for i in range(1, args.rows + 1)
+            ])
+
+        size = args.page_size
+        db = database.SessionLocal()
+        print(f"Строк: {args.rows}, на странице: {size}")
+        for number in (int(p) for p in args.pages.split(",")):
+            offset = (number - 1) * size
+            if offset >= args.rows:
+                continue
+            # Курсор страницы number при листании с первой: id последней строки предыдущей
+            cursor = args.rows - offset + 1 if number > 1 else None
+
+            def by_offset():
+                db.execute(select(database.User).order_by(database.User.id.desc()).offset(offset).limit(size)).all()
+                db.scalar(select(func.count(database.User.id)))
+
+            def by_cursor():
+                queries.page_sync(db, database.User, cursor, True, size)
+
+            print(f"страница {number:>7}: OFFSET {timed(by_offset, args.repeat) * 1000:8.2f} мс   "
+                  f"keyset {timed(by_cursor, args.repeat) * 1000:6.2f} мс")
+            db.expunge_all()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Бенчмарк профилей SQLite: настройки по умолчанию против SQLITE_PROFILE=production
+(WAL, synchronous=NORMAL, mmap, один писатель и пул читателей).
+
+Одновременные пользователи в цикле открывают экраны баланса и ключей
+(чтение) и пополняют баланс (запись) через database.async_session.
+Параллельно отдельный процесс пишет крупные транзакции через SessionLocal
+(как сборщик трафика или сверка): в режиме по умолчанию на время их
+коммита читатели бота блокируются.
+Каждый профиль запускается отдельным процессом на своей базе, так как
+движки создаются по настройкам при импорте.
+
+Запуск: python bench_sqlite.py --users 50 --seconds 10 --write-share 0.2 --batch-rows 20000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+PROFILES = [("по умолчанию", ""), ("production", "production")]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index] if ordered else 0.0
+
+
+def bulk_writer(rows):
+    """Процесс фоновой записи: транзакции по rows строк одна за другой"""
+    import database
+
+    batch = 0
+    while True:
+        batch += 1
+        db = database.SessionLocal()
+        try:
+            db.execute(database.TrafficDay.__table__.insert(), [
+                {"server_id": "bench", "key_id": f"{batch}-{i}", "day": date.today(), "buckets": b"", "total": i}
+                for i in range(rows)
+            ])
+            db.commit()
+        finally:
+            db.close()
+
+
+async def child(users, seconds, write_share, batch_rows, seed):
+    """Процесс одного профиля: нагрузка и итог в JSON"""
+    logging.disable(logging.CRITICAL)
+    from sqlalchemy import func, select, update
+
+    import database
+    import queries
+
+    await asyncio.to_thread(database.init_db)
+    async with database.async_session() as db:
+        for telegram_id in range(1, users + 1):
+            db.add(database.User(telegram_id=telegram_id, username=f"u{telegram_id}", balance=0.0))
+        await db.commit()
+
+    latencies = {"read": [], "write": []}
+    errors = 0
+    if batch_rows:
+        writer = subprocess.Popen([sys.executable, __file__, "--bulk-writer", str(batch_rows)])
+    deadline = time.perf_counter() + seconds
+
+    async def user(telegram_id):
+        nonlocal errors
+        rnd = random.Random(seed + telegram_id)
+        while time.perf_counter() < deadline:
+            kind = "write" if rnd.random() < write_share else "read"
+            started = time.perf_counter()
+            try:
+                async with database.async_session() as db:
+                    if kind == "read":
+                        db_user = await queries.get_user(db, telegram_id)
+                        await queries.user_keys(db, db_user.id)
+                    else:
+                        await db.execute(update(database.User).where(database.User.telegram_id == telegram_id)
+                                         .values(balance=database.User.balance + 10))
+                        await db.commit()
+            except Exception:
+                errors += 1  # database is locked
+                continue
+            latencies[kind].append(time.perf_counter() - started)
+
+    await asyncio.gather(*(user(i) for i in range(1, users + 1)))
+    if batch_rows:
+        writer.terminate()
+        writer.wait()
+    async with database.async_session() as db:
+        batches = await db.scalar(select(func.count(database.TrafficDay.id))) // max(batch_rows, 1)
+    await database.dispose_async_engine()
+    print(json.dumps({"latencies": latencies, "batches": batches, "errors": errors}))
+
+
+def run_profile(profile, args, db_path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", SQLITE_PROFILE=profile)
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", "--users", str(args.users), "--seconds", str(args.seconds),
+         "--write-share", str(args.write_share), "--batch-rows", str(args.batch_rows), "--seed", str(args.seed)],
+        env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--write-share", type=float, default=0.2, help="доля операций записи")
+    parser.add_argument("--batch-rows", type=int, default=20000, help="строк в фоновой транзакции, 0 - без нее")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--bulk-writer", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.bulk_writer:
+        bulk_writer(args.bulk_writer)
+        return
+
+    if args.child:
+        asyncio.run(child(args.users, args.seconds, args.write_share, args.batch_rows, args.seed))
+        return
+
+    print(f"Пользователей: {args.users}, {args.seconds:.0f} с, доля записи: {args.write_share:.0%}, "
+          f"фоновая транзакция: {args.batch_rows} строк")
+    with tempfile.TemporaryDirectory() as tmp:
+        for title, profile in PROFILES:
+            result = run_profile(profile, args, os.path.join(tmp, f"bench_{profile or 'default'}.db"))
+            reads, writes = result["latencies"]["read"], result["latencies"]["write"]
+            print(f"{title:<14} чтение {len(reads) / args.seconds:7.0f}/с p99={percentile(reads, 99) * 1000:7.1f} мс  "
+                  f"запись {len(writes) / args.seconds:6.0f}/с p99={percentile(writes, 99) * 1000:7.1f} мс  "
+                  f"пачек {result['batches']}  ошибок: {result['errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Бенчмарк запуска бота (main.py): время импорта и время до ответа на первый апдейт.
+
+Бот запускается отдельным процессом против двух локальных заглушек:
+  - Telegram Bot API: getMe, getUpdates (одно сообщение /start), sendMessage;
+  - fake_outline_server с большой задержкой - медленный Outline не должен
+    задерживать старт и первый ответ.
+Время до первого ответа считается от запуска процесса до sendMessage.
+
+Запуск: python bench_startup.py --runs 5 --outline-latency fixed:5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = "123456:bench"
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Минимальный Bot API: одно сообщение /start, ответ бота фиксируется"""
+    protocol_version = "HTTP/1.1"
+    update_sent = False
+    replied = None  # threading.Event, выставляется на первый sendMessage
+
+    def _reply(self, result):
+        data = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        user = {"id": 42, "is_bot": False, "first_name": "Bench"}
+        chat = {"id": 42, "type": "private", "first_name": "Bench"}
+
+        if method == "getMe":
+            self._reply({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        elif method == "getUpdates":
+            cls = FakeTelegramHandler
+            if not cls.update_sent:
+                cls.update_sent = True
+                self._reply([{"update_id": 1, "message": {
+                    "message_id": 1, "date": int(time.time()), "chat": chat, "from": user,
+                    "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}])
+            else:
+                time.sleep(0.2)
+                self._reply([])
+        elif method == "sendMessage":
+            FakeTelegramHandler.replied.set()
+            self._reply({"message_id": 2, "date": int(time.time()), "chat": chat, "text": "ok",
+                         "from": {"id": 1, "is_bot": True, "first_name": "bench"}})
+        else:
+            self._reply(True)
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            pass  # процесс бота завершен посреди long polling
+
+    def log_message(self, *args):
+        pass
+
+
+def child(telegram_port):
+    """Процесс бота: импорт main, сборка приложения, run_polling"""
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+
+    from telegram.ext import Application
+    builder = Application.builder().token(TOKEN).base_url(f"http://127.0.0.1:{telegram_port}/bot")
+    application = main.build_application(builder)
+    built = time.perf_counter()
+
+    print(json.dumps({"import": imported - started, "build": built - imported}), flush=True)
+    application.run_polling()
+
+
+def run_once(telegram_port, outline_url, db_path):
+    FakeTelegramHandler.update_sent = False
+    FakeTelegramHandler.replied = threading.Event()
+    env = dict(os.environ, BOT_TOKEN=TOKEN, DATABASE_URL=f"sqlite:///{db_path}",
+               OUTLINES_API_URL=outline_url, OUTLINES_API_KEY="bench")
+
+    spawned = time.perf_counter()
+    process = subprocess.Popen([sys.executable, __file__, "--child", str(telegram_port)],
+                               env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        replied = FakeTelegramHandler.replied.wait(timeout=60)
+        first_reply = time.perf_counter() - spawned
+        timings = {}
+        for line in process.stdout:
+            if line.startswith("{"):
+                timings = json.loads(line)
+                break
+    finally:
+        process.terminate()
+        process.wait()
+    if not replied:
+        raise RuntimeError("бот не ответил на /start за 60 секунд")
+    timings["first_reply"] = first_reply
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--outline-latency", default="fixed:5", help="задержка fake Outline API")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    from fake_outline_server import FakeOutlineServer
+
+    outline = FakeOutlineServer(args.outline_latency)
+    outline.start_in_thread()
+    telegram = ThreadingHTTPServer(("127.0.0.1", 0), FakeTelegramHandler)
+    telegram.daemon_threads = True
+    threading.Thread(target=telegram.serve_forever, daemon=True).start()
+
+    print(f"Запусков: {args.runs}, задержка Outline: {args.outline_latency}")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(args.runs):
+            results.append(run_once(telegram.server_port, outline.url("bench"), os.path.join(tmp, f"bot{i}.db")))
+
+    for name, title in (("import", "импорт main"), ("build", "сборка приложения"),
+                        ("first_reply", "до первого ответа")):
+        values = [r[name] for r in results]
+        print(f"{title:<20} p50={percentile(values, 50) * 1000:8.1f} мс  max={max(values) * 1000:8.1f} мс")
+
+    telegram.shutdown()
+    outline.stop_thread()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import false, select, update
+from telegram.error import BadRequest, Forbidden
+
+import config
+import database
+import outbox
+
+logger = logging.getLogger(__name__)
+
+# Ответы Telegram, после которых писать в чат бессмысленно
+UNREACHABLE = ("chat not found", "user is deactivated", "bot was blocked", "bot was kicked")
+
+def is_unreachable(error: Exception) -> bool:
+    return isinstance(error, Forbidden) or (
+        isinstance(error, BadRequest) and any(reason in str(error).lower() for reason in UNREACHABLE))
+
+class Progress:
+    """Живая статистика рассылки в этом процессе (итоги - в строке broadcasts)"""
+    __slots__ = ("broadcast_id", "started", "sent", "failed", "blocked", "cursor")
+
+    def __init__(self, broadcast_id: int, cursor: int):
+        self.broadcast_id = broadcast_id
+        self.started = time.monotonic()
+        self.sent = self.failed = self.blocked = 0
+        self.cursor = cursor
+
+    @property
+    def rate(self) -> float:
+        """Сообщений в секунду с запуска (или возобновления)"""
+        elapsed = time.monotonic() - self.started
+        return (self.sent + self.failed + self.blocked) / elapsed if elapsed > 0 else 0.0
+
+class BroadcastRunner:
+    """
+    Рассылка всем пользователям без загрузки таблицы users в память.
+    Получатели читаются keyset-порциями (id > курсор ORDER BY id LIMIT n,
+    только id и telegram_id), порция уходит через outbox с приоритетом
+    BULK - лимиты Telegram соблюдает очередь, ответы пользователям идут
+    впереди рассылки. После порции курсор и итоги фиксируются в строке
+    broadcasts одной транзакцией: после перезапуска рассылка продолжается
+    с курсора (повторно может уйти не больше одной порции). Заблокировавшие
+    бота помечаются users.chat_blocked и следующими рассылками пропускаются.
+    """
+
+    def __init__(self, session_factory=None, chunk_size: int = None, sender: outbox.Outbox = None):
+        self.session_factory = session_factory or database.async_session
+        self.chunk_size = chunk_size or config.Config.BROADCAST_CHUNK
+        self.sender = sender
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.progress: Dict[int, Progress] = {}
+
+    async def start(self, bot, text: str, created_by: int = None) -> int:
+        """Создать рассылку и запустить ее в фоне; вернуть id"""
+        async with self.session_factory() as db:
+            row = database.Broadcast(text=text, created_by=created_by)
+            db.add(row)
+            await db.commit()
+            broadcast_id = row.id
+        logger.info(f"📣 Рассылка #{broadcast_id} запущена")
+        self._spawn(bot, broadcast_id, 0)
+        return broadcast_id
+
+    async def resume_all(self, bot) -> List[int]:
+        """После перезапуска продолжить незавершенные рассылки с их курсоров"""
+        async with self.session_factory() as db:
+            rows = (await db.execute(
+                select(database.Broadcast.id, database.Broadcast.last_user_id)
+                .where(database.Broadcast.status == "running")
+            )).all()
+        for broadcast_id, cursor in rows:
+            logger.info(f"📣 Рассылка #{broadcast_id} продолжается с пользователя {cursor}")
+            self._spawn(bot, broadcast_id, cursor)
+        return [broadcast_id for broadcast_id, _ in rows]
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            task.cancel()
+        async with self.session_factory() as db:
+            changed = await db.execute(
+                update(database.Broadcast)
+                .where(database.Broadcast.id == broadcast_id, database.Broadcast.status == "running")
+                .values(status="cancelled", finished_at=datetime.utcnow())
+            )
+            await db.commit()
+            return bool(changed.rowcount)
+
+    def running_ids(self) -> List[int]:
+        """Рассылки, которые идут в этом процессе"""
+        return sorted(self._tasks)
+
+    def _spawn(self, bot, broadcast_id: int, cursor: int):
+        if broadcast_id in self._tasks and not self._tasks[broadcast_id].done():
+            return
+        self.progress[broadcast_id] = Progress(broadcast_id, cursor)
+        task = asyncio.create_task(self._run(bot, broadcast_id, cursor))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    # ===== ОТПРАВКА =====
+
+    async def _run(self, bot, broadcast_id: int, cursor: int):
+        progress = self.progress[broadcast_id]
+        try:
+            async with self.session_factory() as db:
+                text = await db.scalar(select(database.Broadcast.text).where(database.Broadcast.id == broadcast_id))
+            while True:
+                # Сессия открыта только на чтение порции - не на время отправки
+                async with self.session_factory() as db:
+                    chunk = (await db.execute(
+                        select(database.User.id, database.User.telegram_id)
+                        .where(database.User.id > cursor, database.User.chat_blocked == false())
+                        .order_by(database.User.id)
+                        .limit(self.chunk_size)
+                    )).all()
+                if not chunk:
+                    break
+                cursor = await self._send_chunk(bot, broadcast_id, text, chunk, progress)
+                if cursor is None:  # рассылку отменили
+                    return
+
+            async with self.session_factory() as db:
+                await db.execute(
+                    update(database.Broadcast)
+                    .where(database.Broadcast.id == broadcast_id, database.Broadcast.status == "running")
+                    .values(status="done", finished_at=datetime.utcnow())
+                )
+                await db.commit()
+            logger.info(f"📣 Рассылка #{broadcast_id} завершена: отправлено {progress.sent}, "
+                        f"заблокировали {progress.blocked}, ошибок {progress.failed}, {progress.rate:.1f} сообщ./с")
+        except asyncio.CancelledError:
+            logger.info(f"📣 Рассылка #{broadcast_id} остановлена на пользователе {cursor}")
+            raise
+        except Exception as e:
+            # Статус остается running - при следующем запуске бота продолжится с курсора
+            logger.error(f"📣 Рассылка #{broadcast_id} прервана на пользователе {cursor}: {e}")
+
+    async def _send_chunk(self, bot, broadcast_id: int, text: str, chunk, progress: Progress) -> Optional[int]:
+        sender = self.sender or outbox.get_outbox()
+        results = await asyncio.gather(*(
+            sender.send(bot, telegram_id, text, priority=outbox.BULK) for _, telegram_id in chunk
+        ), return_exceptions=True)
+
+        sent = failed = 0
+        blocked = []
+        for (user_id, telegram_id), result in zip(chunk, results):
+            if not isinstance(result, Exception):
+                sent += 1
+            elif is_unreachable(result):
+                blocked.append(user_id)
+            else:
+                failed += 1
+                logger.warning(f"📣 Рассылка #{broadcast_id}: не доставлено {telegram_id}: {result}")
+        cursor = chunk[-1][0]
+
+        # Контрольная точка: курсор, итоги и заблокировавшие - одной транзакцией
+        async with self.session_factory() as db:
+            changed = await db.execute(
+                update(database.Broadcast)
+                .where(database.Broadcast.id == broadcast_id, database.Broadcast.status == "running")
+                .values(last_user_id=cursor,
+                        sent=database.Broadcast.sent + sent,
+                        failed=database.Broadcast.failed + failed,
+                        blocked=database.Broadcast.blocked + len(blocked))
+            )
+            running = bool(changed.rowcount)
+            if blocked:
+                await db.execute(update(database.User).where(database.User.id.in_(blocked)).values(chat_blocked=True))
+            await db.commit()
+
+        progress.sent += sent
+        progress.failed += failed
+        progress.blocked += len(blocked)
+        progress.cursor = cursor
+        return cursor if running else None
+
+    # ===== ОТЧЕТ =====
+
+    async def report_lines(self) -> List[str]:
+        """Строки для админ-панели: последние рассылки и скорость идущих"""
+        async with self.session_factory() as db:
+            rows = (await db.scalars(
+                select(database.Broadcast).order_by(database.Broadcast.id.desc()).limit(3)
+            )).all()
+        lines = []
+        for row in rows:
+            line = (f"• #{row.id} {row.status}: отправлено {row.sent}, "
+                    f"заблокировали {row.blocked}, ошибок {row.failed}")
+            progress = self.progress.get(row.id)
+            if row.status == "running" and progress is not None:
+                line += f", {progress.rate:.1f} сообщ./с, дошла до id {progress.cursor}"
+            lines.append(line)
+        return lines
+
+async def unblock(db, telegram_id: int):
+    """Пользователь снова пишет боту - значит, разблокировал: вернуть его в рассылки"""
+    await db.execute(update(database.User).where(database.User.telegram_id == telegram_id)
+                     .values(chat_blocked=False))
+    await db.commit()
+
+_runner: Optional[BroadcastRunner] = None
+
+def get_runner() -> BroadcastRunner:
+    """Общий запускатель рассылок (создается при первом обращении)"""
+    global _runner
+    if _runner is None:
+        _runner = BroadcastRunner()
+    return _runner
@@ -0,0 +1,169 @@
+"""
+Компактный формат callback_data.
+
+Строки вида admin_user_{id} или tariff_{id} растут вместе с аргументами и
+упираются в лимит Telegram (64 байта), как только в кнопку нужно положить
+курсор или UUID платежа. Упакованная кнопка - это
+
+    "~" + версия формата + base85(id маршрута, аргументы)
+
+где id маршрута и целые числа - varint, строки - длина + UTF-8, UUID - 16
+байт. Разбор - один поиск маршрута по id и чтение полей по его типам.
+Id маршрута постоянный: кнопки в старых сообщениях продолжают работать
+после перезапуска бота, поэтому занятые id нельзя переиспользовать.
+"""
+import abc
+import base64
+import uuid
+from typing import Any, Tuple
+
+MARKER = "~"       # обычные callback_data с него не начинаются
+VERSION = "1"
+MAX_LENGTH = 64    # лимит Telegram на callback_data, байт
+
+# ===== VARINT =====
+
+def _write_uint(value: int, out: bytearray):
+    if value < 0:
+        raise ValueError(f"отрицательное значение {value}")
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_uint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("обрезанный varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+# ===== ТИПЫ ПОЛЕЙ =====
+
+class Field(abc.ABC):
+    """Тип аргумента: запись в буфер и чтение с позиции (неполный тип не создастся)"""
+
+    @abc.abstractmethod
+    def pack(self, value, out: bytearray):
+        ...
+
+    @abc.abstractmethod
+    def unpack(self, data: bytes, pos: int) -> Tuple[Any, int]:
+        ...
+
+class UInt(Field):
+    def pack(self, value, out):
+        _write_uint(int(value), out)
+
+    def unpack(self, data, pos):
+        return _read_uint(data, pos)
+
+class Int(Field):
+    """Целое со знаком (zigzag): -1 -> 1 байт"""
+
+    def pack(self, value, out):
+        value = int(value)
+        _write_uint(value * 2 if value >= 0 else -value * 2 - 1, out)
+
+    def unpack(self, data, pos):
+        value, pos = _read_uint(data, pos)
+        return (value >> 1) ^ -(value & 1), pos
+
+class Bool(Field):
+    def pack(self, value, out):
+        out.append(1 if value else 0)
+
+    def unpack(self, data, pos):
+        if pos >= len(data):
+            raise ValueError("обрезанное поле")
+        return data[pos] == 1, pos + 1
+
+class Str(Field):
+    def pack(self, value, out):
+        raw = str(value).encode()
+        _write_uint(len(raw), out)
+        out += raw
+
+    def unpack(self, data, pos):
+        length, pos = _read_uint(data, pos)
+        if pos + length > len(data):
+            raise ValueError("обрезанная строка")
+        return data[pos:pos + length].decode(), pos + length
+
+class Ident(Field):
+    """Идентификатор: UUID (id платежа ЮKassa) - 16 байт, иное (test_...) - строкой"""
+
+    def pack(self, value, out):
+        try:
+            parsed = uuid.UUID(value)
+        except (ValueError, AttributeError, TypeError):
+            parsed = None
+        if parsed is not None and str(parsed) == value:
+            out.append(0)
+            out += parsed.bytes
+        else:
+            out.append(1)
+            STR.pack(value, out)
+
+    def unpack(self, data, pos):
+        if pos >= len(data):
+            raise ValueError("обрезанное поле")
+        if data[pos] == 0:
+            if pos + 17 > len(data):
+                raise ValueError("обрезанный UUID")
+            return str(uuid.UUID(bytes=bytes(data[pos + 1:pos + 17]))), pos + 17
+        return STR.unpack(data, pos + 1)
+
+UINT = UInt()
+INT = Int()
+BOOL = Bool()
+STR = Str()
+IDENT = Ident()
+
+# ===== МАРШРУТЫ =====
+
+class Spec:
+    """Упакованный маршрут: постоянный id, имя для метрик и типы аргументов"""
+
+    def __init__(self, route_id: int, name: str, *fields: Field):
+        self.route_id = route_id
+        self.name = name
+        self.fields = fields
+
+    def pack(self, *args) -> str:
+        """Аргументы -> callback_data; ValueError, если не влезает в лимит Telegram"""
+        if len(args) != len(self.fields):
+            raise ValueError(f"{self.name}: ожидалось {len(self.fields)} аргументов, получено {len(args)}")
+        out = bytearray()
+        _write_uint(self.route_id, out)
+        for field, value in zip(self.fields, args):
+            field.pack(value, out)
+        data = MARKER + VERSION + base64.b85encode(bytes(out)).decode()
+        if len(data.encode()) > MAX_LENGTH:
+            raise ValueError(f"{self.name}: callback_data длиннее {MAX_LENGTH} байт")
+        return data
+
+    def unpack(self, payload: bytes, pos: int) -> tuple:
+        args = []
+        for field in self.fields:
+            value, pos = field.unpack(payload, pos)
+            args.append(value)
+        if pos != len(payload):
+            raise ValueError(f"{self.name}: лишние байты в callback_data")
+        return tuple(args)
+
+def is_packed(data: str) -> bool:
+    return data.startswith(MARKER)
+
+def decode(data: str) -> Tuple[int, bytes, int]:
+    """callback_data -> (id маршрута, байты, позиция первого аргумента); ValueError - не наш формат"""
+    if data[1:2] != VERSION:
+        raise ValueError(f"неизвестная версия callback_data: {data[1:2]!r}")
+    payload = base64.b85decode(data[2:])
+    route_id, pos = _read_uint(payload, 0)
+    return route_id, payload, pos
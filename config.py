@@ -10,7 +10,29 @@ class Config:
     
     # Database
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///bot.db")
-    
+    # Для обработчиков (AsyncSession); по умолчанию выводится из DATABASE_URL:
+    # sqlite -> sqlite+aiosqlite, postgresql -> postgresql+asyncpg
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", "")
+    ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", 5))  # соединений в пуле AsyncSession
+    # Профиль файловой SQLite: "production" - WAL, synchronous=NORMAL, mmap и кэш,
+    # запись через одно соединение-писатель, чтение через пул читателей
+    SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "")
+    SQLITE_READERS = int(os.getenv("SQLITE_READERS", 4))                      # соединений-читателей
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # байт
+    SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", 64 * 1024))            # кэш страниц на соединение, КБ
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))   # ожидание блокировки, мс
+    # Кэш снимков пользователей (id, баланс, trial_used) для экранов навигации
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))  # пользователей
+    USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))     # секунд
+    # Последние отрисованные экраны: одинаковые правки сообщений не отправляются
+    RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 20000))  # сообщений
+    # Очередь исходящих send_message (лимиты Telegram: ~30 сообщений/с на бота, 1/с в чат)
+    OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 30))  # сообщений в секунду
+    OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))       # сообщений в секунду в один чат
+    OUTBOX_MAX_QUEUE = int(os.getenv("OUTBOX_MAX_QUEUE", 10000))     # сообщений, дальше отправитель ждет
+    OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", 3))     # повторов после сетевой ошибки/429
+    BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", 200))         # получателей на порцию и контрольную точку
+
     # Payments
     YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
     YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
@@ -19,6 +41,44 @@ class Config:
     OUTLINES_API_URL = os.getenv("OUTLINES_API_URL")
     OUTLINES_API_KEY = os.getenv("OUTLINES_API_KEY")
     OUTLINES_SERVER_ID = os.getenv("OUTLINES_SERVER_ID", "default")
+    OUTLINES_TIMEOUT = float(os.getenv("OUTLINES_TIMEOUT", 10))  # секунд на один запрос
+    OUTLINES_POOL_SIZE = int(os.getenv("OUTLINES_POOL_SIZE", 100))  # соединений в пуле
+    
+    # Кластер Outline: JSON-список серверов
+    # [{"id": "de1", "api_url": "https://...", "api_key": "...", "max_keys": 500}]
+    # Если не задан - используется один сервер из OUTLINES_API_URL
+    OUTLINES_SERVERS = os.getenv("OUTLINES_SERVERS", "")
+    OUTLINES_LOAD_REFRESH = int(os.getenv("OUTLINES_LOAD_REFRESH", 60))  # секунд
+    OUTLINES_MIRROR_TTL = int(os.getenv("OUTLINES_MIRROR_TTL", 60))  # обновление зеркала ключей, секунд
+    OUTLINES_BATCH_CONCURRENCY = int(os.getenv("OUTLINES_BATCH_CONCURRENCY", 20))  # параллельных запросов в пакете
+    OUTLINES_RATE_LIMIT = float(os.getenv("OUTLINES_RATE_LIMIT", 50))  # запросов в секунду на сервер, 0 - без лимита
+    OUTLINES_CREATE_ATTEMPTS = int(os.getenv("OUTLINES_CREATE_ATTEMPTS", 3))  # попыток создать ключ
+    OUTLINES_BACKOFF_BASE = float(os.getenv("OUTLINES_BACKOFF_BASE", 0.5))     # первая пауза между попытками, секунд
+    OUTLINES_BACKOFF_MAX = float(os.getenv("OUTLINES_BACKOFF_MAX", 8))         # максимальная пауза, секунд
+    
+    # Проверка здоровья серверов и circuit breaker
+    OUTLINES_PROBE_INTERVAL = float(os.getenv("OUTLINES_PROBE_INTERVAL", 15))  # секунд между проверками
+    OUTLINES_PROBE_TIMEOUT = float(os.getenv("OUTLINES_PROBE_TIMEOUT", 3))     # таймаут проверки, секунд
+    OUTLINES_BREAKER_FAILURES = int(os.getenv("OUTLINES_BREAKER_FAILURES", 3))  # ошибок подряд до размыкания
+    OUTLINES_BREAKER_RESET = float(os.getenv("OUTLINES_BREAKER_RESET", 30))     # секунд до пробного запроса
+    
+    # Сбор трафика по ключам из /metrics/transfer
+    TRAFFIC_COLLECT_INTERVAL = int(os.getenv("TRAFFIC_COLLECT_INTERVAL", 300))  # секунд
+    
+    # Сверка vpn_keys с серверами Outline
+    RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", 3600))  # секунд
+    RECONCILE_FIX = os.getenv("RECONCILE_FIX", "false").lower() == "true"  # иначе только отчет
+    RECONCILE_MAX_DELETE = int(os.getenv("RECONCILE_MAX_DELETE", 500))  # больше сирот - не удаляем, это похоже на сбой
+    
+    # Счетчики админ-статистики: сверка с пересчетом по таблицам
+    COUNTERS_VERIFY_INTERVAL = int(os.getenv("COUNTERS_VERIFY_INTERVAL", 3600))  # секунд
+    COUNTERS_REPAIR = os.getenv("COUNTERS_REPAIR", "true").lower() == "true"  # иначе только отчет
+    
+    # Пул заранее созданных ключей (на каждый сервер)
+    KEY_POOL_LOW_WATER = int(os.getenv("KEY_POOL_LOW_WATER", 5))    # ниже - пополняем
+    KEY_POOL_HIGH_WATER = int(os.getenv("KEY_POOL_HIGH_WATER", 20))  # пополняем до
+    KEY_POOL_REFILL = int(os.getenv("KEY_POOL_REFILL", 60))          # период проверки, секунд
+    KEY_POOL_KEY_LIMIT_GB = int(os.getenv("KEY_POOL_KEY_LIMIT_GB", 5))  # лимит ключа, пока его не настроили при выдаче
     
     # Tariffs
     TARIFFS = {
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, false, func, inspect, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Счетчики админ-статистики (таблица counters) вместо COUNT(*) и SUM по всей
+# таблице на каждое нажатие кнопки. Изменения копятся в session.info и
+# записываются в начале commit той же транзакции: строка счетчика заблокирована
+# только на время коммита, а не всей покупки с запросами к Outline.
+# Вставки и изменения через ORM учитываются событиями ниже, UPDATE/INSERT
+# в обход ORM (ledger.py, upsert пользователя, статус платежа) - через add().
+# Расхождения (массовые вставки, ручные правки базы) исправляет CounterAudit.
+
+counters = database.Counter.__table__
+
+USERS = "users"
+KEYS = "vpn_keys"
+ACTIVE_SUBSCRIPTIONS = "subscriptions:active"
+BALANCE = "balance_kopecks"
+PAYMENTS = "payments:"  # + статус платежа
+
+def payments(status: Optional[str]) -> str:
+    return f"{PAYMENTS}{status}"
+
+def add(session: Session, name: str, delta: int = 1):
+    """Учесть изменение счетчика; запишется при commit этой же транзакции"""
+    if delta:
+        deltas = session.info.setdefault("counter_deltas", {})
+        deltas[name] = deltas.get(name, 0) + delta
+
+def _write(session: Session, name: str, value: int, increment: bool = True):
+    """value прибавляется к счетчику (increment=False - записывается); строки нет - создается"""
+    dialect_name = session.get_bind(clause=counters.insert()).dialect.name
+    if dialect_name in database.UPSERT_INSERTS:
+        stmt = database.UPSERT_INSERTS[dialect_name](counters).values(name=name, value=value)
+        new_value = counters.c.value + stmt.excluded.value if increment else stmt.excluded.value
+        session.execute(stmt.on_conflict_do_update(index_elements=[counters.c.name], set_={"value": new_value}))
+        return
+    result = session.execute(update(counters).where(counters.c.name == name).values(
+        value=counters.c.value + value if increment else value))
+    if not result.rowcount:
+        session.execute(counters.insert().values(name=name, value=value))
+
+# ===== УЧЕТ ИЗМЕНЕНИЙ ORM =====
+# Таблицы узнаются по __tablename__: у vpn_bot_* скриптов свои модели тех же таблиц
+
+def _count_row(session: Session, obj, sign: int):
+    """Вставка (sign=1) или удаление (sign=-1) строки"""
+    table = getattr(obj, "__tablename__", None)
+    values = inspect(obj).dict  # без ленивой загрузки
+    if table == "users":
+        add(session, USERS, sign)
+        add(session, BALANCE, sign * (values.get("balance_kopecks") or 0))
+    elif table == "vpn_keys":
+        add(session, KEYS, sign)
+    elif table == "subscriptions":
+        if values.get("is_active"):
+            add(session, ACTIVE_SUBSCRIPTIONS, sign)
+    elif table == "payments":
+        add(session, payments(values.get("status")), sign)
+
+# Столбцы, изменение которых двигает счетчики
+TRACKED = {"users": "balance_kopecks", "subscriptions": "is_active", "payments": "status"}
+
+def _count_change(session: Session, obj):
+    table = getattr(obj, "__tablename__", None)
+    column = TRACKED.get(table)
+    state = inspect(obj)
+    if column is None or column not in state.attrs.keys():
+        return
+    history = state.attrs[column].history
+    if not history.has_changes():
+        return
+    old = history.deleted[0] if history.deleted else None
+    new = history.added[0] if history.added else None
+    if table == "users":
+        add(session, BALANCE, (new or 0) - (old or 0))
+    elif table == "subscriptions":
+        add(session, ACTIVE_SUBSCRIPTIONS, bool(new) - bool(old))
+    elif old != new:
+        if history.deleted:
+            add(session, payments(old), -1)
+        # иначе прежний статус не был загружен - уменьшение поправит сверка
+        add(session, payments(new), 1)
+
+@event.listens_for(Session, "after_flush")
+def _collect_deltas(session, flush_context):
+    # new/dirty/deleted и история атрибутов здесь еще в состоянии до flush
+    for obj in session.new:
+        _count_row(session, obj, 1)
+    for obj in session.deleted:
+        _count_row(session, obj, -1)
+    for obj in session.dirty:
+        _count_change(session, obj)
+
+@event.listens_for(Session, "before_commit")
+def _write_deltas(session):
+    # commit сбросил бы изменения следом - сбрасываем сами, чтобы учесть их дельты
+    session.flush()
+    deltas = session.info.pop("counter_deltas", None)
+    if not deltas:
+        return
+    # Один порядок строк во всех транзакциях - без взаимных блокировок на PostgreSQL
+    for name in sorted(deltas):
+        if deltas[name]:
+            _write(session, name, deltas[name])
+
+@event.listens_for(Session, "after_rollback")
+def _forget_deltas(session):
+    session.info.pop("counter_deltas", None)
+
+# ===== ЧТЕНИЕ =====
+
+def _totals(rows) -> Dict:
+    values = dict(rows)
+    by_status = {name[len(PAYMENTS):]: value for name, value in values.items() if name.startswith(PAYMENTS)}
+    return {
+        "users": values.get(USERS, 0),
+        "payments": sum(by_status.values()),
+        "payments_by_status": by_status,
+        "keys": values.get(KEYS, 0),
+        "active_subscriptions": values.get(ACTIVE_SUBSCRIPTIONS, 0),
+        "balance_kopecks": values.get(BALANCE, 0),
+    }
+
+async def snapshot(db: AsyncSession) -> Dict:
+    """Все счетчики одним чтением маленькой таблицы - O(1) от размера базы"""
+    result = await db.execute(select(counters.c.name, counters.c.value))
+    return _totals(result.all())
+
+def snapshot_sync(db: Session) -> Dict:
+    return _totals(db.execute(select(counters.c.name, counters.c.value)).all())
+
+# ===== СВЕРКА =====
+
+def recount(db: Session) -> Dict[str, int]:
+    """Истинные значения полным пересчетом по таблицам"""
+    users = database.User.__table__
+    keys = database.VPNKey.__table__
+    subscriptions = database.Subscription.__table__
+    payments_table = database.Payment.__table__
+
+    values = {
+        USERS: db.scalar(select(func.count()).select_from(users)),
+        BALANCE: db.scalar(select(func.coalesce(func.sum(users.c.balance_kopecks), 0))),
+        KEYS: db.scalar(select(func.count()).select_from(keys)),
+        ACTIVE_SUBSCRIPTIONS: db.scalar(
+            select(func.count()).select_from(subscriptions).where(subscriptions.c.is_active == True)),
+    }
+    rows = db.execute(select(payments_table.c.status, func.count()).group_by(payments_table.c.status))
+    for status, count in rows:
+        values[payments(status)] = count
+    return values
+
+class CounterAudit:
+    """
+    Периодическая сверка счетчиков с пересчетом по таблицам.
+    На время сверки таблица counters блокируется на запись: транзакции,
+    которые меняют счетчики, ждут на своем commit, поэтому пересчет и
+    сохраненные значения описывают одно состояние базы, а исправление
+    не затирает чужие дельты. Сессия асинхронная (database.async_session):
+    в профиле production SQLite сверка пишет через того же единственного
+    писателя, что и обработчики, а не вторым соединением.
+    """
+
+    def __init__(self, session_factory=None, repair: bool = None):
+        self.session_factory = session_factory or database.async_session  # AsyncSession
+        self.repair = repair if repair is not None else config.Config.COUNTERS_REPAIR
+        self.last_run: Optional[datetime] = None
+        self.last_drift: Dict[str, Tuple[int, int]] = {}  # имя -> (в счетчике, на самом деле)
+        self.repaired = 0  # исправлено счетчиков за все время
+
+    async def run(self, repair: bool = None) -> Dict[str, Tuple[int, int]]:
+        repair = self.repair if repair is None else repair
+        async with self.session_factory() as db:
+            # Блокировка и полный пересчет - одной транзакцией
+            drift = await db.run_sync(self._drift)
+            if drift and repair:
+                await db.run_sync(lambda session: [_write(session, name, value, increment=False)
+                                                   for name, (_, value) in drift.items()])
+                await db.commit()
+                self.repaired += len(drift)
+            else:
+                await db.rollback()
+
+        self.last_run = datetime.utcnow()
+        self.last_drift = drift
+        if drift:
+            details = ", ".join(f"{name}: {old} -> {new}" for name, (old, new) in drift.items())
+            logger.warning(f"Сверка счетчиков: расхождения{' исправлены' if repair else ''} - {details}")
+        return drift
+
+    def _drift(self, db: Session) -> Dict[str, Tuple[int, int]]:
+        self._lock(db)
+        stored = dict(db.execute(select(counters.c.name, counters.c.value)).all())
+        actual = recount(db)
+        drift = {}
+        for name in sorted(stored.keys() | actual.keys()):
+            if stored.get(name, 0) != actual.get(name, 0):
+                drift[name] = (stored.get(name, 0), actual.get(name, 0))
+        return drift
+
+    def _lock(self, db: Session):
+        if db.get_bind().dialect.name == "postgresql":
+            db.execute(text("LOCK TABLE counters IN SHARE ROW EXCLUSIVE MODE"))
+        else:
+            # SQLite: пустой UPDATE открывает транзакцию записи - другие писатели ждут
+            db.execute(update(counters).where(false()).values(value=counters.c.value))
+
+    def report_lines(self) -> List[str]:
+        """Строки для админ-панели"""
+        if self.last_run is None:
+            return []
+        line = f"🧮 Счетчики сверены {self.last_run:%H:%M} UTC: "
+        line += f"расхождений {len(self.last_drift)}" if self.last_drift else "сходятся"
+        return [line + f", исправлено всего {self.repaired}"]
+
+_audit: Optional[CounterAudit] = None
+
+def get_audit() -> CounterAudit:
+    """Общая сверка счетчиков (создается при первом обращении)"""
+    global _audit
+    if _audit is None:
+        _audit = CounterAudit()
+    return _audit
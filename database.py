@@ -1,13 +1,138 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, BigInteger
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, DateTime, Date, Boolean, ForeignKey, Text, BigInteger, LargeBinary, UniqueConstraint
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
 from datetime import datetime
 import config
+from migrations import migrate
 
 # Создаем движок БД
 engine = create_engine(config.Config.DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(bind=engine)
-Base = declarative_base()
+Base = declarative_base()  # индексы горячих запросов создает migrations.py
+
+# Асинхронные драйверы для синхронных URL
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+# Диалекты с INSERT ... ON CONFLICT ... RETURNING
+UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+def async_database_url(url: str) -> str:
+    """sqlite:///bot.db -> sqlite+aiosqlite:///bot.db, postgresql://... -> postgresql+asyncpg://..."""
+    scheme, sep, rest = url.partition("://")
+    dialect = scheme.split("+", 1)[0]
+    return f"{ASYNC_DRIVERS.get(dialect, scheme)}{sep}{rest}"
+
+def sqlite_production(url: str) -> bool:
+    """Включен ли профиль production (только для файловой SQLite)"""
+    return (config.Config.SQLITE_PROFILE == "production"
+            and url.startswith("sqlite") and ":memory:" not in url)
+
+def apply_sqlite_profile(sync_engine, readonly: bool = False):
+    """PRAGMA профиля production для каждого нового соединения движка"""
+    pragmas = [
+        "journal_mode=WAL",    # читатели не ждут писателя, писатель не ждет читателей
+        "synchronous=NORMAL",  # в WAL fsync только при checkpoint; без риска порчи базы
+        f"mmap_size={config.Config.SQLITE_MMAP_SIZE}",
+        f"cache_size=-{config.Config.SQLITE_CACHE_KB}",
+        f"busy_timeout={config.Config.SQLITE_BUSY_TIMEOUT_MS}",
+    ]
+    if readonly:
+        pragmas.append("query_only=ON")
+
+    @event.listens_for(sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
+
+if sqlite_production(config.Config.DATABASE_URL):
+    apply_sqlite_profile(engine)
+
+_async_engine = None
+_async_reader_engine = None
+_async_sessionmaker = None
+
+def _async_url() -> str:
+    return config.Config.ASYNC_DATABASE_URL or async_database_url(config.Config.DATABASE_URL)
+
+def get_async_engine():
+    """Асинхронный движок (создается при первом обращении - драйвер нужен только боту)"""
+    global _async_engine
+    if _async_engine is None:
+        url = _async_url()
+        options = {}
+        if sqlite_production(url):
+            # Один писатель: записи выстраиваются в очередь пула, а не в SQLITE_BUSY
+            options = {"poolclass": AsyncAdaptedQueuePool, "pool_size": 1, "max_overflow": 0}
+        elif url.startswith("sqlite") and ":memory:" not in url:
+            # Для файловой SQLite по умолчанию NullPool: новое соединение (и поток aiosqlite)
+            # на каждую сессию. Пул соединений в ~1.5 раза быстрее под нагрузкой.
+            options = {"poolclass": AsyncAdaptedQueuePool, "pool_size": config.Config.ASYNC_DB_POOL_SIZE}
+        _async_engine = create_async_engine(url, echo=False, **options)
+        if sqlite_production(url):
+            apply_sqlite_profile(_async_engine.sync_engine)
+    return _async_engine
+
+def get_async_reader_engine():
+    """Пул читателей профиля production (соединения только для чтения)"""
+    global _async_reader_engine
+    if _async_reader_engine is None:
+        _async_reader_engine = create_async_engine(
+            _async_url(), echo=False, poolclass=AsyncAdaptedQueuePool,
+            pool_size=config.Config.SQLITE_READERS, max_overflow=0
+        )
+        apply_sqlite_profile(_async_reader_engine.sync_engine, readonly=True)
+    return _async_reader_engine
+
+class RoutingSession(Session):
+    """
+    Сессия профиля production: SELECT идут в пул читателей, flush и
+    UPDATE/DELETE/INSERT - в соединение-писатель. После первой записи
+    транзакция до конца остается на писателе и видит свои изменения.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, UpdateBase) or self.info.get("writer"):
+            self.info["writer"] = True
+            return get_async_engine().sync_engine
+        return get_async_reader_engine().sync_engine
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _release_writer(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("writer", None)
+
+def async_session() -> AsyncSession:
+    """
+    Сессия для обработчиков: запросы не блокируют event loop.
+    Использование: async with database.async_session() as db: ...
+    """
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        # expire_on_commit=False - объекты читаются после commit без ленивых запросов
+        if sqlite_production(_async_url()):
+            _async_sessionmaker = async_sessionmaker(sync_session_class=RoutingSession, expire_on_commit=False)
+        else:
+            _async_sessionmaker = async_sessionmaker(get_async_engine(), expire_on_commit=False)
+    return _async_sessionmaker()
+
+async def dispose_async_engine():
+    global _async_engine, _async_reader_engine, _async_sessionmaker
+    for async_engine in (_async_engine, _async_reader_engine):
+        if async_engine is not None:
+            await async_engine.dispose()
+    _async_engine = None
+    _async_reader_engine = None
+    _async_sessionmaker = None
 
 class User(Base):
     __tablename__ = 'users'
@@ -16,8 +141,10 @@ class User(Base):
     telegram_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(100))
     full_name = Column(String(200))
-    balance = Column(Float, default=0.0)
+    balance = Column(Float, default=0.0)  # зеркало balance_kopecks / 100 для отображения
+    balance_kopecks = Column(BigInteger, nullable=False, default=0, server_default="0")  # меняется только через ledger.py
     trial_used = Column(Boolean, default=False)  # Этот столбец был добавлен
+    chat_blocked = Column(Boolean, nullable=False, default=False, server_default="0")  # бот заблокирован - рассылки пропускают
     created_at = Column(DateTime, default=datetime.utcnow)
     
     payments = relationship("Payment", back_populates="user")
@@ -60,19 +187,98 @@ class VPNKey(Base):
     key = Column(Text)
     name = Column(String(100))
     data_limit = Column(Integer)
+    server_id = Column(String(50))  # сервер Outline, на котором создан ключ
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
     
     user = relationship("User", back_populates="keys")
 
+class PooledKey(Base):
+    """Заранее созданный ключ Outline, ожидающий выдачи"""
+    __tablename__ = 'key_pool'
+    
+    id = Column(Integer, primary_key=True)
+    server_id = Column(String(50), nullable=False)
+    key_id = Column(String(100), nullable=False)
+    access_url = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, index=True)  # NULL - ключ свободен
+    claimed_name = Column(String(100))
+
+class LedgerEntry(Base):
+    """Движение по балансу (только добавление): сумма всех записей пользователя = balance_kopecks"""
+    __tablename__ = 'balance_ledger'
+    __table_args__ = (UniqueConstraint('reason', 'reference'),)  # платеж не зачисляется дважды
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    amount_kopecks = Column(BigInteger, nullable=False)  # > 0 - зачисление, < 0 - списание
+    balance_after = Column(BigInteger, nullable=False)
+    reason = Column(String(20), nullable=False)          # topup, purchase, admin, opening...
+    reference = Column(String(100))                      # id платежа, тариф и т.п.
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class Counter(Base):
+    """Счетчик админ-статистики; меняется в транзакции самого изменения (counters.py)"""
+    __tablename__ = 'counters'
+    
+    name = Column(String(50), primary_key=True)  # users, vpn_keys, payments:<статус>...
+    value = Column(BigInteger, nullable=False, default=0)
+
+class Broadcast(Base):
+    """Рассылка админа; last_user_id - курсор по users.id, до которого она дошла (broadcast.py)"""
+    __tablename__ = 'broadcasts'
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default="running")  # running, done, cancelled
+    created_by = Column(BigInteger)                                 # telegram_id админа
+    last_user_id = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)             # новых заблокировавших бота
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+class TrafficDay(Base):
+    """Трафик ключа за сутки: 24 почасовых счетчика байт в одном BLOB (array('Q'))"""
+    __tablename__ = 'traffic_days'
+    __table_args__ = (UniqueConstraint('server_id', 'key_id', 'day'),)
+    
+    id = Column(Integer, primary_key=True)
+    server_id = Column(String(50), nullable=False)
+    key_id = Column(String(100), nullable=False)
+    day = Column(Date, nullable=False)
+    buckets = Column(LargeBinary, nullable=False)
+    total = Column(BigInteger, default=0)  # сумма за сутки - для агрегатов в SQL
+
+class TrafficTotal(Base):
+    """Последний накопленный счетчик Outline по ключу - база для приращений после перезапуска"""
+    __tablename__ = 'traffic_totals'
+    __table_args__ = (UniqueConstraint('server_id', 'key_id'),)
+    
+    id = Column(Integer, primary_key=True)
+    server_id = Column(String(50), nullable=False)
+    key_id = Column(String(100), nullable=False)
+    total = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 # Создаем таблицы
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    # Схема и индексы ведутся версионными миграциями (migrations.py)
+    migrate(engine, Base.metadata)
+    
     print("✅ Таблицы базы данных созданы")
     print("   - users (с trial_used)")
     print("   - payments")
     print("   - subscriptions")
     print("   - vpn_keys")
+    print("   - key_pool")
+    print("   - traffic_days, traffic_totals")
+    print("   - balance_ledger")
+    print("   - counters")
+    print("   - broadcasts")
+    print("   - schema_migrations (версия схемы)")
 
 def get_db():
     db = SessionLocal()
@@ -81,5 +287,5 @@ def get_db():
     finally:
         db.close()
 
-# Инициализируем БД при импорте
-init_db()
+# init_db() вызывается при прогреве бота (post_init), а не при импорте:
+# импорт модуля не открывает соединений с БД
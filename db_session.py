@@ -0,0 +1,125 @@
+import functools
+import logging
+import time
+import weakref
+from collections import deque
+from typing import Dict, List
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних замеров получения соединения хранить для перцентилей
+CHECKOUT_SAMPLES = 1000
+
+def _percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class SessionScope:
+    """
+    Одна синхронная сессия БД на апдейт Telegram.
+
+    Обработчик, обернутый декоратором, получает сессию третьим аргументом:
+    при успехе она коммитится, при исключении откатывается и всегда
+    закрывается - соединение возвращается в пул.
+
+    Заодно считает утечки: сессию той же фабрики, которую сборщик мусора
+    удалил с незавершенной транзакцией (например, `db = next(get_db())`),
+    пул получает обратно только при сборке мусора.
+    """
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._checkout_times = deque(maxlen=CHECKOUT_SAMPLES)
+
+        # Метрики
+        self.opened = 0        # открыто сессий
+        self.closed = 0        # закрыто сессий
+        self.committed = 0     # обработчик завершился успешно
+        self.rolled_back = 0   # обработчик упал, изменения откачены
+        self.leaked = 0        # сессий удалено сборщиком мусора с открытой транзакцией
+
+        event.listen(session_factory, "after_begin", self._on_begin)
+        event.listen(session_factory, "after_transaction_end", self._on_transaction_end)
+
+    # ===== ДЕКОРАТОР =====
+
+    def __call__(self, handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            db = self.session_factory()
+            self.opened += 1
+            try:
+                # Соединение берем сразу: все обработчики начинают с запроса пользователя
+                started = time.perf_counter()
+                db.connection()
+                self._checkout_times.append(time.perf_counter() - started)
+
+                result = await handler(update, context, db)
+                db.commit()
+                self.committed += 1
+                return result
+            except Exception:
+                db.rollback()
+                self.rolled_back += 1
+                raise
+            finally:
+                db.close()
+                self.closed += 1
+        return wrapper
+
+    # ===== ОТСЛЕЖИВАНИЕ УТЕЧЕК =====
+
+    def _on_begin(self, session, transaction, connection):
+        info = session.info
+        info["holds_connection"] = True
+        if "leak_guard" not in info:
+            # Финализатор держит только словарь info, а не саму сессию
+            info["leak_guard"] = weakref.finalize(session, self._on_collected, info)
+
+    def _on_transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            session.info["holds_connection"] = False
+
+    def _on_collected(self, info: Dict):
+        if info.get("holds_connection"):
+            self.leaked += 1
+            logger.warning(f"⚠️ Сессия БД не закрыта и удалена сборщиком мусора (всего утечек: {self.leaked})")
+
+    # ===== МЕТРИКИ =====
+
+    @property
+    def active(self) -> int:
+        """Сессии, открытые декоратором и еще не закрытые"""
+        return self.opened - self.closed
+
+    def checkout_latency(self, p: float) -> float:
+        """Перцентиль времени получения соединения из пула, сек"""
+        return _percentile(self._checkout_times, p) if self._checkout_times else 0.0
+
+    def metrics(self) -> Dict:
+        pool = self.session_factory.kw["bind"].pool
+        return {
+            "opened": self.opened,
+            "active": self.active,
+            "committed": self.committed,
+            "rolled_back": self.rolled_back,
+            "leaked": self.leaked,
+            "pool_checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "checkout_p50": self.checkout_latency(50),
+            "checkout_p99": self.checkout_latency(99),
+        }
+
+    def report(self) -> List[str]:
+        """Строки состояния сессий для админ-панели"""
+        m = self.metrics()
+        lines = [f"🗄 Сессий БД: {m['opened']} (сейчас {m['active']}, откатов {m['rolled_back']})",
+                 f"⏱ Соединение из пула: p50={m['checkout_p50'] * 1000:.1f} мс, "
+                 f"p99={m['checkout_p99'] * 1000:.1f} мс"]
+        if m["pool_checked_out"] is not None:
+            lines.append(f"🔌 Занято соединений: {m['pool_checked_out']}")
+        if m["leaked"]:
+            lines.append(f"⚠️ Утечек сессий: {m['leaked']}")
+        return lines
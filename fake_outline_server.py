@@ -0,0 +1,300 @@
+"""
+Локальная замена Outline management API для нагрузочных тестов.
+
+Реализует /server, CRUD /access-keys, лимиты трафика и /metrics/transfer.
+Задержка ответа берется из распределения, часть запросов можно
+завершать ошибкой 500 или обрывом соединения, число ключей ограничивается.
+Все случайности идут от одного seed - прогоны воспроизводимы.
+
+Путь до API (секрет в URL настоящего сервера) может быть любым:
+маршрут определяется по хвосту пути.
+
+Запуск: python fake_outline_server.py --port 8081 --latency lognormal:0.02,0.5 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Распределение задержки, секунд:
+      fixed:0.02            - постоянная
+      uniform:0.01,0.05     - равномерная
+      exp:0.02              - экспоненциальная со средним 0.02
+      lognormal:0.02,0.5    - логнормальная с медианой 0.02 и sigma 0.5 (длинный хвост)
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "fixed":
+        value = values[0] if values else 0.0
+        return lambda rng: value
+    if kind == "uniform":
+        low, high = values
+        return lambda rng: rng.uniform(low, high)
+    if kind == "exp":
+        mean = values[0]
+        return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+    if kind == "lognormal":
+        median, sigma = values
+        mu = math.log(median) if median > 0 else 0.0
+        return lambda rng: rng.lognormvariate(mu, sigma) if median > 0 else 0.0
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+class FakeOutlineServer:
+    """Асинхронный HTTP/1.1 сервер с поведением Outline API"""
+
+    ROUTES = [
+        ("GET", re.compile(r"/server$"), "server_info"),
+        ("GET", re.compile(r"/access-keys$"), "list_keys"),
+        ("POST", re.compile(r"/access-keys$"), "create_key"),
+        ("GET", re.compile(r"/access-keys/([^/]+)$"), "get_key"),
+        ("PUT", re.compile(r"/access-keys/([^/]+)$"), "update_key"),
+        ("DELETE", re.compile(r"/access-keys/([^/]+)$"), "delete_key"),
+        ("PUT", re.compile(r"/access-keys/([^/]+)/name$"), "rename_key"),
+        ("PUT", re.compile(r"/access-keys/([^/]+)/data-limit$"), "set_limit"),
+        ("DELETE", re.compile(r"/access-keys/([^/]+)/data-limit$"), "remove_limit"),
+        ("GET", re.compile(r"/metrics/transfer$"), "transfer"),
+    ]
+
+    def __init__(self, latency: str = "fixed:0", error_rate: float = 0.0, drop_rate: float = 0.0,
+                 max_keys: Optional[int] = None, seed: int = 0, bytes_per_poll: int = 50 * 1024 ** 2):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate      # доля ответов 500
+        self.drop_rate = drop_rate        # доля запросов, на которые соединение рвется без ответа
+        self.max_keys = max_keys          # None - без ограничения
+        self.bytes_per_poll = bytes_per_poll  # средний прирост трафика ключа между опросами метрик
+        self.rng = random.Random(seed)
+
+        self.keys: Dict[str, Dict] = {}
+        self.transferred: Dict[str, int] = {}
+        self._next_id = 0
+        self.created_at_ms = int(time.time() * 1000)
+
+        self.requests: Dict[str, int] = {}   # счетчики по маршрутам
+        self.errors = 0
+        self.drops = 0
+        self.port: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections = set()
+
+    # ===== МАРШРУТЫ =====
+
+    def server_info(self, body, *_):
+        return 200, {"name": "fake-outline", "serverId": "fake", "metricsEnabled": True,
+                     "createdTimestampMs": self.created_at_ms, "version": "1.7.0",
+                     "portForNewAccessKeys": 443, "hostnameForAccessKeys": "127.0.0.1"}
+
+    def list_keys(self, body, *_):
+        return 200, {"accessKeys": list(self.keys.values())}
+
+    def create_key(self, body, *_):
+        if self.max_keys is not None and len(self.keys) >= self.max_keys:
+            return 409, {"code": "KeyLimit", "message": f"Достигнут лимит {self.max_keys} ключей"}
+        key_id = str(self._next_id)
+        self._next_id += 1
+        password = "%032x" % self.rng.getrandbits(128)
+        key = {
+            "id": key_id,
+            "name": body.get("name", ""),
+            "password": password,
+            "port": 443,
+            "method": "chacha20-ietf-poly1305",
+            "accessUrl": f"ss://Y2hhY2hhMjA6{password}@127.0.0.1:443/?outline=1",
+        }
+        if "limit" in body:
+            key["dataLimit"] = body["limit"]
+        self.keys[key_id] = key
+        self.transferred[key_id] = 0
+        return 201, key
+
+    def get_key(self, body, key_id):
+        key = self.keys.get(key_id)
+        return (200, key) if key else (404, {"code": "NotFound"})
+
+    def update_key(self, body, key_id):
+        key = self.keys.get(key_id)
+        if key is None:
+            return 404, {"code": "NotFound"}
+        if "name" in body:
+            key["name"] = body["name"]
+        if "limit" in body:
+            key["dataLimit"] = body["limit"]
+        return 204, None
+
+    def delete_key(self, body, key_id):
+        if self.keys.pop(key_id, None) is None:
+            return 404, {"code": "NotFound"}
+        self.transferred.pop(key_id, None)
+        return 204, None
+
+    def rename_key(self, body, key_id):
+        if key_id not in self.keys:
+            return 404, {"code": "NotFound"}
+        self.keys[key_id]["name"] = body.get("name", "")
+        return 204, None
+
+    def set_limit(self, body, key_id):
+        if key_id not in self.keys:
+            return 404, {"code": "NotFound"}
+        self.keys[key_id]["dataLimit"] = body.get("limit", {})
+        return 204, None
+
+    def remove_limit(self, body, key_id):
+        if key_id not in self.keys:
+            return 404, {"code": "NotFound"}
+        self.keys[key_id].pop("dataLimit", None)
+        return 204, None
+
+    def transfer_metrics(self):
+        """Каждый опрос ключи "потребляют" случайный трафик, но не больше лимита"""
+        for key_id, key in self.keys.items():
+            used = self.transferred[key_id] + int(self.rng.expovariate(1 / self.bytes_per_poll))
+            limit = key.get("dataLimit", {}).get("bytes")
+            self.transferred[key_id] = min(used, limit) if limit is not None else used
+        return dict(self.transferred)
+
+    def transfer(self, body, *_):
+        return 200, {"bytesTransferredByUserId": self.transfer_metrics()}
+
+    # ===== HTTP =====
+
+    def route(self, method: str, path: str) -> Tuple[Optional[str], tuple]:
+        path = path.split("?", 1)[0]
+        for route_method, pattern, handler in self.ROUTES:
+            match = pattern.search(path)
+            if match and route_method == method:
+                return handler, match.groups()
+        return None, ()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                raw = await reader.readexactly(length) if length else b""
+
+                handler, args = self.route(method, path)
+                self.requests[handler or "unknown"] = self.requests.get(handler or "unknown", 0) + 1
+
+                await asyncio.sleep(self.latency(self.rng))
+
+                if self.rng.random() < self.drop_rate:
+                    self.drops += 1
+                    break
+                if self.rng.random() < self.error_rate:
+                    self.errors += 1
+                    status, body = 500, {"code": "InternalError"}
+                elif handler is None:
+                    status, body = 404, {"code": "NotFound"}
+                else:
+                    try:
+                        payload = json.loads(raw) if raw else {}
+                    except ValueError:
+                        payload = {}
+                    status, body = getattr(self, handler)(payload, *args)
+
+                data = json.dumps(body).encode() if body is not None else b""
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # keep-alive соединения клиентов сами не закроются
+            connections = list(self._connections)
+            for task in connections:
+                task.cancel()
+            await asyncio.gather(*connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def start_in_thread(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Запустить сервер в отдельном потоке со своим event loop -
+        чтобы синхронные клиенты, блокирующие loop бенчмарка, не блокировали и сервер.
+        """
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start(host, port))
+            started.set()
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        self._loop = loop
+        return self.port
+
+    def stop_thread(self):
+        loop = getattr(self, "_loop", None)
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self.stop(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join()
+            loop.close()
+            self._loop = None
+
+    def url(self, secret: str = "fake") -> str:
+        return f"http://127.0.0.1:{self.port}/{secret}"
+
+async def main():
+    parser = argparse.ArgumentParser(description="Локальный Outline API для тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:S | uniform:A,B | exp:MEAN | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--max-keys", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeOutlineServer(args.latency, args.error_rate, args.drop_rate, args.max_keys, args.seed)
+    port = await server.start(args.host, args.port)
+    print(f"🧪 Fake Outline API: http://{args.host}:{port}/<любой-секрет>")
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
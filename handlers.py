@@ -1,10 +1,20 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
+import counters
 import database
-from sqlalchemy.orm import Session
+import ledger
+import queries
 from sqlalchemy.exc import SQLAlchemyError
 import payments
-import outlines_api
+import outline_cluster
+import key_pool
+import traffic
+import reconcile
+import router
+import user_cache
+import render_cache
+import outbox
+import broadcast
 import config
 import keyboards
 import logging
@@ -12,29 +22,25 @@ from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+# Маршруты inline-кнопок: обработчик вызывается как handler(query, user_id, *аргументы)
+callbacks = router.CallbackRouter()
+
+ADMIN_PAGE_SIZE = 10  # строк на странице админских списков
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     user = update.effective_user
     
     # Регистрируем пользователя
-    db = database.SessionLocal()
-    try:
-        existing = db.query(database.User).filter_by(telegram_id=user.id).first()
-        if not existing:
-            new_user = database.User(
-                telegram_id=user.id,
-                username=user.username,
-                full_name=user.full_name,
-                balance=0.0
-            )
-            db.add(new_user)
-            db.commit()
-            logger.info(f"Новый пользователь: {user.id}")
-    except Exception as e:
-        logger.error(f"Ошибка регистрации: {e}")
-        db.rollback()
-    finally:
-        db.close()
+    async with database.async_session() as db:
+        try:
+            db_user = await queries.upsert_user(db, user.id, user.username, user.full_name)
+            user_cache.get_cache().put(db_user)
+            if db_user.chat_blocked:
+                await broadcast.unblock(db, user.id)
+        except Exception as e:
+            logger.error(f"Ошибка регистрации: {e}")
+            await db.rollback()
     
     await update.message.reply_text(
         text=f"Привет, {user.first_name}! 👋\n\n"
@@ -56,15 +62,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /balance"""
-    db = database.SessionLocal()
-    try:
-        user = db.query(database.User).filter_by(telegram_id=update.effective_user.id).first()
-        if user:
-            await update.message.reply_text(f"💰 Ваш баланс: {user.balance} руб.")
-        else:
-            await update.message.reply_text("❌ Пользователь не найден. Используйте /start")
-    finally:
-        db.close()
+    user = await user_cache.get_user_snapshot(update.effective_user.id)
+    if user:
+        await update.message.reply_text(f"💰 Ваш баланс: {user.balance} руб.")
+    else:
+        await update.message.reply_text("❌ Пользователь не найден. Используйте /start")
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin - только для администратора"""
@@ -95,70 +97,40 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"Кнопка: {callback_data} от {user_id}")
     
-    # РОУТИНГ ПО CALLBACK_DATA
-    if callback_data == "main_menu":
-        await show_main_menu(query)
-    
-    elif callback_data == "show_tariffs":
-        await show_tariffs(query)
-    
-    elif callback_data.startswith("tariff_"):
-        tariff_id = callback_data.replace("tariff_", "")
-        await handle_tariff_selection(query, user_id, tariff_id)
-    
-    elif callback_data.startswith("pay_"):
-        tariff_id = callback_data.replace("pay_", "")
-        await handle_payment(query, user_id, tariff_id)
-    
-    elif callback_data == "my_keys":
-        await show_user_keys(query, user_id)
-    
-    elif callback_data == "balance":
-        await show_balance(query, user_id)
-    
-    elif callback_data == "support":
-        await show_support(query)
-    
-    # АДМИН КНОПКИ
-    elif callback_data == "admin_stats":
-        await admin_stats(query, user_id)
-    
-    elif callback_data == "admin_users":
-        await admin_users(query, user_id)
-    
-    elif callback_data == "admin_keys":
-        await admin_keys(query, user_id)
-    
-    elif callback_data == "admin_payments":
-        await admin_payments(query, user_id)
-    
-    else:
-        await query.edit_message_text(
+    # РОУТИНГ ПО CALLBACK_DATA: таблица маршрутов (декораторы @callbacks ниже)
+    if not await callbacks.dispatch(callback_data, query, user_id):
+        await render_cache.edit(query,
             text="❌ Неизвестная команда",
             reply_markup=keyboards.main_menu()
         )
+
 # ========== ОСНОВНЫЕ ФУНКЦИИ ==========
 
-async def show_main_menu(query):
+@callbacks.exact("main_menu")
+async def show_main_menu(query, user_id):
     """Показать главное меню"""
-    await query.edit_message_text(
+    await render_cache.edit(query,
         text="Главное меню:",
         reply_markup=keyboards.main_menu()
     )
 
-async def show_tariffs(query):
+@callbacks.exact("show_tariffs")
+async def show_tariffs(query, user_id):
     """Показать тарифы"""
-    await query.edit_message_text(
+    snapshot = await user_cache.get_user_snapshot(user_id)
+    await render_cache.edit(query,
         text="Выберите тариф:",
-        reply_markup=keyboards.tariffs_keyboard()
+        reply_markup=keyboards.tariffs_keyboard(bool(snapshot and snapshot.trial_used))
     )
 
+@callbacks.packed(keyboards.TARIFF)
+@callbacks.prefix("tariff_", str)  # tariff_trial и кнопки в старых сообщениях
 async def handle_tariff_selection(query, user_id, tariff_id):
     """Обработка выбора тарифа"""
     tariff = config.Config.TARIFFS.get(tariff_id)
     
     if not tariff:
-        await query.edit_message_text(
+        await render_cache.edit(query,
             text="❌ Тариф не найден.",
             reply_markup=keyboards.tariffs_keyboard()
         )
@@ -169,7 +141,7 @@ async def handle_tariff_selection(query, user_id, tariff_id):
         await handle_trial_period(query, user_id)
     else:
         # Платный тариф
-        await query.edit_message_text(
+        await render_cache.edit(query,
             text=f"📋 Тариф: {tariff['name']}\n"
                  f"💰 Цена: {tariff['price']} руб.\n"
                  f"⏳ Срок: {tariff['days']} дней\n\n"
@@ -179,55 +151,71 @@ async def handle_tariff_selection(query, user_id, tariff_id):
 
 async def handle_trial_period(query, user_id):
     """Обработка пробного периода"""
-    db = database.SessionLocal()
+    # trial_used не сбрасывается, поэтому снимку из кэша можно верить без запроса к БД
+    snapshot = await user_cache.get_user_snapshot(user_id)
+    if snapshot and snapshot.trial_used:
+        await render_cache.edit(query,
+            text="❌ Пробный период уже использован.",
+            reply_markup=keyboards.main_menu()
+        )
+        return
+    
+    db = database.async_session()
+    new_key = pooled = server_id = None
+    saved = False
     try:
-        user = db.query(database.User).filter_by(telegram_id=user_id).first()
+        user = await queries.get_user(db, user_id)
         if not user:
-            await query.edit_message_text("❌ Пользователь не найден")
+            await render_cache.edit(query, "❌ Пользователь не найден")
             return
         
         if user.trial_used:
-            await query.edit_message_text(
+            await render_cache.edit(query,
                 text="❌ Пробный период уже использован.",
                 reply_markup=keyboards.main_menu()
             )
             return
         
-        # Создаем VPN ключ
-        api = outlines_api.OutlinesAPI()
+        # Берем готовый ключ из пула; если пул пуст - создаем на наименее загруженном сервере
         key_name = f"Пробный {user.telegram_id}"
-        new_key = api.create_key(key_name, limit_gb=5)
+        pooled = new_key = await key_pool.get_pool().claim(key_name, limit_gb=5)
+        if new_key:
+            server_id = new_key['server_id']
+        else:
+            server, new_key = await outline_cluster.get_cluster().create_key(key_name, limit_gb=5)
+            server_id = server.id if server else None
         
         if new_key:
-            # Сохраняем ключ в БД
+            # Сохраняем ключ в БД вместе с сервером, на котором он создан
             vpn_key = database.VPNKey(
                 user_id=user.id,
                 key_id=new_key.get('id'),
+                key=new_key.get('accessUrl', ''),
                 name=key_name,
-                access_url=new_key.get('accessUrl', ''),
-                server_id=config.Config.OUTLINES_SERVER_ID,
-                data_limit_gb=5
+                data_limit=5,
+                server_id=server_id
             )
             db.add(vpn_key)
             
             # Создаем подписку
             subscription = database.Subscription(
                 user_id=user.id,
-                tariff_id="trial",
+                tariff="trial",
+                price=0,
                 start_date=datetime.utcnow(),
                 end_date=datetime.utcnow() + timedelta(days=30),
-                is_active=True,
-                vpn_key_id=vpn_key.id
+                is_active=True
             )
             db.add(subscription)
             
             # Отмечаем пробный период как использованный
             user.trial_used = True
             
-            db.commit()
+            await db.commit()
+            saved = True
             
             # Отправляем ключ пользователю
-            await query.edit_message_text(
+            await render_cache.edit(query,
                 text=f"✅ Пробный период активирован на 30 дней!\n\n"
                      f"🔑 Ваш VPN ключ:\n"
                      f"`{new_key.get('accessUrl', '')}`\n\n"
@@ -237,80 +225,106 @@ async def handle_trial_period(query, user_id):
             )
             logger.info(f"Пробный период активирован для {user_id}")
         else:
-            await query.edit_message_text(
+            await render_cache.edit(query,
                 text="❌ Не удалось создать VPN ключ. Попробуйте позже.",
                 reply_markup=keyboards.main_menu()
             )
             
     except Exception as e:
         logger.error(f"Ошибка пробного периода: {e}")
-        await query.edit_message_text(
+        await db.rollback()
+        if new_key and not saved:
+            # Ключ не записан в БД - вернуть его в пул или удалить, чтобы не потерялся
+            try:
+                if pooled:
+                    await key_pool.get_pool().release(new_key)
+                else:
+                    await outline_cluster.get_cluster().delete_key(server_id, new_key['id'])
+            except Exception as release_error:
+                logger.error(f"Ключ {new_key.get('id')} пробного периода не освобожден: {release_error}")
+        await render_cache.edit(query,
             text="❌ Произошла ошибка. Попробуйте позже.",
             reply_markup=keyboards.main_menu()
         )
-        db.rollback()
     finally:
-        db.close()
+        await db.close()
 
+@callbacks.packed(keyboards.PAY)
+@callbacks.prefix("pay_", str)  # кнопки в старых сообщениях
 async def handle_payment(query, user_id, tariff_id):
     """Обработка оплаты"""
     tariff = config.Config.TARIFFS.get(tariff_id)
     
     if not tariff:
-        await query.edit_message_text("❌ Тариф не найден")
+        await render_cache.edit(query, "❌ Тариф не найден")
+        return
+    
+    if not await user_cache.get_user_snapshot(user_id):
+        await render_cache.edit(query, "❌ Пользователь не найден")
         return
     
-    db = database.SessionLocal()
+    db = database.async_session()
     try:
-        user = db.query(database.User).filter_by(telegram_id=user_id).first()
-        if not user:
-            await query.edit_message_text("❌ Пользователь не найден")
-            return
-        
         # Создаем платеж
-        description = f"Тариф: {tariff['name']} ({tariff['days']} дней)"
-        payment_result = payments.create_payment(
-            user_id=user.id,
-            amount=tariff['price'],
-            description=description,
-            tariff_id=tariff_id
-        )
+        payment_result = await payments.create_payment(db, user_id, tariff['price'], tariff_id)
         
         if payment_result:
-            await query.edit_message_text(
+            await render_cache.edit(query,
                 text=f"💳 Для оплаты перейдите по ссылке:\n\n"
-                     f"{payment_result['confirmation_url']}\n\n"
+                     f"{payment_result['payment_url']}\n\n"
                      f"После оплаты баланс пополнится автоматически.",
-                reply_markup=keyboards.main_menu()
+                reply_markup=keyboards.check_payment_keyboard(payment_result['payment_id'])
             )
         else:
-            await query.edit_message_text(
+            await render_cache.edit(query,
                 text="❌ Не удалось создать платеж. Попробуйте позже.",
                 reply_markup=keyboards.main_menu()
             )
             
     except Exception as e:
         logger.error(f"Ошибка создания платежа: {e}")
-        await query.edit_message_text(
+        await render_cache.edit(query,
             text="❌ Произошла ошибка при создании платежа.",
             reply_markup=keyboards.main_menu()
         )
     finally:
-        db.close()
+        await db.close()
 
-async def show_user_keys(query, user_id):
-    """Показать ключи пользователя"""
-    db = database.SessionLocal()
+@callbacks.packed(keyboards.CHECK_PAYMENT)
+async def handle_check_payment(query, user_id, payment_id):
+    """Проверка оплаты по кнопке под ссылкой на платеж"""
+    user = await user_cache.get_user_snapshot(user_id)
+    db = database.async_session()
     try:
-        user = db.query(database.User).filter_by(telegram_id=user_id).first()
-        if not user:
-            await query.edit_message_text("❌ Пользователь не найден")
+        payment = await queries.get_payment(db, payment_id)
+        if not user or not payment or payment.user_id != user.id:
+            await render_cache.edit(query, "❌ Платеж не найден", reply_markup=keyboards.main_menu())
             return
         
-        keys = db.query(database.VPNKey).filter_by(user_id=user.id).all()
+        status = await payments.check_payment_status(payment_id, db, user_id)
+        if status and status["paid"]:
+            text = "✅ Оплата получена, баланс пополнен."
+            markup = keyboards.main_menu()
+        else:
+            text = "⏳ Оплата пока не поступила. Проверьте еще раз через минуту."
+            markup = keyboards.check_payment_keyboard(payment_id)
+        await render_cache.edit(query, text=text, reply_markup=markup)
+    finally:
+        await db.close()
+
+@callbacks.exact("my_keys")
+async def show_user_keys(query, user_id):
+    """Показать ключи пользователя"""
+    user = await user_cache.get_user_snapshot(user_id)
+    if not user:
+        await render_cache.edit(query, "❌ Пользователь не найден")
+        return
+    
+    async with database.async_session() as db:
+        keys = await queries.user_keys(db, user.id)
         
         if not keys:
-            await query.edit_message_text(
+            await render_cache.edit(query,
                 text="У вас пока нет VPN ключей.",
                 reply_markup=keyboards.main_menu()
             )
@@ -319,39 +333,37 @@ async def show_user_keys(query, user_id):
         text = "🔑 Ваши VPN ключи:\n\n"
         for key in keys:
             text += f"• {key.name}\n"
-            if key.access_url:
-                text += f"  `{key.access_url[:50]}...`\n\n"
+            used = await traffic.key_usage(db, key.server_id, key.key_id)
+            limit = f" из {key.data_limit} ГБ" if key.data_limit else ""
+            text += f"  📶 Трафик за 30 дней: {traffic.format_bytes(used)}{limit}\n"
+            if key.key:
+                text += f"  `{key.key[:50]}...`\n\n"
         
-        await query.edit_message_text(
+        await render_cache.edit(query,
             text=text,
             parse_mode="Markdown",
             reply_markup=keyboards.main_menu()
         )
-        
-    finally:
-        db.close()
 
+@callbacks.exact("balance")
 async def show_balance(query, user_id):
     """Показать баланс"""
-    db = database.SessionLocal()
-    try:
-        user = db.query(database.User).filter_by(telegram_id=user_id).first()
-        if user:
-            await query.edit_message_text(
-                text=f"💰 Ваш баланс: {user.balance} руб.",
-                reply_markup=keyboards.main_menu()
-            )
-        else:
-            await query.edit_message_text(
-                text="❌ Пользователь не найден",
-                reply_markup=keyboards.main_menu()
-            )
-    finally:
-        db.close()
+    user = await user_cache.get_user_snapshot(user_id)
+    if user:
+        await render_cache.edit(query,
+            text=f"💰 Ваш баланс: {user.balance} руб.",
+            reply_markup=keyboards.main_menu()
+        )
+    else:
+        await render_cache.edit(query,
+            text="❌ Пользователь не найден",
+            reply_markup=keyboards.main_menu()
+        )
 
-async def show_support(query):
+@callbacks.exact("support")
+async def show_support(query, user_id):
     """Показать поддержку"""
-    await query.edit_message_text(
+    await render_cache.edit(query,
         text="📞 Поддержка:\n\n"
              "По всем вопросам обращайтесь к администратору.\n"
              "Мы всегда готовы помочь!",
@@ -359,106 +371,177 @@ async def show_support(query):
     )
 # ========== АДМИН ФУНКЦИИ ==========
 
+@callbacks.exact("admin_stats")
 async def admin_stats(query, user_id):
     """Статистика для администратора"""
     if user_id != config.Config.ADMIN_ID:
-        await query.edit_message_text("❌ Нет прав")
+        await render_cache.edit(query, "❌ Нет прав")
         return
     
-    db = database.SessionLocal()
-    try:
-        users_count = db.query(database.User).count()
-        payments_count = db.query(database.Payment).count()
-        keys_count = db.query(database.VPNKey).count()
-        active_subs = db.query(database.Subscription).filter_by(is_active=True).count()
-        
-        text = f"📊 Статистика:\n\n"
-        text += f"👥 Пользователей: {users_count}\n"
-        text += f"💳 Платежей: {payments_count}\n"
-        text += f"🔑 VPN ключей: {keys_count}\n"
-        text += f"✅ Активных подписок: {active_subs}\n"
-        
-        await query.edit_message_text(
-            text=text,
-            reply_markup=keyboards.admin_keyboard()
-        )
-        
-    finally:
-        db.close()
+    async with database.async_session() as db:
+        counts = await counters.snapshot(db)
+    pool = key_pool.get_pool()
+    free_keys = sum((await pool.free_counts()).values())
+    
+    text = f"📊 Статистика:\n\n"
+    text += f"👥 Пользователей: {counts['users']}\n"
+    text += f"💳 Платежей: {counts['payments']}\n"
+    text += f"🔑 VPN ключей: {counts['keys']}\n"
+    text += f"✅ Активных подписок: {counts['active_subscriptions']}\n"
+    text += f"💰 Сумма балансов: {ledger.format_rub(counts['balance_kopecks'])} руб.\n"
+    text += f"🗄 Пул ключей: свободно {free_keys}, "
+    text += f"пуст в {pool.empty_rate:.0%} запросов, ошибок донастройки {pool.finalize_errors}\n"
+    cache = user_cache.get_cache()
+    text += f"🧠 Кэш пользователей: попаданий {cache.hit_rate:.0%}, "
+    text += f"сэкономлено запросов {cache.hits}, вытеснено {cache.evictions}\n"
+    menus = keyboards.get_catalog().metrics()
+    text += f"⌨️ Клавиатуры: готовых {menus['variants']}, выдано из каталога {menus['hits']}, "
+    text += f"собрано {menus['builds']}\n"
+    text += "\n".join(render_cache.get_cache().report_lines()) + "\n"
+    text += "\n".join(outbox.get_outbox().report_lines()) + "\n\n"
+    text += "📡 Серверы Outline:\n" + "\n".join(outline_cluster.get_monitor().report()) + "\n"
+    reconcile_lines = reconcile.get_reconciler().report_lines()
+    if reconcile_lines:
+        text += "\n🧮 Сверка ключей:\n" + "\n".join(reconcile_lines) + "\n"
+    counter_lines = counters.get_audit().report_lines()
+    if counter_lines:
+        text += "\n" + "\n".join(counter_lines) + "\n"
+    route_lines = callbacks.report()
+    if route_lines:
+        text += "\n🧭 Кнопки (самые медленные):\n" + "\n".join(route_lines) + "\n"
+    
+    await render_cache.edit(query,
+        text=text,
+        reply_markup=keyboards.admin_keyboard()
+    )
 
-async def admin_users(query, user_id):
-    """Список пользователей для администратора"""
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast <текст> - рассылка всем пользователям (только админ)"""
+    user_id = update.effective_user.id
     if user_id != config.Config.ADMIN_ID:
-        await query.edit_message_text("❌ Нет прав")
+        await update.message.reply_text("❌ У вас нет прав администратора.")
         return
     
-    db = database.SessionLocal()
-    try:
-        users = db.query(database.User).order_by(database.User.created_at.desc()).limit(10).all()
-        
-        text = "👥 Последние 10 пользователей:\n\n"
-        for user in users:
-            text += f"• ID: {user.telegram_id}\n"
-            text += f"  Имя: {user.full_name or 'N/A'}\n"
-            text += f"  Баланс: {user.balance} руб.\n"
-            text += f"  Регистрация: {user.created_at.strftime('%Y-%m-%d')}\n\n"
-        
-        await query.edit_message_text(
-            text=text,
-            reply_markup=keyboards.admin_keyboard()
-        )
-        
-    finally:
-        db.close()
+    # Текст после команды целиком, с переносами строк
+    text = update.message.text.partition(" ")[2].strip()
+    if not text:
+        await update.message.reply_text("Использование: /broadcast <текст сообщения>")
+        return
+    
+    broadcast_id = await broadcast.get_runner().start(context.bot, text, created_by=user_id)
+    await update.message.reply_text(
+        text=f"📣 Рассылка #{broadcast_id} запущена. Ход - в разделе «Рассылки».",
+        reply_markup=keyboards.broadcasts_keyboard([broadcast_id])
+    )
 
-async def admin_keys(query, user_id):
-    """Список ключей для администратора"""
+@callbacks.exact("admin_broadcasts")
+async def admin_broadcasts(query, user_id):
+    """Последние рассылки и скорость идущих"""
     if user_id != config.Config.ADMIN_ID:
-        await query.edit_message_text("❌ Нет прав")
+        await render_cache.edit(query, "❌ Нет прав")
         return
     
-    db = database.SessionLocal()
-    try:
-        keys = db.query(database.VPNKey).order_by(database.VPNKey.created_at.desc()).limit(10).all()
-        
-        text = "🔑 Последние 10 VPN ключей:\n\n"
-        for key in keys:
-            text += f"• {key.name}\n"
-            text += f"  Пользователь ID: {key.user_id}\n"
-            text += f"  Создан: {key.created_at.strftime('%Y-%m-%d')}\n\n"
-        
-        await query.edit_message_text(
-            text=text,
-            reply_markup=keyboards.admin_keyboard()
-        )
-        
-    finally:
-        db.close()
+    runner = broadcast.get_runner()
+    lines = await runner.report_lines()
+    text = "📣 Рассылки:\n\n" + ("\n".join(lines) if lines else "Рассылок еще не было.\n/broadcast <текст> - начать")
+    text += "\n\n" + "\n".join(outbox.get_outbox().report_lines())
+    await render_cache.edit(query,
+        text=text,
+        reply_markup=keyboards.broadcasts_keyboard(runner.running_ids())
+    )
 
-async def admin_payments(query, user_id):
-    """Список платежей для администратора"""
+@callbacks.packed(keyboards.BROADCAST_CANCEL)
+async def cancel_broadcast(query, user_id, broadcast_id):
     if user_id != config.Config.ADMIN_ID:
-        await query.edit_message_text("❌ Нет прав")
+        await render_cache.edit(query, "❌ Нет прав")
         return
     
-    db = database.SessionLocal()
-    try:
-        payments_list = db.query(database.Payment).order_by(database.Payment.created_at.desc()).limit(10).all()
-        
-        text = "💳 Последние 10 платежей:\n\n"
-        for payment in payments_list:
-            status_emoji = "✅" if payment.status == "completed" else "⏳" if payment.status == "pending" else "❌"
-            text += f"{status_emoji} {payment.amount} руб.\n"
-            text += f"  Статус: {payment.status}\n"
-            text += f"  Дата: {payment.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-        
-        await query.edit_message_text(
-            text=text,
-            reply_markup=keyboards.admin_keyboard()
-        )
-        
-    finally:
-        db.close()
+    cancelled = await broadcast.get_runner().cancel(broadcast_id)
+    await render_cache.edit(query,
+        text=f"⛔ Рассылка #{broadcast_id} остановлена." if cancelled else f"Рассылка #{broadcast_id} уже завершена.",
+        reply_markup=keyboards.broadcasts_keyboard([])
+    )
+
+@callbacks.exact("admin_users")
+@callbacks.packed(keyboards.ADMIN_USERS)
+async def admin_users(query, user_id, older=True, cursor=None):
+    """Пользователи для администратора, постранично (новые сверху)"""
+    if user_id != config.Config.ADMIN_ID:
+        await render_cache.edit(query, "❌ Нет прав")
+        return
+    
+    async with database.async_session() as db:
+        page = await queries.page(db, database.User, cursor, older, ADMIN_PAGE_SIZE)
+    
+    text = "👥 Пользователи:\n\n"
+    for user in page.items:
+        text += f"• ID: {user.telegram_id}\n"
+        text += f"  Имя: {user.full_name or 'N/A'}\n"
+        text += f"  Баланс: {user.balance} руб.\n"
+        text += f"  Регистрация: {user.created_at.strftime('%Y-%m-%d')}\n\n"
+    if not page.items:
+        text += "Пусто\n"
+    
+    await render_cache.edit(query,
+        text=text,
+        reply_markup=keyboards.admin_keyboard(keyboards.page_buttons(keyboards.ADMIN_USERS, page))
+    )
+
+@callbacks.exact("admin_keys")
+@callbacks.packed(keyboards.ADMIN_KEYS)
+async def admin_keys(query, user_id, older=True, cursor=None):
+    """VPN ключи для администратора, постранично (новые сверху)"""
+    if user_id != config.Config.ADMIN_ID:
+        await render_cache.edit(query, "❌ Нет прав")
+        return
+    
+    async with database.async_session() as db:
+        page = await queries.page(db, database.VPNKey, cursor, older, ADMIN_PAGE_SIZE)
+        # Топ по трафику - только на первой странице
+        top = await traffic.top_consumers(db, days=1, limit=5) if cursor is None else []
+    
+    text = "🔑 VPN ключи:\n\n"
+    for key in page.items:
+        text += f"• {key.name}\n"
+        text += f"  Пользователь ID: {key.user_id}\n"
+        text += f"  Создан: {key.created_at.strftime('%Y-%m-%d')}\n\n"
+    if not page.items:
+        text += "Пусто\n"
+    
+    if top:
+        text += "📶 Топ по трафику за сутки:\n"
+        for server_id, key_id, used in top:
+            text += f"• {server_id}/{key_id}: {traffic.format_bytes(used)}\n"
+    
+    await render_cache.edit(query,
+        text=text,
+        reply_markup=keyboards.admin_keyboard(keyboards.page_buttons(keyboards.ADMIN_KEYS, page))
+    )
+
+@callbacks.exact("admin_payments")
+@callbacks.packed(keyboards.ADMIN_PAYMENTS)
+async def admin_payments(query, user_id, older=True, cursor=None):
+    """Платежи для администратора, постранично (новые сверху)"""
+    if user_id != config.Config.ADMIN_ID:
+        await render_cache.edit(query, "❌ Нет прав")
+        return
+    
+    async with database.async_session() as db:
+        page = await queries.page(db, database.Payment, cursor, older, ADMIN_PAGE_SIZE)
+    
+    text = "💳 Платежи:\n\n"
+    for payment in page.items:
+        status_emoji = "✅" if payment.status == "completed" else "⏳" if payment.status == "pending" else "❌"
+        text += f"{status_emoji} {payment.amount} руб.\n"
+        text += f"  Статус: {payment.status}\n"
+        text += f"  Дата: {payment.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+    if not page.items:
+        text += "Пусто\n"
+    
+    await render_cache.edit(query,
+        text=text,
+        reply_markup=keyboards.admin_keyboard(keyboards.page_buttons(keyboards.ADMIN_PAYMENTS, page))
+    )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
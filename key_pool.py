@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import delete, func, select, update
+
+import config
+import database
+from outline_cluster import OutlineCluster, get_cluster
+from outline_batch import OutlineBatch
+from rate_limit import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз пробовать забрать ключ, если его перехватил параллельный запрос
+CLAIM_ATTEMPTS = 5
+# Сколько раз подряд пробовать переименовать выданный ключ и выставить лимит
+FINALIZE_ATTEMPTS = 3
+
+class KeyPool:
+    """
+    Пул заранее созданных ключей Outline.
+    Фоновое пополнение держит на каждом сервере от low_water до high_water
+    свободных ключей; покупка и пробный период просто забирают готовый ключ.
+    Ключи пула создаются с осторожным лимитом key_limit_gb: имя и лимит
+    покупателя выставляются после выдачи, и если Outline их не принял,
+    ключ не остается безлимитным. Неудачная донастройка повторяется
+    с паузами, а затем - при каждом пополнении, пока не пройдет.
+    """
+
+    def __init__(self, cluster: OutlineCluster = None, session_factory=None,
+                 low_water: int = None, high_water: int = None, key_limit_gb: int = None):
+        self._cluster = cluster
+        self._batch = OutlineBatch(cluster) if cluster is not None else None
+        self.session_factory = session_factory or database.async_session  # AsyncSession
+        self.low_water = low_water if low_water is not None else config.Config.KEY_POOL_LOW_WATER
+        self.high_water = high_water if high_water is not None else config.Config.KEY_POOL_HIGH_WATER
+        self.key_limit_gb = key_limit_gb if key_limit_gb is not None else config.Config.KEY_POOL_KEY_LIMIT_GB
+        self._refill_lock = asyncio.Lock()
+        self._background = set()
+        self._finalizing: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._unfinished: Dict[Tuple[str, str], Tuple[str, Optional[int]]] = {}  # (сервер, ключ) -> (имя, лимит)
+        self._task: Optional[asyncio.Task] = None
+
+        # Метрики
+        self.claims = 0         # выдано ключей из пула
+        self.misses = 0         # пул оказался пуст
+        self.refills = 0        # запусков пополнения, создавших ключи
+        self.created = 0        # создано ключей для пула
+        self.create_errors = 0
+        self.finalize_errors = 0    # неудачных попыток донастроить выданный ключ
+        self.released = 0           # ключей возвращено в пул (покупка не состоялась)
+
+    @property
+    def cluster(self) -> OutlineCluster:
+        return self._cluster or get_cluster()
+
+    @property
+    def batch(self) -> OutlineBatch:
+        if self._batch is None:
+            self._batch = OutlineBatch(self.cluster)
+        return self._batch
+
+    @property
+    def empty_rate(self) -> float:
+        """Доля запросов, для которых пул оказался пуст"""
+        total = self.claims + self.misses
+        return self.misses / total if total else 0.0
+
+    async def free_counts(self) -> Dict[str, int]:
+        """Свободные ключи по серверам"""
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(database.PooledKey.server_id, func.count(database.PooledKey.id)).where(
+                    database.PooledKey.claimed_at.is_(None)
+                ).group_by(database.PooledKey.server_id)
+            )
+            return {server_id: count for server_id, count in result}
+
+    async def claim(self, name: str, limit_gb: int = None) -> Optional[Dict]:
+        """
+        Забрать свободный ключ из пула без обращения к Outline.
+        Имя и лимит (limit_gb=None - без лимита) выставляются в фоне.
+        Returns: {'id', 'accessUrl', 'name', 'server_id'} или None, если пул пуст
+        """
+        preferred = self.cluster.pick_server()
+        async with self.session_factory() as db:
+            for _ in range(CLAIM_ATTEMPTS):
+                free = select(database.PooledKey.id).where(database.PooledKey.claimed_at.is_(None)).order_by(database.PooledKey.id).limit(1)
+                candidate = None
+                if preferred is not None:
+                    candidate = (await db.execute(free.where(database.PooledKey.server_id == preferred.id))).scalar()
+                if candidate is None:
+                    candidate = (await db.execute(free)).scalar()
+                if candidate is None:
+                    break
+
+                # Условный UPDATE: ключ достанется только одному из параллельных запросов
+                claimed = await db.execute(
+                    update(database.PooledKey).where(
+                        database.PooledKey.id == candidate,
+                        database.PooledKey.claimed_at.is_(None)
+                    ).values(claimed_at=datetime.utcnow(), claimed_name=name)
+                )
+                await db.commit()
+
+                if claimed.rowcount:
+                    row = await db.get(database.PooledKey, candidate)
+                    self.claims += 1
+                    target = (row.server_id, row.key_id)
+                    task = self._spawn(self._finalize(row.server_id, row.key_id, name, limit_gb))
+                    self._finalizing[target] = task
+                    task.add_done_callback(lambda t, target=target: self._finalizing.pop(target, None)
+                                           if self._finalizing.get(target) is t else None)
+                    self._maybe_refill()
+                    return {'id': row.key_id, 'accessUrl': row.access_url, 'name': name, 'server_id': row.server_id}
+
+        self.misses += 1
+        logger.warning(f"Пул ключей пуст (промахов: {self.misses})")
+        self._maybe_refill()
+        return None
+
+    async def release(self, key: Dict) -> bool:
+        """
+        Вернуть выданный claim ключ в пул (покупка не состоялась): вернуть
+        имя пула и лимит по умолчанию. Если Outline этого не принял, ключ
+        удаляется - без настройки он не должен уйти следующему покупателю.
+        """
+        target = (key['server_id'], key['id'])
+        task = self._finalizing.pop(target, None)
+        if task is not None:
+            task.cancel()
+        self._unfinished.pop(target, None)
+
+        ok = await self._configure(key['server_id'], key['id'], f"pool-{uuid.uuid4().hex[:8]}", self.key_limit_gb)
+        async with self.session_factory() as db:
+            row = database.PooledKey
+            where = (row.server_id == key['server_id'], row.key_id == key['id'])
+            if ok:
+                await db.execute(update(row).where(*where).values(claimed_at=None, claimed_name=None))
+            else:
+                await db.execute(delete(row).where(*where))
+            await db.commit()
+        if ok:
+            self.released += 1
+            logger.info(f"Ключ {key['id']} сервера {key['server_id']} возвращен в пул")
+        else:
+            server = self.cluster.servers.get(key['server_id'])
+            if server is None or not await server.delete_key(key['id']):
+                logger.error(f"Ключ {key['id']} сервера {key['server_id']} не удалось ни вернуть в пул, ни удалить")
+        return ok
+
+    async def _finalize(self, server_id: str, key_id: str, name: str, limit_gb: Optional[int]):
+        """Переименовать выданный ключ и выставить лимит - вне пути покупки"""
+        if not await self._configure(server_id, key_id, name, limit_gb):
+            # Ключ остается с лимитом пула; повторим при следующем пополнении
+            self._unfinished[(server_id, key_id)] = (name, limit_gb)
+            logger.error(f"Ключ {key_id} сервера {server_id} не донастроен ({name}), повтор при пополнении пула")
+
+    async def _configure(self, server_id: str, key_id: str, name: str, limit_gb: Optional[int]) -> bool:
+        """Имя и лимит ключа с повторами; True - Outline принял оба"""
+        # cluster.get() бросает KeyError: сервер могли убрать из конфигурации
+        server = self.cluster.servers.get(server_id)
+        if server is None:
+            logger.error(f"Сервер {server_id} ключа {key_id} не найден в кластере")
+            return False
+        renamed = limited = False
+        for attempt in range(FINALIZE_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt - 1, 1.0, 10.0))
+            renamed = renamed or await server.api.rename_key(key_id, name)
+            if not limited:
+                if limit_gb is None:
+                    limited = await server.api.remove_key_limit(key_id)
+                else:
+                    limited = await server.api.update_key_limit(key_id, limit_gb)
+            if renamed and limited:
+                return True
+            self.finalize_errors += 1
+            logger.warning(f"Ключ {key_id} сервера {server_id}: имя {'ок' if renamed else 'не принято'}, "
+                           f"лимит {'ок' if limited else 'не принят'} (попытка {attempt + 1})")
+        return False
+
+    async def _retry_unfinished(self):
+        for (server_id, key_id), (name, limit_gb) in list(self._unfinished.items()):
+            if server_id not in self.cluster.servers:
+                # Сервер убран из конфигурации - донастраивать негде
+                self._unfinished.pop((server_id, key_id), None)
+                logger.error(f"Ключ {key_id}: сервер {server_id} удален из кластера, донастройка отменена")
+                continue
+            if await self._configure(server_id, key_id, name, limit_gb):
+                self._unfinished.pop((server_id, key_id), None)
+                logger.info(f"Ключ {key_id} сервера {server_id} донастроен")
+
+    async def refill(self):
+        """Пополнить пул на серверах, где свободных ключей меньше low_water"""
+        async with self._refill_lock:
+            if self._unfinished:
+                await self._retry_unfinished()
+            counts = await self.free_counts()
+            jobs = []
+            for server in self.cluster.servers.values():
+                free = counts.get(server.id, 0)
+                if server.healthy and free < self.low_water:
+                    jobs.append(self._fill_server(server, self.high_water - free))
+            if jobs:
+                await asyncio.gather(*jobs)
+                self.refills += 1
+
+    async def _fill_server(self, server, amount: int):
+        if server.max_keys is not None:
+            amount = min(amount, server.max_keys - server.key_count)
+        names = [f"pool-{uuid.uuid4().hex[:8]}" for _ in range(amount)]
+        # Лимит покупателя выставляется при выдаче, до того - осторожный лимит пула
+        results = await self.batch.create_keys(names, limit_gb=self.key_limit_gb, server_id=server.id)
+
+        created = []
+        for result in results:
+            if not result.ok:
+                self.create_errors += 1
+                continue
+            _, key_data = result.result
+            created.append(database.PooledKey(
+                server_id=server.id,
+                key_id=key_data['id'],
+                access_url=key_data.get('accessUrl', '')
+            ))
+
+        if created:
+            async with self.session_factory() as db:
+                db.add_all(created)
+                await db.commit()
+            self.created += len(created)
+            logger.info(f"Пул ключей сервера {server.id}: добавлено {len(created)}")
+
+    def _maybe_refill(self):
+        if not self._refill_lock.locked():
+            self._spawn(self.refill())
+
+    def _spawn(self, coro) -> asyncio.Task:
+        """Фоновая задача со ссылкой, чтобы ее не собрал GC"""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def start(self) -> asyncio.Task:
+        """Запустить периодическое пополнение (нужен работающий event loop)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Ошибка пополнения пула ключей: {e}")
+            await asyncio.sleep(config.Config.KEY_POOL_REFILL)
+
+    async def metrics(self) -> Dict:
+        return {
+            "free": await self.free_counts(),
+            "claims": self.claims,
+            "misses": self.misses,
+            "empty_rate": self.empty_rate,
+            "refills": self.refills,
+            "created": self.created,
+            "create_errors": self.create_errors,
+            "finalize_errors": self.finalize_errors,
+            "unfinished": len(self._unfinished),
+            "released": self.released,
+        }
+
+_pool: Optional[KeyPool] = None
+
+def get_pool() -> KeyPool:
+    """Общий пул ключей (создается при первом обращении)"""
+    global _pool
+    if _pool is None:
+        _pool = KeyPool()
+    return _pool
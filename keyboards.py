@@ -1,7 +1,91 @@
+import copy
+import logging
+from typing import Callable, Dict, Optional
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import config
+from callback_codec import BOOL, IDENT, STR, UINT, Spec
+
+logger = logging.getLogger(__name__)
+
+# Упакованные кнопки (callback_codec): id маршрутов постоянные, занятые не переиспользовать
+TARIFF = Spec(1, "tariff", STR)
+PAY = Spec(2, "pay", STR)
+ADMIN_USERS = Spec(3, "admin_users", BOOL, UINT)        # к старым записям?, курсор (id)
+ADMIN_KEYS = Spec(4, "admin_keys", BOOL, UINT)
+ADMIN_PAYMENTS = Spec(5, "admin_payments", BOOL, UINT)
+CHECK_PAYMENT = Spec(6, "check_payment", IDENT)          # id платежа
+BROADCAST_CANCEL = Spec(7, "broadcast_cancel", UINT)     # id рассылки
+
+# ===== КАТАЛОГ КЛАВИАТУР =====
+# Постоянные меню отправляются тысячи раз в час в одних и тех же вариантах.
+# Разметка PTB неизменяема после создания, поэтому каждый вариант строится
+# один раз и отдается всем: без новых списков кнопок и объектов на апдейт.
+
+LOCALES = ("ru",)        # языки текстов кнопок
+DEFAULT_LOCALE = "ru"
+
+class KeyboardCatalog:
+    """
+    Готовые InlineKeyboardMarkup по ключу (имя, is_admin, trial_used, locale).
+    Сборщик вызывается как builder(is_admin, trial_used, locale). Варианты
+    сбрасываются, когда меняется config.Config.TARIFFS (в нем названия и цены
+    кнопок), - сравнение маленького словаря дешевле сборки разметки.
+    """
+
+    def __init__(self, builders: Dict[str, Callable]):
+        self.builders = builders
+        self._variants: Dict[tuple, InlineKeyboardMarkup] = {}
+        self._tariffs: Optional[dict] = None  # копия TARIFFS, по которой собраны варианты
+
+        # Метрики
+        self.hits = 0
+        self.builds = 0
+        self.invalidations = 0
+
+    def get(self, name: str, is_admin: bool = False, trial_used: bool = False,
+            locale: str = None) -> InlineKeyboardMarkup:
+        self._check_tariffs()
+        if locale not in LOCALES:
+            locale = DEFAULT_LOCALE  # неизвестный язык не плодит варианты
+        key = (name, bool(is_admin), bool(trial_used), locale)
+        markup = self._variants.get(key)
+        if markup is None:
+            markup = self._variants[key] = self.builders[name](key[1], key[2], locale)
+            self.builds += 1
+        else:
+            self.hits += 1
+        return markup
 
-def main_menu(is_admin=False):
+    def warm(self):
+        """Собрать все варианты заранее (при старте бота)"""
+        for name in self.builders:
+            for is_admin in (False, True):
+                for trial_used in (False, True):
+                    for locale in LOCALES:
+                        self.get(name, is_admin, trial_used, locale)
+        logger.info(f"⌨️ Каталог клавиатур: {len(self._variants)} вариантов")
+
+    def _check_tariffs(self):
+        if self._tariffs == config.Config.TARIFFS:
+            return
+        if self._tariffs is not None:
+            self.invalidations += 1
+            logger.info("⌨️ Тарифы изменились - клавиатуры будут пересобраны")
+        self._variants.clear()
+        self._tariffs = copy.deepcopy(config.Config.TARIFFS)
+
+    def metrics(self) -> Dict:
+        return {
+            "variants": len(self._variants),
+            "hits": self.hits,
+            "builds": self.builds,
+            "invalidations": self.invalidations,
+        }
+
+# ===== СБОРЩИКИ =====
+
+def _build_main_menu(is_admin, trial_used, locale):
     keyboard = [
         [InlineKeyboardButton("🆓 Пробный тариф", callback_data="tariff_trial")],
         [InlineKeyboardButton("💰 Пополнить баланс", callback_data="balance_deposit")],
@@ -16,31 +100,32 @@ def main_menu(is_admin=False):
     
     return InlineKeyboardMarkup(keyboard)
 
-def tariffs_keyboard(user_trial_used=False):
+def _build_tariffs(is_admin, trial_used, locale):
     keyboard = []
+    tariffs = config.Config.TARIFFS
     
-    if not user_trial_used:
-        trial_tariff = config.Config.TARIFFS["trial"]
+    if not trial_used and "trial" in tariffs:
         keyboard.append([
             InlineKeyboardButton(
-                f"🆓 {trial_tariff['name']} - БЕСПЛАТНО", 
+                f"🆓 {tariffs['trial']['name']} - БЕСПЛАТНО", 
                 callback_data="tariff_trial"
             )
         ])
     
-    for tariff_id in ["1day", "1month", "3months", "6months"]:
-        tariff = config.Config.TARIFFS[tariff_id]
+    for tariff_id, tariff in tariffs.items():
+        if tariff_id == "trial":
+            continue
         keyboard.append([
             InlineKeyboardButton(
                 f"{tariff['name']} - {tariff['price']}₽", 
-                callback_data=f"tariff_{tariff_id}"
+                callback_data=TARIFF.pack(tariff_id)
             )
         ])
     
     keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
     return InlineKeyboardMarkup(keyboard)
 
-def deposit_amounts_keyboard():
+def _build_deposit_amounts(is_admin, trial_used, locale):
     amounts = [50, 100, 200, 500, 1000]
     keyboard = []
     
@@ -57,5 +142,85 @@ def deposit_amounts_keyboard():
     
     return InlineKeyboardMarkup(keyboard)
 
-def back_to_main():
+def _build_back_to_main(is_admin, trial_used, locale):
     return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Главное меню", callback_data="main_menu")]])
+
+def _build_admin(is_admin, trial_used, locale, nav=None):
+    keyboard = [nav] if nav else []  # ряд листания списка
+    keyboard += [
+        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users"),
+         InlineKeyboardButton("🔑 Ключи", callback_data="admin_keys")],
+        [InlineKeyboardButton("💳 Платежи", callback_data="admin_payments"),
+         InlineKeyboardButton("📣 Рассылки", callback_data="admin_broadcasts")],
+        [InlineKeyboardButton("◀️ Главное меню", callback_data="main_menu")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+_catalog: Optional[KeyboardCatalog] = None
+
+def get_catalog() -> KeyboardCatalog:
+    """Общий каталог клавиатур бота (создается при первом обращении)"""
+    global _catalog
+    if _catalog is None:
+        _catalog = KeyboardCatalog({
+            "main_menu": _build_main_menu,
+            "tariffs": _build_tariffs,
+            "deposit_amounts": _build_deposit_amounts,
+            "back_to_main": _build_back_to_main,
+            "admin": _build_admin,
+        })
+    return _catalog
+
+# ===== КЛАВИАТУРЫ =====
+
+def main_menu(is_admin=False, locale=None):
+    return get_catalog().get("main_menu", is_admin, locale=locale)
+
+def tariffs_keyboard(user_trial_used=False, locale=None):
+    return get_catalog().get("tariffs", trial_used=user_trial_used, locale=locale)
+
+def deposit_amounts_keyboard(locale=None):
+    return get_catalog().get("deposit_amounts", locale=locale)
+
+def back_to_main(locale=None):
+    return get_catalog().get("back_to_main", locale=locale)
+
+def payment_keyboard(tariff_id):
+    keyboard = [
+        [InlineKeyboardButton("💳 Оплатить", callback_data=PAY.pack(tariff_id))],
+        [InlineKeyboardButton("◀️ Назад", callback_data="show_tariffs")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def admin_keyboard(nav=None):
+    """Админ-меню; nav - ряд кнопок листания списка (см. page_buttons), с ним разметка собирается заново"""
+    if nav:
+        return _build_admin(True, False, DEFAULT_LOCALE, nav)
+    return get_catalog().get("admin", is_admin=True)
+
+def page_buttons(spec, page):
+    """Кнопки листания keyset-страницы: направление и курсор (id крайней строки) в callback_data"""
+    nav = []
+    if page.newer is not None:
+        nav.append(InlineKeyboardButton("◀️ Новее", callback_data=spec.pack(False, page.newer)))
+    if page.older is not None:
+        nav.append(InlineKeyboardButton("Старее ▶️", callback_data=spec.pack(True, page.older)))
+    return nav
+
+def broadcasts_keyboard(running_ids):
+    """Экран рассылок: отмена идущих, обновление статистики"""
+    keyboard = [[InlineKeyboardButton(f"⛔ Остановить #{broadcast_id}", callback_data=BROADCAST_CANCEL.pack(broadcast_id))]
+                for broadcast_id in running_ids]
+    keyboard += [
+        [InlineKeyboardButton("🔄 Обновить", callback_data="admin_broadcasts")],
+        [InlineKeyboardButton("◀️ Админ-панель", callback_data="admin_stats")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def check_payment_keyboard(payment_id):
+    keyboard = [
+        [InlineKeyboardButton("🔄 Проверить оплату", callback_data=CHECK_PAYMENT.pack(payment_id))],
+        [InlineKeyboardButton("◀️ Главное меню", callback_data="main_menu")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
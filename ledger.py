@@ -0,0 +1,113 @@
+import logging
+import uuid
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+import counters
+import database
+import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Баланс хранится в копейках (users.balance_kopecks) и меняется только здесь:
+# одним условным UPDATE и записью в balance_ledger в той же транзакции.
+# Блокировки в приложении не нужны - списание при нехватке средств просто
+# не находит строку. Коммит делает вызывающий код вместе с остальной покупкой.
+
+users = database.User.__table__
+ledger = database.LedgerEntry.__table__
+
+def to_kopecks(rubles) -> int:
+    return int((Decimal(str(rubles)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def format_rub(kopecks: int) -> str:
+    """12345 -> '123.45'"""
+    return f"{Decimal(kopecks) / 100:.2f}"
+
+def operation_id(prefix: str) -> str:
+    """Ключ идемпотентности операции без внешнего id (покупка, ручное пополнение)"""
+    return f"{prefix}:{uuid.uuid4().hex[:16]}"
+
+def _change_balance(user_id: int, delta: int):
+    """UPDATE users ... WHERE id = ? [AND balance_kopecks >= -delta]"""
+    stmt = update(users).where(users.c.id == user_id)
+    if delta < 0:
+        stmt = stmt.where(users.c.balance_kopecks >= -delta)
+    return stmt.values(
+        balance_kopecks=users.c.balance_kopecks + delta,
+        balance=(users.c.balance_kopecks + delta) / 100.0,
+    )
+
+def _entry(user_id: int, delta: int, balance: int, reason: str, reference: Optional[str]):
+    return ledger.insert().values(
+        user_id=user_id, amount_kopecks=delta, balance_after=balance,
+        reason=reason, reference=reference, created_at=datetime.utcnow()
+    )
+
+def _read_back(user_id: int):
+    return select(users.c.balance_kopecks, users.c.telegram_id).where(users.c.id == user_id)
+
+def _after_change(session: Session, user_id: int, telegram_id: int, delta: int, balance: int):
+    """Загруженные в сессию объекты пользователя получают новый баланс без лишнего SELECT"""
+    for obj in list(session.identity_map.values()):
+        if getattr(obj, "__tablename__", None) == "users" and obj.id == user_id:
+            set_committed_value(obj, "balance", balance / 100)
+            if hasattr(type(obj), "balance_kopecks"):
+                set_committed_value(obj, "balance_kopecks", balance)
+    user_cache.mark_changed(session, telegram_id)
+    counters.add(session, counters.BALANCE, delta)
+
+# ===== AsyncSession =====
+
+async def change(db: AsyncSession, user_id: int, delta: int, reason: str,
+                 reference: str = None) -> Optional[int]:
+    """Изменить баланс на delta копеек; вернуть новый баланс или None (нет средств/пользователя)"""
+    stmt = _change_balance(user_id, delta)
+    if db.get_bind().dialect.update_returning:
+        row = (await db.execute(stmt.returning(users.c.balance_kopecks, users.c.telegram_id))).first()
+    else:
+        result = await db.execute(stmt)
+        row = (await db.execute(_read_back(user_id))).first() if result.rowcount else None
+    if row is None:
+        return None
+
+    balance, telegram_id = row
+    await db.execute(_entry(user_id, delta, balance, reason, reference))
+    _after_change(db.sync_session, user_id, telegram_id, delta, balance)
+    logger.info(f"💰 Баланс пользователя {telegram_id}: {delta:+d} коп. ({reason}), итого {balance}")
+    return balance
+
+async def credit(db: AsyncSession, user_id: int, kopecks: int, reason: str, reference: str = None) -> Optional[int]:
+    return await change(db, user_id, kopecks, reason, reference)
+
+async def debit(db: AsyncSession, user_id: int, kopecks: int, reason: str, reference: str = None) -> Optional[int]:
+    return await change(db, user_id, -kopecks, reason, reference)
+
+# ===== Синхронная Session (vpn_bot_* скрипты) =====
+
+def change_sync(db: Session, user_id: int, delta: int, reason: str, reference: str = None) -> Optional[int]:
+    stmt = _change_balance(user_id, delta)
+    if db.get_bind().dialect.update_returning:
+        row = db.execute(stmt.returning(users.c.balance_kopecks, users.c.telegram_id)).first()
+    else:
+        row = db.execute(_read_back(user_id)).first() if db.execute(stmt).rowcount else None
+    if row is None:
+        return None
+
+    balance, telegram_id = row
+    db.execute(_entry(user_id, delta, balance, reason, reference))
+    _after_change(db, user_id, telegram_id, delta, balance)
+    logger.info(f"💰 Баланс пользователя {telegram_id}: {delta:+d} коп. ({reason}), итого {balance}")
+    return balance
+
+def credit_sync(db: Session, user_id: int, kopecks: int, reason: str, reference: str = None) -> Optional[int]:
+    return change_sync(db, user_id, kopecks, reason, reference)
+
+def debit_sync(db: Session, user_id: int, kopecks: int, reason: str, reference: str = None) -> Optional[int]:
+    return change_sync(db, user_id, -kopecks, reason, reference)
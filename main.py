@@ -1,65 +1,123 @@
+import asyncio
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 import config
 import handlers
 import database
+import queries
+import outlines_api
+import outline_cluster
+import outline_batch
+import key_pool
+import traffic
+import reconcile
+import counters
+import keyboards
+import outbox
+import broadcast
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime
 
+async def warm_up(application):
+    """
+    Прогрев после старта (post_init): до этого момента бот не делает
+    блокирующего ввода-вывода. Схема БД проверяется в отдельном потоке,
+    Outline опрашивается задачами планировщика в фоне - медленный Outline
+    не задерживает обработку первых апдейтов.
+    """
+    await asyncio.to_thread(database.init_db)
+    keyboards.get_catalog().warm()
+    
+    scheduler = build_scheduler(application)
+    scheduler.start()
+    application.bot_data["scheduler"] = scheduler
+    # Рассылки, прерванные остановкой бота, продолжаются с контрольной точки
+    await broadcast.get_runner().resume_all(application.bot)
+
+async def on_shutdown(application):
+    """Останавливаем планировщик и закрываем пул соединений к Outline"""
+    scheduler = application.bot_data.get("scheduler")
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+    await outbox.get_outbox().drain()
+    await outlines_api.close_http_client()
+    await database.dispose_async_engine()
+
 async def check_subscriptions(context):
     """Ежедневная проверка подписок"""
-    db = database.SessionLocal()
+    db = database.async_session()
     try:
         today = datetime.utcnow()
         
-        expired = db.query(database.Subscription).filter(
-            database.Subscription.end_date < today,
-            database.Subscription.is_active == True
-        ).all()
+        expired = await queries.expired_subscriptions(db, today)
         
+        notify = []
+        revoke = []
         for sub in expired:
             sub.is_active = False
-            keys = db.query(database.VPNKey).filter_by(user_id=sub.user_id, is_active=True).all()
-            for key in keys:
-                key.is_active = False
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=sub.user.telegram_id,
-                    text="⚠️ Ваша подписка истекла. Пожалуйста, продлите её."
-                )
-            except:
-                pass
+            keys = await queries.deactivate_user_keys(db, sub.user_id)
+            revoke.extend(key for key in keys if key[1] and not key[1].startswith(reconcile.DEMO_PREFIX))
+            notify.append(sub.user.telegram_id)
         
-        db.commit()
+        await db.commit()
         print(f"✓ Проверка подписок: деактивировано {len(expired)}")
     except Exception as e:
         print(f"✗ Ошибка проверки подписок: {e}")
+        return
     finally:
-        db.close()
-
-def main():
-    # Инициализация базы
-    print("🔧 Инициализация базы данных...")
+        await db.close()
     
-    # Создаем приложение
-    application = Application.builder().token(config.Config.BOT_TOKEN).build()
+    # Отзыв ключей на серверах Outline - после commit, пакетом с лимитами по серверам.
+    # Не удаленные сейчас ключи (сервер недоступен) сверка удалит как сирот (RECONCILE_FIX)
+    if revoke:
+        results = await outline_batch.get_batch().delete_keys(revoke)
+        revoked = sum(1 for r in results if r.ok)
+        print(f"✓ Отозвано ключей в Outline: {revoked} из {len(revoke)}")
+    
+    # Уведомления - после commit, через очередь с лимитами Telegram (неудачи логирует outbox)
+    for telegram_id in notify:
+        await outbox.get_outbox().post(
+            context.bot, telegram_id,
+            "⚠️ Ваша подписка истекла. Пожалуйста, продлите её.",
+            priority=outbox.BULK
+        )
+
+def build_scheduler(application):
+    """Фоновые задачи; первые запуски опросов Outline - сразу после старта"""
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(check_subscriptions, 'cron', hour=0, args=[application])
+    scheduler.add_job(outline_cluster.get_cluster().refresh_load, 'interval',
+                      seconds=config.Config.OUTLINES_LOAD_REFRESH, next_run_time=datetime.now())
+    scheduler.add_job(key_pool.get_pool().refill, 'interval', seconds=config.Config.KEY_POOL_REFILL)
+    scheduler.add_job(outline_cluster.get_monitor().probe_all, 'interval',
+                      seconds=config.Config.OUTLINES_PROBE_INTERVAL, next_run_time=datetime.now())
+    scheduler.add_job(traffic.get_collector().collect, 'interval',
+                      seconds=config.Config.TRAFFIC_COLLECT_INTERVAL, next_run_time=datetime.now())
+    scheduler.add_job(reconcile.get_reconciler().run, 'interval', seconds=config.Config.RECONCILE_INTERVAL)
+    scheduler.add_job(counters.get_audit().run, 'interval', seconds=config.Config.COUNTERS_VERIFY_INTERVAL)
+    return scheduler
+
+def build_application(builder=None):
+    """Собрать приложение без сетевых запросов (builder можно передать свой, например в бенчмарке)"""
+    builder = builder or Application.builder().token(config.Config.BOT_TOKEN)
+    application = builder.post_init(warm_up).post_shutdown(on_shutdown).build()
     
     # Добавляем обработчики команд
     application.add_handler(CommandHandler("start", handlers.start))
     application.add_handler(CommandHandler("help", handlers.help_command))
     application.add_handler(CommandHandler("balance", handlers.balance_command))
     application.add_handler(CommandHandler("admin", handlers.admin_panel))  # Админ команда
+    application.add_handler(CommandHandler("broadcast", handlers.broadcast_command))  # Рассылка (админ)
     
     # Обработчик callback-кнопок
     application.add_handler(CallbackQueryHandler(handlers.button_handler))
     
     # Обработчик текстовых сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_message))
-    
-    # Планировщик
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(check_subscriptions, 'cron', hour=0, args=[application])
-    scheduler.start()
+    return application
+
+def main():
+    # База данных и Outline прогреваются в warm_up, после старта
+    application = build_application()
     
     print("=" * 50)
     print("🤖 VPN Бот запущен!")
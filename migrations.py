@@ -0,0 +1,195 @@
+"""
+Версионные миграции схемы БД.
+
+Применённые версии хранятся в таблице schema_migrations; при запуске
+накатываются только новые, каждая в своей транзакции. Индексы на
+PostgreSQL строятся через CREATE INDEX CONCURRENTLY - без блокировки
+записи, поэтому миграции можно применять на работающем боте. На
+PostgreSQL миграции идут под advisory-блокировкой: два процесса бота,
+стартовавшие одновременно, не выполнят один шаг дважды.
+
+Запуск вручную: python migrations.py [--target N]
+"""
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, List, Optional, Set
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock для миграций (любое число, общее для всех процессов бота)
+MIGRATION_LOCK_ID = 7_240_001
+
+_versions = MetaData()
+schema_migrations = Table(
+    "schema_migrations", _versions,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(100), nullable=False),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+class Migration:
+    """Один шаг схемы; transactional=False - шаг выполняется в режиме autocommit"""
+
+    def __init__(self, version: int, name: str, upgrade: Callable[[Connection, MetaData], None],
+                 transactional: bool = True):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+        self.transactional = transactional
+
+# ===== ШАГИ =====
+
+def _initial_schema(conn: Connection, metadata: MetaData):
+    # Существующие таблицы пропускаются - так подхватываются базы, созданные до миграций
+    metadata.create_all(bind=conn, checkfirst=True)
+
+def _vpn_keys_server_id(conn: Connection, metadata: MetaData):
+    columns = [c['name'] for c in inspect(conn).get_columns('vpn_keys')]
+    if 'server_id' not in columns:
+        conn.execute(text("ALTER TABLE vpn_keys ADD COLUMN server_id VARCHAR(50)"))
+
+# Индексы под горячие фильтры: ключи пользователя, проверка подписок,
+# платежи пользователя и последние платежи в админке
+HOT_INDEXES = [
+    ("ix_vpn_keys_user_id", "vpn_keys", ("user_id",)),
+    ("ix_subscriptions_active_end", "subscriptions", ("is_active", "end_date")),
+    ("ix_payments_user_status", "payments", ("user_id", "status")),
+    ("ix_payments_created_at", "payments", ("created_at",)),
+]
+
+def _index_valid(conn: Connection, name: str) -> Optional[bool]:
+    """PostgreSQL: None - индекса нет, False - INVALID (прерванный CREATE INDEX CONCURRENTLY)"""
+    return conn.execute(text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+    ), {"name": name}).scalar()
+
+def _hot_indexes(conn: Connection, metadata: MetaData):
+    postgresql = conn.dialect.name == "postgresql"
+    concurrently = " CONCURRENTLY" if postgresql else ""
+    inspector = inspect(conn)
+    for name, table, columns in HOT_INDEXES:
+        if postgresql:
+            valid = _index_valid(conn, name)
+            if valid:
+                continue
+            if valid is False:
+                # Недостроенный индекс не используется планировщиком - пересоздаем
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                logger.warning(f"🗂 Индекс {name} был INVALID - пересоздается")
+        elif any(ix['name'] == name for ix in inspector.get_indexes(table)):
+            continue
+        conn.execute(text(f"CREATE INDEX{concurrently} {name} ON {table} ({', '.join(columns)})"))
+        logger.info(f"🗂 Создан индекс {name}")
+
+def _balance_ledger(conn: Connection, metadata: MetaData):
+    columns = [c['name'] for c in inspect(conn).get_columns('users')]
+    if 'balance_kopecks' not in columns:
+        conn.execute(text("ALTER TABLE users ADD COLUMN balance_kopecks BIGINT NOT NULL DEFAULT 0"))
+        conn.execute(text("UPDATE users SET balance_kopecks = CAST(ROUND(COALESCE(balance, 0) * 100) AS BIGINT)"))
+    metadata.tables['balance_ledger'].create(bind=conn, checkfirst=True)
+    # Входящий остаток: сумма записей журнала сходится с balance_kopecks с первого дня
+    conn.execute(text(
+        "INSERT INTO balance_ledger (user_id, amount_kopecks, balance_after, reason, reference, created_at) "
+        "SELECT id, balance_kopecks, balance_kopecks, 'opening', NULL, :now FROM users "
+        "WHERE balance_kopecks <> 0 AND id NOT IN (SELECT user_id FROM balance_ledger)"
+    ), {"now": datetime.utcnow()})
+
+def _counters(conn: Connection, metadata: MetaData):
+    metadata.tables['counters'].create(bind=conn, checkfirst=True)
+    # Начальные значения - полным пересчетом; дальше их ведет counters.py
+    conn.execute(text("DELETE FROM counters"))
+    for select_sql in (
+        "SELECT 'users', COUNT(*) FROM users",
+        "SELECT 'balance_kopecks', COALESCE(SUM(balance_kopecks), 0) FROM users",
+        "SELECT 'vpn_keys', COUNT(*) FROM vpn_keys",
+        "SELECT 'subscriptions:active', COUNT(*) FROM subscriptions WHERE is_active",
+        "SELECT 'payments:' || COALESCE(status, 'None'), COUNT(*) FROM payments GROUP BY status",
+    ):
+        conn.execute(text(f"INSERT INTO counters (name, value) {select_sql}"))
+
+def _broadcasts(conn: Connection, metadata: MetaData):
+    columns = [c['name'] for c in inspect(conn).get_columns('users')]
+    if 'chat_blocked' not in columns:
+        conn.execute(text("ALTER TABLE users ADD COLUMN chat_blocked BOOLEAN NOT NULL DEFAULT FALSE"))
+    metadata.tables['broadcasts'].create(bind=conn, checkfirst=True)
+
+def _traffic_totals(conn: Connection, metadata: MetaData):
+    metadata.tables['traffic_totals'].create(bind=conn, checkfirst=True)
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "initial schema", _initial_schema),
+    Migration(2, "vpn_keys.server_id", _vpn_keys_server_id),
+    Migration(3, "hot query indexes", _hot_indexes, transactional=False),
+    Migration(4, "balance in kopecks and balance_ledger", _balance_ledger),
+    Migration(5, "admin statistics counters", _counters),
+    Migration(6, "admin broadcasts and users.chat_blocked", _broadcasts),
+    Migration(7, "traffic last totals", _traffic_totals),
+]
+
+# ===== ПРИМЕНЕНИЕ =====
+
+def applied_versions(engine: Engine) -> List[int]:
+    with engine.connect() as conn:
+        if not inspect(conn).has_table("schema_migrations"):
+            return []
+        return sorted(conn.execute(select(schema_migrations.c.version)).scalars())
+
+@contextmanager
+def _migration_lock(engine: Engine):
+    """PostgreSQL: сессионная advisory-блокировка на отдельном соединении на все время миграций"""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+def migrate(engine: Engine, metadata: MetaData, target: Optional[int] = None) -> List[int]:
+    """Накатить недостающие миграции (до версии target включительно); вернуть примененные версии"""
+    with _migration_lock(engine):
+        # Версии читаются уже под блокировкой: второй процесс увидит шаги, примененные первым
+        _versions.create_all(bind=engine, checkfirst=True)
+        return _apply(engine, metadata, set(applied_versions(engine)), target)
+
+def _apply(engine: Engine, metadata: MetaData, done: Set[int], target: Optional[int]) -> List[int]:
+    applied = []
+
+    for migration in MIGRATIONS:
+        if migration.version in done or (target is not None and migration.version > target):
+            continue
+
+        if migration.transactional:
+            with engine.begin() as conn:
+                migration.upgrade(conn, metadata)
+                conn.execute(schema_migrations.insert().values(version=migration.version, name=migration.name))
+        else:
+            with engine.connect() as conn:
+                conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                migration.upgrade(conn, metadata)
+                conn.execute(schema_migrations.insert().values(version=migration.version, name=migration.name))
+
+        logger.info(f"✅ Миграция {migration.version}: {migration.name}")
+        applied.append(migration.version)
+    return applied
+
+if __name__ == "__main__":
+    import argparse
+
+    import database
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=int, default=None, help="применить миграции до этой версии")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    migrate(database.engine, database.Base.metadata, args.target)
+    print(f"Версии схемы: {applied_versions(database.engine)}")
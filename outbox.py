@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Dict, List, Optional
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import config
+from rate_limit import TokenBucket, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: меньше - раньше
+INTERACTIVE = 0   # ответ на действие пользователя (ключ после покупки)
+NOTIFY = 1        # уведомление одному пользователю (пополнение админом)
+BULK = 2          # массовые рассылки и ежедневные проверки
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NOTIFY: "notify", BULK: "bulk"}
+
+class Outgoing:
+    """Сообщение в очереди; future - у того, кто ждет доставки (send), иначе None (post)"""
+    __slots__ = ("bot", "chat_id", "text", "kwargs", "priority", "seq", "future", "attempt", "queued_at")
+
+    def __init__(self, bot, chat_id: int, text: str, kwargs: dict, priority: int, seq: int,
+                 future: Optional[asyncio.Future]):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.attempt = 0
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Outbox:
+    """
+    Очередь исходящих send_message с лимитами Telegram: не больше
+    global_rate сообщений в секунду на бота и chat_rate в один чат.
+    Один воркер берет самое приоритетное сообщение, чей чат не упирается
+    в свой лимит; сообщения в "занятый" чат откладываются до его токена и
+    не задерживают остальных. На 429 (RetryAfter) пауза выдерживается для
+    всей очереди - Telegram ограничивает бота целиком. Очередь ограничена:
+    когда она полна, отправитель ждет места (backpressure) - рассылка
+    замедляется, а не раздувает память.
+    """
+
+    def __init__(self, global_rate: float = None, chat_rate: float = None,
+                 max_queue: int = None, max_retries: int = None):
+        # Запас в один токен: без начального залпа в секунду не уходит больше global_rate
+        self.global_bucket = TokenBucket(global_rate if global_rate is not None else config.Config.OUTBOX_GLOBAL_RATE,
+                                         capacity=1)
+        self.chat_rate = chat_rate if chat_rate is not None else config.Config.OUTBOX_CHAT_RATE
+        self.max_queue = max_queue or config.Config.OUTBOX_MAX_QUEUE
+        self.max_retries = max_retries if max_retries is not None else config.Config.OUTBOX_MAX_RETRIES
+
+        self._ready: List[Outgoing] = []            # куча по (приоритет, порядок)
+        self._delayed: List[tuple] = []             # куча (когда можно, сообщение) - чат или сеть заняты
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._paused_until = 0.0
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+
+        # Метрики
+        self.sent = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.failed = 0             # не доставлено (бот заблокирован, чат не найден, исчерпаны повторы)
+        self.retried = 0            # повторов после сетевых ошибок
+        self.rate_limited = 0       # ответов 429 от Telegram
+        self.paused_seconds = 0.0   # суммарная пауза по retry_after
+        self.throttled = 0          # откладываний из-за лимита чата
+        self.backpressure_waits = 0     # отправителей ждали места в очереди
+        self.backpressure_seconds = 0.0
+        self.max_depth = 0
+        self.queue_seconds = 0.0    # суммарное ожидание доставленных в очереди
+
+    # ===== ПОСТАНОВКА В ОЧЕРЕДЬ =====
+
+    @property
+    def depth(self) -> int:
+        return len(self._ready) + len(self._delayed)
+
+    async def send(self, bot, chat_id: int, text: str, priority: int = INTERACTIVE, **kwargs):
+        """Поставить в очередь и дождаться доставки; ошибки Telegram пробрасываются"""
+        future = asyncio.get_running_loop().create_future()
+        await self._put(bot, chat_id, text, kwargs, priority, future)
+        return await future
+
+    async def post(self, bot, chat_id: int, text: str, priority: int = BULK, **kwargs):
+        """Поставить в очередь без ожидания доставки; неудачи только логируются"""
+        await self._put(bot, chat_id, text, kwargs, priority, None)
+
+    async def _put(self, bot, chat_id, text, kwargs, priority, future):
+        if self.depth >= self.max_queue:
+            started = time.monotonic()
+            self.backpressure_waits += 1
+            async with self._space:
+                await self._space.wait_for(lambda: self.depth < self.max_queue)
+            self.backpressure_seconds += time.monotonic() - started
+
+        heapq.heappush(self._ready, Outgoing(bot, chat_id, text, kwargs, priority, next(self._seq), future))
+        self.max_depth = max(self.max_depth, self.depth)
+        self._ensure_worker()
+        self._wakeup.set()
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    # ===== ВОРКЕР =====
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_queue:
+                # Полные корзины (чат давно не писали) ничего не помнят - выбрасываем
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if b.delay(b.capacity) > 0}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    def _release_delayed(self, now: float):
+        while self._delayed and self._delayed[0][0] <= now:
+            heapq.heappush(self._ready, heapq.heappop(self._delayed)[1])
+
+    async def _run(self):
+        while self.depth:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._release_delayed(now)
+            if not self._ready:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._delayed[0][0] - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            item = heapq.heappop(self._ready)
+            if item.future is not None and item.future.cancelled():
+                continue  # отправитель передумал (отмененная рассылка)
+            bucket = self._chat_bucket(item.chat_id)
+            if not bucket.try_acquire():
+                self.throttled += 1
+                heapq.heappush(self._delayed, (now + bucket.delay(), item))
+                continue
+
+            await self.global_bucket.acquire()
+            task = asyncio.create_task(self._deliver(item))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+            async with self._space:
+                self._space.notify_all()
+
+    async def _deliver(self, item: Outgoing):
+        try:
+            message = await item.bot.send_message(chat_id=item.chat_id, text=item.text, **item.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            retry_after = float(retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after)
+            self.rate_limited += 1
+            self.paused_seconds += retry_after
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            logger.warning(f"📮 Telegram просит подождать {retry_after:.0f} с - очередь на паузе")
+            self._retry(item, 0.0, e)
+        except BadRequest as e:  # подкласс NetworkError, но повтор не поможет
+            self._fail(item, e)
+        except NetworkError as e:
+            self.retried += 1
+            self._retry(item, backoff_delay(item.attempt, 1.0, 30.0), e)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self.sent[PRIORITY_NAMES.get(item.priority, "bulk")] += 1
+            self.queue_seconds += time.monotonic() - item.queued_at
+            if item.future is not None and not item.future.done():
+                item.future.set_result(message)
+
+    def _retry(self, item: Outgoing, delay: float, error: Exception):
+        item.attempt += 1
+        if item.attempt > self.max_retries:
+            self._fail(item, error)
+            return
+        # Возвращается на свое место по приоритету и порядку, не в конец очереди
+        heapq.heappush(self._delayed, (time.monotonic() + delay, item))
+        self._ensure_worker()
+        self._wakeup.set()
+
+    def _fail(self, item: Outgoing, error: Exception):
+        self.failed += 1
+        if item.future is not None and not item.future.done():
+            item.future.set_exception(error)
+        else:
+            logger.warning(f"📮 Сообщение в чат {item.chat_id} не доставлено: {error}")
+
+    async def drain(self, timeout: float = 10.0):
+        """Дождаться отправки очереди (при остановке бота), не дольше timeout"""
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth:
+            logger.warning(f"📮 При остановке в очереди осталось {self.depth} сообщений")
+
+    # ===== МЕТРИКИ =====
+
+    def metrics(self) -> Dict:
+        delivered = sum(self.sent.values())
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "sent": dict(self.sent),
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "paused_seconds": self.paused_seconds,
+            "throttled": self.throttled,
+            "backpressure_waits": self.backpressure_waits,
+            "backpressure_seconds": self.backpressure_seconds,
+            "avg_queue_ms": self.queue_seconds / delivered * 1000 if delivered else 0.0,
+        }
+
+    def report_lines(self) -> List[str]:
+        """Строки для админ-панели"""
+        m = self.metrics()
+        sent = ", ".join(f"{name} {count}" for name, count in m["sent"].items())
+        return [
+            f"📮 Исходящие: в очереди {m['depth']} (макс. {m['max_depth']} из {self.max_queue}), "
+            f"ср. ожидание {m['avg_queue_ms']:.0f} мс",
+            f"• отправлено: {sent}; не доставлено {m['failed']}",
+            f"• 429 от Telegram: {m['rate_limited']} (пауза {m['paused_seconds']:.0f} с), "
+            f"ждали места в очереди: {m['backpressure_waits']}",
+        ]
+
+_outbox: Optional[Outbox] = None
+
+def get_outbox() -> Outbox:
+    """Общая очередь исходящих сообщений (создается при первом обращении)"""
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox()
+    return _outbox
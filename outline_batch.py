@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import config
+from outline_cluster import OutlineCluster, OutlineServer, get_cluster
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+class BatchResult:
+    """Результат одной операции пакета"""
+    __slots__ = ("item", "ok", "result", "error")
+
+    def __init__(self, item: Any, ok: bool, result: Any = None, error: str = None):
+        self.item = item
+        self.ok = ok
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        return f"BatchResult({self.item!r}, ok={self.ok}, error={self.error!r})"
+
+class OutlineBatch:
+    """
+    Пакетные операции с ключами Outline.
+    Не больше concurrency запросов одновременно и не больше
+    rate_per_server запросов в секунду на каждый сервер.
+    """
+
+    def __init__(self, cluster: OutlineCluster = None, concurrency: int = None,
+                 rate_per_server: float = None):
+        self._cluster = cluster
+        self.concurrency = concurrency or config.Config.OUTLINES_BATCH_CONCURRENCY
+        self.rate_per_server = rate_per_server if rate_per_server is not None else config.Config.OUTLINES_RATE_LIMIT
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    @property
+    def cluster(self) -> OutlineCluster:
+        return self._cluster or get_cluster()
+
+    def _bucket(self, server_id: str) -> TokenBucket:
+        bucket = self._buckets.get(server_id)
+        if bucket is None:
+            bucket = self._buckets[server_id] = TokenBucket(self.rate_per_server)
+        return bucket
+
+    async def _run(self, items: List, server_of: Callable[[Any], Optional[OutlineServer]],
+                   op: Callable[[OutlineServer, Any], Awaitable[Any]]) -> List[BatchResult]:
+        """Выполнить op для каждого элемента; порядок результатов совпадает с items"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(item) -> BatchResult:
+            async with semaphore:
+                try:
+                    server = server_of(item)
+                    if server is None:
+                        return BatchResult(item, False, error="нет доступного сервера")
+                    await self._bucket(server.id).acquire()
+                    result = await op(server, item)
+                    if not result:
+                        return BatchResult(item, False, error="сервер вернул ошибку")
+                    return BatchResult(item, True, result=result)
+                except Exception as e:
+                    return BatchResult(item, False, error=str(e))
+
+        results = await asyncio.gather(*(one(item) for item in items))
+        failed = sum(1 for r in results if not r.ok)
+        if failed:
+            logger.warning(f"Пакетная операция: {failed} из {len(results)} с ошибкой")
+        return results
+
+    async def create_keys(self, names: List[str], limit_gb: Optional[int] = 10,
+                          server_id: str = None) -> List[BatchResult]:
+        """Создать ключи; без server_id каждый ключ размещается на наименее загруженном сервере.
+        result: (server_id, key_data)"""
+        def server_of(name):
+            return self.cluster.get(server_id) if server_id else self.cluster.pick_server()
+
+        async def op(server, name):
+            key_data = await server.create_key(name, limit_gb=limit_gb)
+            return (server.id, key_data) if key_data else None
+
+        return await self._run(names, server_of, op)
+
+    async def delete_keys(self, keys: List[Tuple[Optional[str], str]]) -> List[BatchResult]:
+        """Удалить ключи. keys: [(server_id, key_id), ...]"""
+        async def op(server, item):
+            return await self.cluster.delete_key(server.id, item[1])
+
+        return await self._run(keys, lambda item: self.cluster.get(item[0]), op)
+
+    async def update_key_limits(self, keys: List[Tuple[Optional[str], str, int]]) -> List[BatchResult]:
+        """Изменить лимиты. keys: [(server_id, key_id, limit_gb), ...]"""
+        async def op(server, item):
+            return await server.api.update_key_limit(item[1], item[2])
+
+        return await self._run(keys, lambda item: self.cluster.get(item[0]), op)
+
+_batch: Optional[OutlineBatch] = None
+
+def get_batch() -> OutlineBatch:
+    """Общий исполнитель пакетных операций (создается при первом обращении)"""
+    global _batch
+    if _batch is None:
+        _batch = OutlineBatch()
+    return _batch
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import config
+from outlines_api import AsyncOutlinesAPI
+from outline_mirror import KeyMirror
+from outline_health import CLOSED, CircuitBreaker, HealthMonitor
+from rate_limit import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+def new_token() -> str:
+    """Токен идемпотентности для создания ключа"""
+    return uuid.uuid4().hex[:8]
+
+def tag_name(name: str, token: str) -> str:
+    """Имя ключа в Outline с токеном: по нему повтор находит уже созданный ключ"""
+    return f"{name} #{token}"
+
+class OutlineServer:
+    """Сервер Outline из реестра и его текущая нагрузка"""
+
+    def __init__(self, server_id: str, api_url: str, api_key: str = "",
+                 path_id: str = "", max_keys: int = None):
+        self.id = server_id
+        self.breaker = CircuitBreaker()
+        self.api = AsyncOutlinesAPI(base_url=api_url, api_key=api_key, server_id=path_id, breaker=self.breaker)
+        self.max_keys = max_keys
+        self.mirror = KeyMirror(self.api.fetch_keys)
+
+        # Результат последней проверки здоровья (HealthMonitor)
+        self.probe_latency: Optional[float] = None
+        self.last_probe_ok: Optional[bool] = None
+
+        # Нагрузка (обновляется в refresh_load)
+        self.key_count = 0
+        self.recent_bytes = 0           # трафик с прошлого обновления
+        self._total_bytes = None        # суммарный трафик из /metrics/transfer
+        self.load_updated_at = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        """Сервер участвует в размещении, только пока цепь замкнута"""
+        return self.breaker.state == CLOSED
+
+    @property
+    def has_capacity(self) -> bool:
+        return self.max_keys is None or self.key_count < self.max_keys
+
+    async def create_key(self, name: str, limit_gb: Optional[int] = 10,
+                         token: str = None) -> Optional[Dict]:
+        """
+        Создать ключ на этом сервере и сразу учесть его в зеркале.
+        Идемпотентно: имя ключа помечается токеном, и перед каждым повтором
+        ищем ключ с этим токеном - если прошлая попытка (например, по таймауту)
+        все-таки создала ключ, он будет подхвачен, а не создан второй.
+        """
+        tagged = tag_name(name, token or new_token())
+        attempts = config.Config.OUTLINES_CREATE_ATTEMPTS
+
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt - 1, config.Config.OUTLINES_BACKOFF_BASE,
+                                                  config.Config.OUTLINES_BACKOFF_MAX))
+                found = await self._find_created(tagged)
+                if found is None:
+                    continue  # список ключей недоступен - создавать вслепую нельзя
+                if found:
+                    logger.info(f"Ключ {tagged} уже создан прошлой попыткой, подхватываем")
+                    return self._created(found)
+
+            key_data = await self.api.create_key(tagged, limit_gb=limit_gb)
+            if key_data:
+                return self._created(key_data)
+
+        logger.error(f"Не удалось создать ключ {tagged} на {self.id} за {attempts} попыток")
+        return None
+
+    async def _find_created(self, tagged: str) -> Optional[Dict]:
+        """Ключ с этим именем на сервере; {} - его нет, None - сервер не ответил"""
+        if not await self.mirror.refresh():
+            return None
+        found = self.mirror.find_by_name(tagged)
+        for duplicate in found[1:]:
+            # Обе попытки дошли до сервера - лишний ключ удаляем
+            if await self.api.delete_key(duplicate['id']):
+                self.mirror.apply_deleted(duplicate['id'])
+        return found[0] if found else {}
+
+    def _created(self, key_data: Dict) -> Dict:
+        self.mirror.apply_created(key_data)
+        self.key_count += 1  # чтобы всплеск покупок не лег на один сервер
+        return key_data
+
+    async def delete_key(self, key_id: str) -> bool:
+        """Удалить ключ на этом сервере и сразу убрать его из зеркала"""
+        deleted = await self.api.delete_key(key_id)
+        if deleted:
+            self.mirror.apply_deleted(key_id)
+            self.key_count = max(0, self.key_count - 1)
+        return deleted
+
+    async def refresh_load(self):
+        """Обновить зеркало ключей и трафик сервера"""
+        keys_ok, transfer = await asyncio.gather(
+            self.mirror.refresh(),
+            self.api.get_transfer_metrics()
+        )
+        if not keys_ok or transfer is None:
+            logger.warning(f"Не удалось обновить нагрузку сервера {self.id}")
+            return
+
+        total = sum(transfer.values())
+        self.recent_bytes = max(0, total - self._total_bytes) if self._total_bytes is not None else 0
+        self._total_bytes = total
+        self.key_count = self.mirror.count()
+        self.load_updated_at = time.monotonic()
+
+class OutlineCluster:
+    """Реестр серверов Outline с размещением ключей на наименее загруженный"""
+
+    def __init__(self, servers: List[OutlineServer]):
+        if not servers:
+            raise ValueError("Реестр серверов Outline пуст")
+        self.servers: Dict[str, OutlineServer] = {s.id: s for s in servers}
+        self.default_id = servers[0].id
+
+    @classmethod
+    def from_config(cls) -> "OutlineCluster":
+        """Собрать реестр из OUTLINES_SERVERS (или одного OUTLINES_API_URL)"""
+        if config.Config.OUTLINES_SERVERS:
+            servers = [
+                OutlineServer(
+                    server_id=str(item["id"]),
+                    api_url=item["api_url"],
+                    api_key=item.get("api_key", ""),
+                    max_keys=item.get("max_keys")
+                )
+                for item in json.loads(config.Config.OUTLINES_SERVERS)
+            ]
+        else:
+            servers = [OutlineServer(
+                server_id=config.Config.OUTLINES_SERVER_ID,
+                api_url=config.Config.OUTLINES_API_URL,
+                api_key=config.Config.OUTLINES_API_KEY,
+                path_id=config.Config.OUTLINES_SERVER_ID
+            )]
+        return cls(servers)
+
+    def get(self, server_id: Optional[str]) -> OutlineServer:
+        """Сервер по id; ключи без server_id (старые записи) - на сервере по умолчанию"""
+        server = self.servers.get(server_id or self.default_id)
+        if server is None:
+            raise KeyError(f"Сервер Outline '{server_id}' отсутствует в реестре")
+        return server
+
+    async def refresh_load(self):
+        """Обновить нагрузку всех серверов параллельно"""
+        await asyncio.gather(*(s.refresh_load() for s in self.servers.values()))
+
+    def pick_server(self) -> Optional[OutlineServer]:
+        """Наименее загруженный здоровый сервер со свободным местом"""
+        candidates = [s for s in self.servers.values() if s.healthy and s.has_capacity]
+        if not candidates:
+            return None
+
+        # Доля ключей + доля недавнего трафика: оба слагаемых в [0, 1]
+        total_keys = sum(s.key_count for s in candidates) or 1
+        total_bytes = sum(s.recent_bytes for s in candidates) or 1
+        return min(candidates, key=lambda s: s.key_count / total_keys + s.recent_bytes / total_bytes)
+
+    async def create_key(self, name: str, limit_gb: int = 10,
+                         token: str = None) -> Tuple[Optional[OutlineServer], Optional[Dict]]:
+        """Создать ключ на наименее загруженном сервере. Returns: (server, key_data)"""
+        server = self.pick_server()
+        if server is None:
+            logger.error("Нет доступных серверов Outline для нового ключа")
+            return None, None
+
+        return server, await server.create_key(name, limit_gb=limit_gb, token=token)
+
+    async def get_key(self, server_id: Optional[str], key_id: str) -> Optional[Dict]:
+        return await self.get(server_id).api.get_key(key_id)
+
+    async def delete_key(self, server_id: Optional[str], key_id: str) -> bool:
+        return await self.get(server_id).delete_key(key_id)
+
+    async def update_key_limit(self, server_id: Optional[str], key_id: str, limit_gb: int) -> bool:
+        return await self.get(server_id).api.update_key_limit(key_id, limit_gb)
+
+_cluster: Optional[OutlineCluster] = None
+_monitor: Optional[HealthMonitor] = None
+
+def get_cluster() -> OutlineCluster:
+    """Общий реестр серверов (создается при первом обращении)"""
+    global _cluster
+    if _cluster is None:
+        _cluster = OutlineCluster.from_config()
+    return _cluster
+
+def get_monitor() -> HealthMonitor:
+    """Проверка здоровья всех серверов реестра"""
+    global _monitor
+    if _monitor is None:
+        _monitor = HealthMonitor(get_cluster().servers.values())
+    return _monitor
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from typing import Iterable, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"        # сервер работает, запросы идут
+OPEN = "open"            # сервер считается упавшим, запросы отклоняются сразу
+HALF_OPEN = "half-open"  # пробуем один запрос после паузы
+
+class CircuitOpenError(Exception):
+    """Запрос к серверу отклонен: цепь разомкнута"""
+
+class CircuitBreaker:
+    """Автомат closed -> open -> half-open для одного сервера Outline"""
+
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = failure_threshold or config.Config.OUTLINES_BREAKER_FAILURES
+        self.reset_timeout = reset_timeout if reset_timeout is not None else config.Config.OUTLINES_BREAKER_RESET
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self._trial_in_flight = False
+        # HALF_OPEN: пропускаем ровно один пробный запрос
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info("Цепь замкнута: сервер Outline снова доступен")
+        self.state = CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning(f"Цепь разомкнута после {self.failures} ошибок подряд")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+class HealthMonitor:
+    """Периодическая проверка серверов Outline вместо проверки при импорте"""
+
+    def __init__(self, servers: Iterable, interval: float = None, timeout: float = None):
+        self.servers = servers  # OutlineServer: .id, .api, .breaker
+        self.interval = interval or config.Config.OUTLINES_PROBE_INTERVAL
+        self.timeout = timeout or config.Config.OUTLINES_PROBE_TIMEOUT
+        self._task: Optional[asyncio.Task] = None
+
+    async def probe(self, server) -> bool:
+        started = time.perf_counter()
+        ok = await server.api.probe(timeout=self.timeout)
+        server.probe_latency = time.perf_counter() - started
+        server.last_probe_ok = ok
+        return ok
+
+    async def probe_all(self):
+        await asyncio.gather(*(self.probe(s) for s in list(self.servers)))
+
+    def report(self) -> List[str]:
+        """Строки состояния серверов для админ-панели"""
+        icons = {CLOSED: "✅", HALF_OPEN: "🟡", OPEN: "⛔"}
+        lines = []
+        for server in self.servers:
+            latency = server.probe_latency
+            latency_text = f"{latency * 1000:.0f} мс" if latency is not None else "нет данных"
+            lines.append(f"{icons[server.breaker.state]} {server.id}: {server.breaker.state}, {latency_text}")
+        return lines
+
+    def start(self) -> asyncio.Task:
+        """Запустить периодическую проверку (нужен работающий event loop)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Ошибка проверки серверов Outline: {e}")
+            await asyncio.sleep(self.interval)
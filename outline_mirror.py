@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class KeyMirror:
+    """
+    Локальная копия ключей одного сервера Outline.
+    Обновляется в фоне раз в ttl секунд; чтения никогда не ходят в сеть.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[Optional[List[Dict]]]], ttl: int = None):
+        self._fetch = fetch  # возвращает список ключей или None при ошибке
+        self.ttl = ttl or config.Config.OUTLINES_MIRROR_TTL
+
+        self._by_id: Dict[str, Dict] = {}
+        self._by_name: Dict[str, Set[str]] = {}
+
+        self.refreshed_at = 0.0     # time.monotonic() последнего успешного обновления
+        self.last_ok: Optional[bool] = None
+        self.last_error: Optional[str] = None
+        self._refresh_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    # ===== ЧТЕНИЕ (O(1), без сети) =====
+
+    def count(self) -> int:
+        return len(self._by_id)
+
+    def get(self, key_id: str) -> Optional[Dict]:
+        return self._by_id.get(str(key_id))
+
+    def find_by_name(self, name: str) -> List[Dict]:
+        return [self._by_id[key_id] for key_id in self._by_name.get(name, ())]
+
+    def latest(self, limit: int = 10) -> List[Dict]:
+        """Последние limit ключей в порядке сервера"""
+        result = []
+        for key_id in reversed(self._by_id):
+            if len(result) == limit:
+                break
+            result.append(self._by_id[key_id])
+        result.reverse()
+        return result
+
+    @property
+    def age(self) -> Optional[float]:
+        """Сколько секунд назад было последнее успешное обновление"""
+        return time.monotonic() - self.refreshed_at if self.refreshed_at else None
+
+    @property
+    def is_stale(self) -> bool:
+        return self.age is None or self.age > self.ttl
+
+    # ===== ЗАПИСЬ =====
+
+    def apply_created(self, key_data: Dict):
+        """Учесть созданный ботом ключ, не дожидаясь обновления"""
+        key_id = str(key_data['id'])
+        self._forget_name(key_id)
+        self._by_id[key_id] = key_data
+        self._by_name.setdefault(key_data.get('name') or '', set()).add(key_id)
+
+    def apply_deleted(self, key_id: str):
+        """Учесть удаленный ботом ключ"""
+        key_id = str(key_id)
+        self._forget_name(key_id)
+        self._by_id.pop(key_id, None)
+
+    def _forget_name(self, key_id: str):
+        old = self._by_id.get(key_id)
+        if old is None:
+            return
+        ids = self._by_name.get(old.get('name') or '')
+        if ids is not None:
+            ids.discard(key_id)
+            if not ids:
+                del self._by_name[old.get('name') or '']
+
+    async def refresh(self) -> bool:
+        """Загрузить ключи с сервера и применить только изменения"""
+        async with self._refresh_lock:
+            keys = await self._fetch()
+            if keys is None:
+                self.last_ok = False
+                self.last_error = "сервер не ответил"
+                return False
+
+            fresh = {str(k['id']): k for k in keys}
+            removed = self._by_id.keys() - fresh.keys()
+            for key_id in removed:
+                self.apply_deleted(key_id)
+
+            changed = 0
+            for key_id, key_data in fresh.items():
+                if self._by_id.get(key_id) != key_data:
+                    self.apply_created(key_data)
+                    changed += 1
+
+            self.refreshed_at = time.monotonic()
+            self.last_ok = True
+            self.last_error = None
+            if changed or removed:
+                logger.info(f"Зеркало ключей: {changed} новых/измененных, {len(removed)} удаленных, всего {self.count()}")
+            return True
+
+    # ===== ФОНОВОЕ ОБНОВЛЕНИЕ =====
+
+    def start(self) -> asyncio.Task:
+        """Запустить фоновое обновление (нужен работающий event loop)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.last_ok = False
+                self.last_error = str(e)
+                logger.error(f"Ошибка обновления зеркала ключей: {e}")
+            await asyncio.sleep(self.ttl)
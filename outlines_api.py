@@ -1,8 +1,10 @@
 import requests
+import httpx
 import json
 import config
 from typing import Optional, Dict, List
 import logging
+from outline_health import CircuitBreaker, CircuitOpenError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -155,12 +157,268 @@ class OutlinesAPI:
             logger.error(f"Исключение при получении информации о сервере: {e}")
             return None
 
-# Создаем глобальный экземпляр API
-outlines_api = OutlinesAPI()
+# ========== АСИНХРОННЫЙ КЛИЕНТ ==========
+
+# Общий пул keep-alive соединений для всех асинхронных клиентов
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Получить общий HTTP-клиент (создается при первом обращении)"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            verify=False,  # Самоподписанные сертификаты Outline
+            timeout=config.Config.OUTLINES_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=config.Config.OUTLINES_POOL_SIZE,
+                max_keepalive_connections=config.Config.OUTLINES_POOL_SIZE,
+                keepalive_expiry=30
+            )
+        )
+    return _http_client
+
+async def close_http_client():
+    """Закрыть общий HTTP-клиент (вызывается при остановке бота)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+class AsyncOutlinesAPI:
+    """Асинхронный клиент Outline VPN API на общем пуле соединений"""
+    
+    def __init__(self, base_url: str = None, api_key: str = None, server_id: str = None,
+                 client: httpx.AsyncClient = None, breaker: CircuitBreaker = None):
+        self.base_url = (base_url or config.Config.OUTLINES_API_URL).rstrip('/')
+        self.api_key = api_key if api_key is not None else config.Config.OUTLINES_API_KEY
+        # server_id - сегмент пути после base_url; "" если base_url уже полный
+        self.server_id = server_id if server_id is not None else config.Config.OUTLINES_SERVER_ID
+        self._client = client
+        self.breaker = breaker
+        
+        self.headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            # Outline может работать и без токена - секрет уже в URL
+            self.headers["Authorization"] = f"Bearer {self.api_key}"
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self._client or get_http_client()
+    
+    def _url(self, path: str) -> str:
+        if not self.server_id:
+            return f"{self.base_url}{path}"
+        return f"{self.base_url}/{self.server_id}{path}"
+    
+    async def _request(self, method: str, path: str, timeout: float = None,
+                       probe: bool = False, **kwargs) -> httpx.Response:
+        """
+        Выполнить запрос; timeout задается на каждый вызов отдельно.
+        При разомкнутой цепи сразу бросает CircuitOpenError (кроме проверок здоровья).
+        """
+        if self.breaker is not None and not probe and not self.breaker.allow():
+            raise CircuitOpenError(f"Сервер {self.base_url} временно недоступен")
+        
+        try:
+            response = await self.client.request(
+                method,
+                self._url(path),
+                headers=self.headers,
+                timeout=timeout if timeout is not None else config.Config.OUTLINES_TIMEOUT,
+                **kwargs
+            )
+        except Exception:
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        
+        if self.breaker is not None:
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return response
+    
+    async def probe(self, timeout: float = None) -> bool:
+        """Проверка здоровья сервера (идет даже при разомкнутой цепи)"""
+        try:
+            response = await self._request("GET", "/server", timeout=timeout, probe=True)
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"Сервер {self.base_url} не отвечает: {e}")
+            return False
+    
+    async def create_key(self, name: str = "VPN Key", limit_gb: Optional[int] = 10,
+                         timeout: float = None) -> Optional[Dict]:
+        """
+        Создать новый ключ в Outline (limit_gb=None - без лимита)
+        Returns: {'id': 'key_id', 'accessUrl': 'ss://...', 'name': '...'}
+        """
+        try:
+            payload = {"name": name}
+            if limit_gb is not None:
+                payload["limit"] = {"bytes": limit_gb * 1024 * 1024 * 1024}
+            response = await self._request("POST", "/access-keys", timeout=timeout, json=payload)
+            
+            if response.status_code == 201:
+                key_data = response.json()
+                logger.info(f"Создан ключ: {name}, ID: {key_data.get('id')}")
+                return key_data
+            else:
+                logger.error(f"Ошибка создания ключа: {response.status_code} - {response.text}")
+                return None
+                
+        except Exception as e:
+            logger.error(f"Исключение при создании ключа: {e}")
+            return None
+    
+    async def get_all_keys(self, timeout: float = None) -> List[Dict]:
+        """Получить все ключи"""
+        return await self.fetch_keys(timeout=timeout) or []
+    
+    async def fetch_keys(self, timeout: float = None) -> Optional[List[Dict]]:
+        """Получить все ключи; None при ошибке (в отличие от пустого списка)"""
+        try:
+            response = await self._request("GET", "/access-keys", timeout=timeout)
+            
+            if response.status_code == 200:
+                return response.json().get('accessKeys', [])
+            else:
+                logger.error(f"Ошибка получения ключей: {response.status_code}")
+                return None
+                
+        except Exception as e:
+            logger.error(f"Исключение при получении ключей: {e}")
+            return None
+    
+    async def delete_key(self, key_id: str, timeout: float = None) -> bool:
+        """Удалить ключ"""
+        try:
+            response = await self._request("DELETE", f"/access-keys/{key_id}", timeout=timeout)
+            
+            if response.status_code == 204:
+                logger.info(f"Ключ удален: {key_id}")
+                return True
+            else:
+                logger.error(f"Ошибка удаления ключа: {response.status_code}")
+                return False
+                
+        except Exception as e:
+            logger.error(f"Исключение при удалении ключа: {e}")
+            return False
+    
+    async def get_key(self, key_id: str, timeout: float = None) -> Optional[Dict]:
+        """Получить информацию о конкретном ключе"""
+        try:
+            response = await self._request("GET", f"/access-keys/{key_id}", timeout=timeout)
+            
+            if response.status_code == 200:
+                return response.json()
+            else:
+                logger.error(f"Ошибка получения ключа {key_id}: {response.status_code}")
+                return None
+                
+        except Exception as e:
+            logger.error(f"Исключение при получении ключа: {e}")
+            return None
+    
+    async def rename_key(self, key_id: str, name: str, timeout: float = None) -> bool:
+        """Переименовать ключ"""
+        try:
+            response = await self._request("PUT", f"/access-keys/{key_id}/name", timeout=timeout, json={"name": name})
+            
+            if response.status_code == 204:
+                return True
+            else:
+                logger.error(f"Ошибка переименования ключа {key_id}: {response.status_code}")
+                return False
+                
+        except Exception as e:
+            logger.error(f"Исключение при переименовании ключа: {e}")
+            return False
+    
+    async def update_key_limit(self, key_id: str, limit_gb: int, timeout: float = None) -> bool:
+        """Обновить лимит трафика для ключа"""
+        try:
+            payload = {"limit": {"bytes": limit_gb * 1024 * 1024 * 1024}}
+            response = await self._request("PUT", f"/access-keys/{key_id}", timeout=timeout, json=payload)
+            
+            if response.status_code == 204:
+                logger.info(f"Лимит обновлен для ключа {key_id}: {limit_gb}GB")
+                return True
+            else:
+                logger.error(f"Ошибка обновления лимита: {response.status_code}")
+                return False
+                
+        except Exception as e:
+            logger.error(f"Исключение при обновлении лимита: {e}")
+            return False
+    
+    async def remove_key_limit(self, key_id: str, timeout: float = None) -> bool:
+        """Снять лимит трафика с ключа"""
+        try:
+            response = await self._request("DELETE", f"/access-keys/{key_id}/data-limit", timeout=timeout)
+            
+            if response.status_code == 204:
+                logger.info(f"Лимит снят для ключа {key_id}")
+                return True
+            else:
+                logger.error(f"Ошибка снятия лимита: {response.status_code}")
+                return False
+                
+        except Exception as e:
+            logger.error(f"Исключение при снятии лимита: {e}")
+            return False
+    
+    async def get_transfer_metrics(self, timeout: float = None) -> Optional[Dict[str, int]]:
+        """Получить трафик по ключам: {key_id: bytes} за последние 30 дней"""
+        try:
+            response = await self._request("GET", "/metrics/transfer", timeout=timeout)
+            
+            if response.status_code == 200:
+                return response.json().get('bytesTransferredByUserId', {})
+            else:
+                logger.error(f"Ошибка получения метрик трафика: {response.status_code}")
+                return None
+                
+        except Exception as e:
+            logger.error(f"Исключение при получении метрик трафика: {e}")
+            return None
+    
+    async def get_server_info(self, timeout: float = None) -> Optional[Dict]:
+        """Получить информацию о сервере"""
+        try:
+            response = await self._request("GET", "/server", timeout=timeout)
+            
+            if response.status_code == 200:
+                return response.json()
+            else:
+                logger.error(f"Ошибка получения информации о сервере: {response.status_code}")
+                return None
+                
+        except Exception as e:
+            logger.error(f"Исключение при получении информации о сервере: {e}")
+            return None
+
+_outlines_api: Optional[OutlinesAPI] = None
+
+def get_outlines_api() -> OutlinesAPI:
+    """Глобальный синхронный клиент (создается при первом обращении, а не при импорте)"""
+    global _outlines_api
+    if _outlines_api is None:
+        _outlines_api = OutlinesAPI()
+    return _outlines_api
+
+def __getattr__(name):
+    # Совместимость со старым outlines_api.outlines_api
+    if name == "outlines_api":
+        return get_outlines_api()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def test_connection():
     """Тест подключения к Outline"""
     try:
+        outlines_api = get_outlines_api()
         info = outlines_api.get_server_info()
         if info:
             logger.info(f"✅ Подключение к Outline успешно!")
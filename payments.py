@@ -1,9 +1,14 @@
+import asyncio
 import uuid
 import logging
 from datetime import datetime
-from sqlalchemy.orm import Session
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
 import config
+import counters
 import database
+import ledger
+import queries
 
 logger = logging.getLogger(__name__)
 
@@ -27,13 +32,13 @@ def get_bot_link():
     bot_username = bot_token.split(':')[0]
     return f"https://t.me/{bot_username}"
 
-async def create_payment(db: Session, user_id: int, amount: float, tariff_id: str = None):
+async def create_payment(db: AsyncSession, user_id: int, amount: float, tariff_id: str = None):
     """
     Создать реальный платеж в ЮKassa
     Returns: {'payment_url': str, 'payment_id': str, 'status': str}
     """
     try:
-        user = db.query(database.User).filter(database.User.telegram_id == user_id).first()
+        user = await queries.get_user(db, user_id)
         if not user:
             logger.error(f"Пользователь {user_id} не найден")
             return None
@@ -47,8 +52,8 @@ async def create_payment(db: Session, user_id: int, amount: float, tariff_id: st
         # ✅ ИСПРАВЛЕНО: правильный return_url - ссылка на бота
         bot_link = get_bot_link()
         
-        # Создаем платеж в ЮKassa
-        payment = YooPayment.create({
+        # Создаем платеж в ЮKassa (SDK синхронный - в отдельном потоке)
+        payment = await asyncio.to_thread(YooPayment.create, {
             "amount": {
                 "value": f"{amount:.2f}",
                 "currency": "RUB"
@@ -79,7 +84,7 @@ async def create_payment(db: Session, user_id: int, amount: float, tariff_id: st
             created_at=datetime.utcnow()
         )
         db.add(db_payment)
-        db.commit()
+        await db.commit()
         
         # Сохраняем в сессии для быстрого доступа
         payment_sessions[user_id] = {
@@ -107,9 +112,10 @@ async def create_payment(db: Session, user_id: int, amount: float, tariff_id: st
         except:
             return None
 
-async def create_test_payment(db: Session, user_id: int, amount: float, tariff_id: str = None):
+async def create_test_payment(db: AsyncSession, user_id: int, amount: float, tariff_id: str = None):
     """Тестовый платеж (если ЮKassa не работает)"""
-    user = db.query(database.User).filter(database.User.telegram_id == user_id).first()
+    await db.rollback()  # сессия могла остаться в ошибке после неудачного create_payment
+    user = await queries.get_user(db, user_id)
     if not user:
         return None
     
@@ -126,8 +132,8 @@ async def create_test_payment(db: Session, user_id: int, amount: float, tariff_i
     db.add(db_payment)
     
     # Пополняем баланс
-    user.balance += amount
-    db.commit()
+    await ledger.credit(db, user.id, ledger.to_kopecks(amount), "topup", payment_id)
+    await db.commit()
     
     # Сохраняем в сессии
     payment_sessions[user_id] = {
@@ -146,34 +152,42 @@ async def create_test_payment(db: Session, user_id: int, amount: float, tariff_i
         "bot_link": get_bot_link()
     }
 
-async def check_payment_status(payment_id: str, db: Session, user_id: int = None):
+async def check_payment_status(payment_id: str, db: AsyncSession, user_id: int = None):
     """Проверить статус платежа в ЮKassa"""
     try:
         if config.Config.PAYMENT_PROVIDER == "yookassa" and YOOKASSA_AVAILABLE:
-            payment = YooPayment.find_one(payment_id)
+            payment = await asyncio.to_thread(YooPayment.find_one, payment_id)
             
             # Обновляем статус в БД
-            db_payment = db.query(database.Payment).filter(
-                database.Payment.payment_id == payment_id
-            ).first()
+            db_payment = await queries.get_payment(db, payment_id)
             
-            if db_payment:
-                old_status = db_payment.status
-                db_payment.status = payment.status
-                db_payment.updated_at = datetime.utcnow()
+            if db_payment and db_payment.status != payment.status:
+                # Статус меняется условным UPDATE: из параллельных проверок одного
+                # платежа переход в succeeded (и зачисление) выигрывает только одна
+                changed = await db.execute(
+                    update(database.Payment)
+                    .where(database.Payment.id == db_payment.id,
+                           database.Payment.status == db_payment.status,
+                           database.Payment.status != "succeeded")
+                    .values(status=payment.status)
+                )
+                if changed.rowcount:
+                    counters.add(db.sync_session, counters.payments(db_payment.status), -1)
+                    counters.add(db.sync_session, counters.payments(payment.status))
                 
                 # Если платеж успешен - пополняем баланс
-                if payment.status == "succeeded" and old_status != "succeeded":
-                    user = db.query(database.User).filter_by(id=db_payment.user_id).first()
-                    if user:
-                        user.balance += db_payment.amount
-                        logger.info(f"✅ Баланс пополнен для пользователя {user.telegram_id} на {db_payment.amount}₽")
+                if payment.status == "succeeded" and changed.rowcount:
+                    balance = await ledger.credit(db, db_payment.user_id, ledger.to_kopecks(db_payment.amount),
+                                                  "topup", payment_id)
+                    if balance is not None:
+                        logger.info(f"✅ Баланс пополнен по платежу {payment_id} на {db_payment.amount}₽")
                         
                         # Удаляем из сессии
-                        if user.telegram_id in payment_sessions:
-                            del payment_sessions[user.telegram_id]
+                        for telegram_id, session in list(payment_sessions.items()):
+                            if session['payment_id'] == payment_id:
+                                del payment_sessions[telegram_id]
                 
-                db.commit()
+                await db.commit()
             
             return {
                 "status": payment.status,
@@ -184,7 +198,7 @@ async def check_payment_status(payment_id: str, db: Session, user_id: int = None
             }
         else:
             # В тестовом режиме
-            payment = db.query(database.Payment).filter_by(payment_id=payment_id).first()
+            payment = await queries.get_payment(db, payment_id)
             if payment:
                 return {
                     "status": payment.status,
@@ -198,18 +212,15 @@ async def check_payment_status(payment_id: str, db: Session, user_id: int = None
         logger.error(f"Ошибка проверки статуса платежа {payment_id}: {e}")
         return None
 
-async def check_user_payments(user_id: int, db: Session):
+async def check_user_payments(user_id: int, db: AsyncSession):
     """Проверить все pending платежи пользователя"""
     try:
-        user = db.query(database.User).filter_by(telegram_id=user_id).first()
+        user = await queries.get_user(db, user_id)
         if not user:
             return []
         
         # Проверяем платежи в статусе pending
-        pending_payments = db.query(database.Payment).filter(
-            database.Payment.user_id == user.id,
-            database.Payment.status == "pending"
-        ).all()
+        pending_payments = await queries.pending_payments(db, user.id)
         
         results = []
         for payment in pending_payments:
@@ -232,7 +243,7 @@ def clear_payment_session(user_id: int):
     if user_id in payment_sessions:
         del payment_sessions[user_id]
 
-async def create_tariff_payment(db: Session, user_id: int, tariff_id: str):
+async def create_tariff_payment(db: AsyncSession, user_id: int, tariff_id: str):
     """Создать платеж для тарифа"""
     if tariff_id not in config.Config.TARIFFS:
         logger.error(f"Тариф {tariff_id} не найден")
@@ -246,19 +257,10 @@ async def create_tariff_payment(db: Session, user_id: int, tariff_id: str):
 # Тестовая функция
 async def test_payment():
     """Тест создания платежа"""
-    db = database.SessionLocal()
+    await asyncio.to_thread(database.init_db)
     
-    try:
-        test_user = db.query(database.User).filter_by(telegram_id=123456789).first()
-        if not test_user:
-            test_user = database.User(
-                telegram_id=123456789,
-                username="test_user",
-                full_name="Test User",
-                balance=0.0
-            )
-            db.add(test_user)
-            db.commit()
+    async with database.async_session() as db:
+        test_user = await queries.upsert_user(db, 123456789, "test_user", "Test User")
         
         result = await create_payment(db, test_user.telegram_id, 10.0)
         if result:
@@ -268,10 +270,6 @@ async def test_payment():
             print(f"   Payment URL: {result['payment_url']}")
         else:
             print("❌ Платеж не создан")
-            
-    finally:
-        db.close()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(test_payment())
@@ -0,0 +1,196 @@
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+
+import counters
+from database import UPSERT_INSERTS, Payment, Subscription, User, VPNKey
+
+logger = logging.getLogger(__name__)
+
+# Асинхронные запросы для обработчиков (AsyncSession из database.async_session)
+
+# ===== ПОЛЬЗОВАТЕЛИ =====
+
+async def get_user(db: AsyncSession, telegram_id: int) -> Optional[User]:
+    result = await db.execute(select(User).where(User.telegram_id == telegram_id))
+    return result.scalars().first()
+
+def user_upsert_statements(dialect_name: str, telegram_id: int, username: str = None,
+                           full_name: str = None, model=User):
+    """
+    (INSERT ... ON CONFLICT (telegram_id) DO NOTHING RETURNING *,
+     UPDATE ... WHERE имя изменилось RETURNING *).
+    Строку из INSERT возвращает только настоящая вставка - по ней и считаются
+    новые пользователи; строку, которую уже вставил параллельный апдейт, обновляет UPDATE.
+    Для неизменившейся строки RETURNING у UPDATE пуст.
+    """
+    insert = UPSERT_INSERTS[dialect_name](model).values(
+        telegram_id=telegram_id, username=username, full_name=full_name, balance=0.0
+    ).on_conflict_do_nothing(index_elements=[model.telegram_id]).returning(model)
+    rename = update(model).where(
+        model.telegram_id == telegram_id,
+        or_(model.username.is_distinct_from(username), model.full_name.is_distinct_from(full_name)),
+    ).values(username=username, full_name=full_name).returning(model)
+    return insert, rename
+
+def _unchanged(user, username, full_name) -> bool:
+    return user is not None and user.username == username and user.full_name == full_name
+
+async def upsert_user(db: AsyncSession, telegram_id: int, username: str = None,
+                      full_name: str = None) -> User:
+    """
+    Найти пользователя, создать нового или обновить имя - без гонки на unique(telegram_id).
+    Частый случай (пользователь есть, имя то же) - один SELECT без записи;
+    иначе INSERT ... ON CONFLICT DO NOTHING и/или UPDATE с RETURNING вместо INSERT + commit + refresh.
+    """
+    user = await get_user(db, telegram_id)
+    if _unchanged(user, username, full_name):
+        return user
+
+    dialect_name = db.get_bind().dialect.name
+    if dialect_name not in UPSERT_INSERTS:
+        if user is None:
+            user = User(telegram_id=telegram_id, balance=0.0)
+            db.add(user)
+        user.username, user.full_name = username, full_name
+        await db.commit()
+        return user
+
+    insert, rename = user_upsert_statements(dialect_name, telegram_id, username, full_name)
+    options = {"populate_existing": True}
+    if user is None:
+        inserted = (await db.scalars(insert, execution_options=options)).first()
+        if inserted is not None:
+            counters.add(db.sync_session, "users")
+            logger.info(f"Новый пользователь: {telegram_id}")
+            await db.commit()
+            return inserted
+    # Строка уже есть (или ее только что вставил параллельный апдейт) - обновляем имя
+    renamed = (await db.scalars(rename, execution_options=options)).first()
+    await db.commit()
+    if renamed is None:
+        # Параллельный апдейт уже записал те же данные
+        return await get_user(db, telegram_id)
+    return renamed
+
+def upsert_user_sync(db: Session, telegram_id: int, username: str = None,
+                     full_name: str = None, model=User):
+    """То же для синхронной сессии (vpn_bot_* скрипты со своими моделями)"""
+    user = db.query(model).filter(model.telegram_id == telegram_id).first()
+    if _unchanged(user, username, full_name):
+        return user
+
+    dialect_name = db.get_bind().dialect.name
+    if dialect_name not in UPSERT_INSERTS:
+        if user is None:
+            user = model(telegram_id=telegram_id, balance=0.0)
+            db.add(user)
+        user.username, user.full_name = username, full_name
+        db.commit()
+        return user
+
+    insert, rename = user_upsert_statements(dialect_name, telegram_id, username, full_name, model)
+    options = {"populate_existing": True}
+    if user is None:
+        inserted = db.scalars(insert, execution_options=options).first()
+        if inserted is not None:
+            counters.add(db, "users")
+            logger.info(f"Новый пользователь: {telegram_id}")
+            db.commit()
+            return inserted
+    renamed = db.scalars(rename, execution_options=options).first()
+    db.commit()
+    if renamed is None:
+        return db.query(model).filter(model.telegram_id == telegram_id).first()
+    return renamed
+
+# ===== КЛЮЧИ =====
+
+async def user_keys(db: AsyncSession, user_id: int) -> List[VPNKey]:
+    result = await db.execute(select(VPNKey).where(VPNKey.user_id == user_id))
+    return list(result.scalars())
+
+async def deactivate_user_keys(db: AsyncSession, user_id: int) -> List[Tuple[Optional[str], str]]:
+    """Деактивировать активные ключи пользователя; вернуть их [(server_id, key_id), ...]"""
+    result = await db.execute(
+        select(VPNKey.id, VPNKey.server_id, VPNKey.key_id).where(VPNKey.user_id == user_id, VPNKey.is_active == True)
+    )
+    rows = result.all()
+    if rows:
+        await db.execute(update(VPNKey).where(VPNKey.id.in_([row.id for row in rows])).values(is_active=False))
+    return [(row.server_id, row.key_id) for row in rows]
+
+# ===== ПОДПИСКИ =====
+
+async def expired_subscriptions(db: AsyncSession, now: datetime) -> List[Subscription]:
+    """Активные подписки с истекшим сроком вместе с пользователем (без ленивой загрузки)"""
+    result = await db.execute(
+        select(Subscription).options(joinedload(Subscription.user)).where(
+            Subscription.end_date < now,
+            Subscription.is_active == True
+        )
+    )
+    return list(result.scalars())
+
+# ===== ПЛАТЕЖИ =====
+
+async def get_payment(db: AsyncSession, payment_id: str) -> Optional[Payment]:
+    result = await db.execute(select(Payment).where(Payment.payment_id == payment_id))
+    return result.scalars().first()
+
+async def pending_payments(db: AsyncSession, user_id: int) -> List[Payment]:
+    result = await db.execute(select(Payment).where(Payment.user_id == user_id, Payment.status == "pending"))
+    return list(result.scalars())
+
+# ===== ПОСТРАНИЧНЫЙ ПРОСМОТР =====
+# Keyset-пагинация по первичному ключу, новые сверху: страница - это
+# WHERE id < курсор ORDER BY id DESC LIMIT n по индексу PK, поэтому 5000-я
+# страница стоит столько же, сколько первая. OFFSET читает и отбрасывает все
+# предыдущие строки, а COUNT(*) для числа страниц здесь не нужен.
+
+class Page:
+    """Строки страницы и курсоры соседних страниц (None - дальше строк нет)"""
+    __slots__ = ("items", "older", "newer")
+
+    def __init__(self, items: list, older: Optional[int] = None, newer: Optional[int] = None):
+        self.items = items
+        self.older = older  # id самой старой строки страницы - курсор следующей
+        self.newer = newer  # id самой новой строки - курсор предыдущей
+
+def page_statement(model, cursor: int = None, older: bool = True, limit: int = 10):
+    """older=True - строки старше курсора (следующая страница), False - новее (предыдущая)"""
+    stmt = select(model)
+    if older:
+        if cursor is not None:
+            stmt = stmt.where(model.id < cursor)
+        stmt = stmt.order_by(model.id.desc())
+    else:
+        stmt = stmt.where(model.id > cursor).order_by(model.id.asc())
+    # Лишняя строка показывает, есть ли что-то дальше
+    return stmt.limit(limit + 1)
+
+def build_page(rows: list, cursor: int = None, older: bool = True, limit: int = 10) -> Page:
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if older:
+        has_older, has_newer = more, cursor is not None
+    else:
+        rows.reverse()
+        has_older, has_newer = True, more
+    if not rows:
+        return Page([])
+    return Page(rows, rows[-1].id if has_older else None, rows[0].id if has_newer else None)
+
+async def page(db: AsyncSession, model, cursor: int = None, older: bool = True,
+               limit: int = 10, options=()) -> Page:
+    result = await db.execute(page_statement(model, cursor, older, limit).options(*options))
+    return build_page(list(result.scalars()), cursor, older, limit)
+
+def page_sync(db: Session, model, cursor: int = None, older: bool = True,
+              limit: int = 10, options=()) -> Page:
+    rows = db.scalars(page_statement(model, cursor, older, limit).options(*options)).all()
+    return build_page(list(rows), cursor, older, limit)
@@ -0,0 +1,47 @@
+import asyncio
+import random
+import time
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, запас до capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate  # <= 0 - без ограничения
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, tokens: float = 1) -> float:
+        """Сколько секунд ждать, пока накопится tokens (0 - можно сейчас)"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Взять токены без ожидания"""
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        """Дождаться и взять токены; ожидающие обслуживаются по очереди"""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep(self.delay(tokens))
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Экспоненциальная пауза перед повтором attempt (с 0) с полным джиттером"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import or_, update
+
+import config
+import database
+from outline_cluster import OutlineCluster, OutlineServer, get_cluster
+from outline_batch import OutlineBatch
+
+logger = logging.getLogger(__name__)
+
+DEMO_PREFIX = "demo_"   # демо-ключи существуют только в БД
+STREAM_CHUNK = 1000     # строк за одну выборку при потоковом чтении
+SAMPLE_SIZE = 10        # сколько id показывать в отчете
+CLAIM_GRACE = 3600      # секунд, пока выданный из пула ключ считается известным
+
+class ServerReport:
+    """Расхождения БД и одного сервера Outline"""
+
+    def __init__(self, server_id: str):
+        self.server_id = server_id
+        self.remote = 0       # ключей на сервере
+        self.local = 0        # активных ключей в БД (включая пул)
+        self.demo = 0         # демо-ключей, пропущенных при сверке
+        self.orphans: List[str] = []   # есть на сервере, в БД нет или ключ неактивен
+        self.ghosts: List[str] = []    # активны в БД, на сервере нет
+        self.pending: int = 0          # сироты первого обнаружения - ждут подтверждения
+        self.ghosts_pending: int = 0   # призраки первого обнаружения - ждут подтверждения
+        self.deleted = 0
+        self.deactivated = 0
+        self.error: Optional[str] = None
+
+    def lines(self) -> List[str]:
+        if self.error:
+            return [f"⛔ {self.server_id}: {self.error}"]
+        line = (f"🔄 {self.server_id}: на сервере {self.remote}, в БД {self.local}, "
+                f"сирот {len(self.orphans)} (+{self.pending} ждут), "
+                f"призраков {len(self.ghosts)} (+{self.ghosts_pending} ждут)")
+        if self.deleted or self.deactivated:
+            line += f", удалено {self.deleted}, деактивировано {self.deactivated}"
+        lines = [line]
+        if self.orphans:
+            lines.append(f"   сироты: {', '.join(self.orphans[:SAMPLE_SIZE])}")
+        if self.ghosts:
+            lines.append(f"   призраки: {', '.join(self.ghosts[:SAMPLE_SIZE])}")
+        return lines
+
+class Reconciler:
+    """
+    Сверка таблицы vpn_keys (и пула) с серверами Outline.
+    На каждый сервер - один запрос списка ключей и одно потоковое чтение БД;
+    сравнение через множества id, в памяти только id одного сервера.
+
+    Сироты (ключ на сервере, в БД его нет или он деактивирован) удаляются
+    пакетно, но только если были найдены и в прошлый запуск: ключ, созданный
+    прямо перед записью в БД, не будет удален посреди покупки.
+    Призраки (активный ключ в БД без ключа на сервере) деактивируются - тоже
+    только после двух запусков подряд. Снимок БД читается до списка ключей
+    сервера: ключ, созданный между двумя чтениями, попадет в сироты первого
+    обнаружения, а не в призраки.
+    """
+
+    def __init__(self, cluster: OutlineCluster = None, session_factory=None,
+                 fix: bool = None, max_delete: int = None, write_session_factory=None):
+        self._cluster = cluster
+        self._batch = OutlineBatch(cluster) if cluster is not None else None
+        self.session_factory = session_factory or database.SessionLocal  # потоковое чтение
+        # Записи - AsyncSession: в профиле production SQLite через единственного писателя
+        self.write_session_factory = write_session_factory or database.async_session
+        self.fix = fix if fix is not None else config.Config.RECONCILE_FIX
+        self.max_delete = max_delete if max_delete is not None else config.Config.RECONCILE_MAX_DELETE
+        self._suspects: Dict[str, Set[str]] = {}   # сироты прошлого запуска по серверам
+        self._ghost_suspects: Dict[str, Set[str]] = {}   # призраки прошлого запуска по серверам
+        self.last_reports: List[ServerReport] = []
+
+    @property
+    def cluster(self) -> OutlineCluster:
+        return self._cluster or get_cluster()
+
+    @property
+    def batch(self) -> OutlineBatch:
+        if self._batch is None:
+            self._batch = OutlineBatch(self.cluster)
+        return self._batch
+
+    async def run(self, fix: bool = None) -> List[ServerReport]:
+        """Сверить все серверы; fix=True - исправить расхождения"""
+        fix = self.fix if fix is None else fix
+        reports = []
+        for server in self.cluster.servers.values():
+            reports.append(await self.reconcile_server(server, fix))
+        self.last_reports = reports
+
+        orphans = sum(len(r.orphans) for r in reports)
+        ghosts = sum(len(r.ghosts) for r in reports)
+        if orphans or ghosts:
+            logger.warning(f"Сверка ключей: сирот {orphans}, призраков {ghosts}")
+        return reports
+
+    async def reconcile_server(self, server: OutlineServer, fix: bool) -> ServerReport:
+        report = ServerReport(server.id)
+        if not server.healthy:
+            report.error = "сервер недоступен, пропущен"
+            return report
+
+        db = self.session_factory()
+        try:
+            # Сначала снимок БД, потом список сервера: ключ, созданный и записанный
+            # в БД между ними, окажется только на сервере (сирота первого
+            # обнаружения), а не активным в БД без ключа на сервере.
+            # Синхронная сессия: потоковое чтение - в отдельном потоке, event loop не блокируется
+            active, pooled = await asyncio.to_thread(self._local_ids, db, server, report)
+            report.local = len(active) + len(pooled)
+
+            keys = await server.api.fetch_keys()
+            if keys is None:
+                report.error = "не удалось получить список ключей"
+                return report
+            remote = {str(k['id']) for k in keys}
+            del keys
+            report.remote = len(remote)
+
+            # Сироты: ключ на сервере, которого нет ни среди активных, ни в пуле
+            orphans = remote - active - pooled
+            confirmed = orphans & self._suspects.get(server.id, set())
+            self._suspects[server.id] = orphans
+            report.orphans = sorted(confirmed)
+            report.pending = len(orphans) - len(confirmed)
+
+            # Призраки: активный ключ в БД, которого нет на сервере
+            # (ключи пула не проверяем: их жизненным циклом управляет пул)
+            ghosts = active - remote
+            confirmed = ghosts & self._ghost_suspects.get(server.id, set())
+            self._ghost_suspects[server.id] = ghosts
+            report.ghosts = sorted(confirmed)
+            report.ghosts_pending = len(ghosts) - len(confirmed)
+
+            if fix:
+                await self._delete_orphans(server, report)
+                report.deactivated = await self._deactivate_ghosts(server, report.ghosts)
+                # Удаленных и деактивированных не нужно подтверждать повторно
+                self._suspects[server.id] -= set(report.orphans)
+                self._ghost_suspects[server.id] -= set(report.ghosts)
+        finally:
+            db.close()
+        return report
+
+    def _server_filter(self, column, server: OutlineServer):
+        """Ключи старых записей без server_id относятся к серверу по умолчанию"""
+        if server.id == self.cluster.default_id:
+            return or_(column == server.id, column.is_(None))
+        return column == server.id
+
+    def _local_ids(self, db, server: OutlineServer, report: ServerReport):
+        """Потоком читаем id активных ключей сервера из vpn_keys и id ключей пула"""
+        active: Set[str] = set()
+        pooled: Set[str] = set()
+
+        rows = db.query(database.VPNKey.key_id, database.VPNKey.is_active).filter(
+            self._server_filter(database.VPNKey.server_id, server)
+        ).yield_per(STREAM_CHUNK)
+        for key_id, is_active in rows:
+            if not key_id:
+                continue
+            if key_id.startswith(DEMO_PREFIX):
+                report.demo += 1
+            elif is_active:
+                active.add(key_id)
+
+        # Ключи пула: свободные и только что выданные (запись в vpn_keys могла еще не появиться)
+        claimed_since = datetime.utcnow() - timedelta(seconds=CLAIM_GRACE)
+        rows = db.query(database.PooledKey.key_id).filter(
+            database.PooledKey.server_id == server.id,
+            or_(database.PooledKey.claimed_at.is_(None), database.PooledKey.claimed_at > claimed_since)
+        ).yield_per(STREAM_CHUNK)
+        for (key_id,) in rows:
+            pooled.add(key_id)
+        return active, pooled
+
+    async def _delete_orphans(self, server: OutlineServer, report: ServerReport):
+        orphans = report.orphans
+        if not orphans:
+            return
+        if len(orphans) > self.max_delete:
+            logger.error(f"Сверка {server.id}: {len(orphans)} сирот больше лимита "
+                         f"{self.max_delete}, удаление пропущено")
+            return
+        results = await self.batch.delete_keys([(server.id, key_id) for key_id in orphans])
+        report.deleted = sum(1 for r in results if r.ok)
+        logger.info(f"Сверка {server.id}: удалено сирот {report.deleted} из {len(orphans)}")
+
+    async def _deactivate_ghosts(self, server: OutlineServer, ghosts: List[str]) -> int:
+        deactivated = 0
+        async with self.write_session_factory() as db:
+            for start in range(0, len(ghosts), STREAM_CHUNK):
+                chunk = ghosts[start:start + STREAM_CHUNK]
+                result = await db.execute(update(database.VPNKey).where(
+                    self._server_filter(database.VPNKey.server_id, server),
+                    database.VPNKey.key_id.in_(chunk),
+                    database.VPNKey.is_active == True
+                ).values(is_active=False).execution_options(synchronize_session=False))
+                deactivated += result.rowcount
+            await db.commit()
+        if deactivated:
+            logger.info(f"Сверка {server.id}: деактивировано призраков {deactivated}")
+        return deactivated
+
+    def report_lines(self) -> List[str]:
+        """Строки последнего отчета для админ-панели"""
+        lines = []
+        for report in self.last_reports:
+            lines.extend(report.lines())
+        return lines
+
+_reconciler: Optional[Reconciler] = None
+
+def get_reconciler() -> Reconciler:
+    """Общий сверщик ключей (создается при первом обращении)"""
+    global _reconciler
+    if _reconciler is None:
+        _reconciler = Reconciler()
+    return _reconciler
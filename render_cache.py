@@ -0,0 +1,123 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from telegram.error import BadRequest
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class RenderCache:
+    """
+    Последний отрисованный экран каждого сообщения бота: (chat_id, message_id) ->
+    хэш текста, parse_mode и разметки. Повторное нажатие той же кнопки
+    (главное меню, баланс) дает тот же экран - такая правка не уходит в
+    Bot API: Telegram все равно ответил бы "message is not modified", а
+    запрос занял бы round trip и место в лимите отправки.
+    Пользователь не может править сообщения бота, поэтому запись меняется
+    только нашими же правками; после неудачной правки она сбрасывается.
+    """
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or config.Config.RENDER_CACHE_SIZE
+        self._items: "OrderedDict[Tuple[int, int], bytes]" = OrderedDict()
+
+        # Метрики
+        self.hits = 0           # правок пропущено - вызовов Bot API сэкономлено
+        self.misses = 0         # экран изменился или неизвестен - правка отправлена
+        self.not_modified = 0   # Telegram ответил "not modified" (экран был отрисован до запуска)
+        self.evictions = 0      # вытеснено по размеру (LRU)
+
+    @staticmethod
+    def digest(text: str, parse_mode=None, reply_markup=None, **options) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(text.encode())
+        h.update(f"\0{parse_mode}\0{sorted(options.items())}\0".encode())
+        # Поля кнопок напрямую: to_json() разметки в десятки раз дороже
+        for row in getattr(reply_markup, "inline_keyboard", ()):
+            for button in row:
+                h.update(f"\1{button.text}\0{button.callback_data}\0{button.url}".encode())
+            h.update(b"\2")
+        if reply_markup is not None and not hasattr(reply_markup, "inline_keyboard"):
+            h.update(reply_markup.to_json().encode())
+        return h.digest()
+
+    def is_same(self, key: Tuple[int, int], digest: bytes) -> bool:
+        if self._items.get(key) == digest:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def put(self, key: Tuple[int, int], digest: bytes):
+        self._items[key] = digest
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def forget(self, key: Tuple[int, int]):
+        self._items.pop(key, None)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def metrics(self) -> Dict:
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+        }
+
+    def report_lines(self) -> List[str]:
+        """Строки для админ-панели"""
+        return [f"🪞 Повторные экраны: пропущено правок {self.hits} ({self.hit_rate:.0%}), "
+                f"\"not modified\" от Telegram {self.not_modified}"]
+
+_cache: Optional[RenderCache] = None
+
+def get_cache() -> RenderCache:
+    """Общий кэш отрисованных экранов (создается при первом обращении)"""
+    global _cache
+    if _cache is None:
+        _cache = RenderCache()
+    return _cache
+
+async def edit(query, text: str, reply_markup=None, parse_mode=None, **options):
+    """
+    query.edit_message_text, который не отправляет правку, если сообщение уже
+    показывает ровно этот экран. На callback_query к этому моменту уже ответили
+    (button_handler), так что клиент не ждет.
+    """
+    message = query.message
+    if message is None:  # сообщение недоступно (слишком старое) - без кэша
+        return await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **options)
+
+    cache = get_cache()
+    key = (message.chat_id, message.message_id)
+    digest = cache.digest(text, parse_mode, reply_markup, **options)
+    if cache.is_same(key, digest):
+        return message
+
+    try:
+        result = await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **options)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            cache.forget(key)
+            raise
+        # Экран уже такой (отрисован до перезапуска) - запоминаем, ошибки нет
+        cache.not_modified += 1
+        result = message
+    except Exception:
+        cache.forget(key)
+        raise
+    cache.put(key, digest)
+    return result
@@ -0,0 +1,197 @@
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import callback_codec
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы задержек, мс (последняя корзина - все, что дольше)
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+class Route:
+    """Маршрут callback_data: обработчик, разбор аргументов и метрики"""
+
+    def __init__(self, name: str, handler: Callable, types: Sequence[Callable] = (), sep: str = "_"):
+        self.name = name
+        self.handler = handler
+        self.types = tuple(types)
+        self.sep = sep
+
+        # Метрики
+        self.calls = 0
+        self.errors = 0          # исключений в обработчике
+        self.bad_args = 0        # callback_data с нечитаемыми аргументами
+        self.total_time = 0.0    # секунд
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def parse(self, rest: str) -> Optional[tuple]:
+        """Остаток callback_data -> аргументы по типам маршрута; None - не разобрать"""
+        if not self.types:
+            return () if not rest else None
+        parts = rest.split(self.sep, len(self.types) - 1)
+        if len(parts) != len(self.types):
+            return None
+        try:
+            return tuple(convert(part) for convert, part in zip(self.types, parts))
+        except (ValueError, KeyError):
+            return None
+
+    def observe(self, elapsed: float):
+        self.calls += 1
+        self.total_time += elapsed
+        self.histogram[bisect_left(LATENCY_BUCKETS, elapsed * 1000)] += 1
+
+    def percentile(self, p: float) -> float:
+        """Верхняя граница корзины, в которую попадает p-й процентиль, мс"""
+        if not self.calls:
+            return 0.0
+        rank = p / 100 * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.histogram):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def metrics(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bad_args": self.bad_args,
+            "avg_ms": self.total_time / self.calls * 1000 if self.calls else 0.0,
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+            "histogram": dict(zip([f"<={b}" for b in LATENCY_BUCKETS] + ["inf"], self.histogram)),
+        }
+
+class CallbackRouter:
+    """
+    Таблица маршрутов для inline-кнопок вместо цепочки if/elif.
+    Точные значения ищутся в словаре, префиксы - в префиксном дереве
+    (побеждает самый длинный совпавший префикс, так что admin_user_ и
+    admin_users_ не мешают друг другу). Стоимость поиска зависит от длины
+    callback_data, а не от числа маршрутов.
+
+    Упакованные callback_data (callback_codec) находятся по id маршрута
+    одним поиском в словаре.
+
+    Обработчик вызывается как handler(*args, *разобранные_аргументы), где
+    args - то, что передано в dispatch (query, user_id, сессия...).
+    """
+
+    def __init__(self, name: str = "callbacks"):
+        self.name = name
+        self._exact: Dict[str, Route] = {}
+        self._trie: Dict = {}     # символ -> поддерево; ключ None - маршрут префикса
+        self._packed: Dict[int, Tuple[Route, callback_codec.Spec]] = {}
+        self.routes: List[Route] = []
+        self.unknown = 0          # callback_data без маршрута
+
+    def exact(self, data: str):
+        """Декоратор: маршрут для callback_data == data"""
+        def register(handler):
+            self._exact[data] = self._add(Route(data, handler))
+            return handler
+        return register
+
+    def prefix(self, prefix: str, *types: Callable, sep: str = "_"):
+        """Декоратор: маршрут для callback_data, начинающихся с prefix; остаток разбирается по types"""
+        def register(handler):
+            node = self._trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = self._add(Route(f"{prefix}*", handler, types, sep))
+            return handler
+        return register
+
+    def packed(self, spec: callback_codec.Spec):
+        """Декоратор: маршрут для кнопок spec.pack(...); аргументы - по полям spec"""
+        def register(handler):
+            if spec.route_id in self._packed:
+                raise ValueError(f"id маршрута {spec.route_id} уже занят: {self._packed[spec.route_id][1].name}")
+            self._packed[spec.route_id] = (self._add(Route(spec.name, handler)), spec)
+            return handler
+        return register
+
+    def _add(self, route: Route) -> Route:
+        self.routes.append(route)
+        return route
+
+    def resolve(self, data: str) -> Tuple[Optional[Route], tuple]:
+        """callback_data -> (маршрут, аргументы); (None, ()) - нет маршрута или аргументы не разобраны"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, ()
+        if callback_codec.is_packed(data):
+            return self._resolve_packed(data)
+
+        best, best_length = None, 0
+        node = self._trie
+        for length, char in enumerate(data, 1):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                best, best_length = node[None], length
+        if best is None:
+            return None, ()
+
+        args = best.parse(data[best_length:])
+        if args is None:
+            best.bad_args += 1
+            logger.warning(f"Не разобраны аргументы callback_data: {data}")
+            return None, ()
+        return best, args
+
+    def _resolve_packed(self, data: str) -> Tuple[Optional[Route], tuple]:
+        try:
+            route_id, payload, pos = callback_codec.decode(data)
+        except ValueError:
+            logger.warning(f"Не разобрана упакованная callback_data: {data}")
+            return None, ()
+        entry = self._packed.get(route_id)
+        if entry is None:
+            return None, ()
+        route, spec = entry
+        try:
+            return route, spec.unpack(payload, pos)
+        except ValueError:
+            route.bad_args += 1
+            logger.warning(f"Не разобраны аргументы callback_data: {data}")
+            return None, ()
+
+    async def dispatch(self, data: str, *args) -> bool:
+        """Выполнить маршрут для data; False - маршрута нет (вызывающий решает, что ответить)"""
+        route, parsed = self.resolve(data or "")
+        if route is None:
+            self.unknown += 1
+            return False
+
+        started = time.perf_counter()
+        try:
+            await route.handler(*args, *parsed)
+        except Exception:
+            route.errors += 1
+            raise
+        finally:
+            route.observe(time.perf_counter() - started)
+        return True
+
+    def metrics(self) -> Dict:
+        return {
+            "unknown": self.unknown,
+            "routes": {route.name: route.metrics() for route in self.routes},
+        }
+
+    def report(self, top: int = 5) -> List[str]:
+        """Строки для админ-панели: самые медленные маршруты по p99"""
+        used = [route for route in self.routes if route.calls]
+        used.sort(key=lambda route: (route.percentile(99), route.total_time), reverse=True)
+        lines = [f"• {route.name}: {route.calls} вызовов, ср. {route.metrics()['avg_ms']:.0f} мс, "
+                 f"p99 ≤ {route.percentile(99):g} мс, ошибок {route.errors}"
+                 for route in used[:top]]
+        if self.unknown:
+            lines.append(f"• неизвестных callback: {self.unknown}")
+        return lines
@@ -0,0 +1,105 @@
+"""
+Проверка журнала баланса (ledger.py) на SQLite в памяти.
+
+Без бота и без bot.db: своя база на одно соединение, таблицы из моделей.
+Запуск: python test_ledger.py
+"""
+import sys
+sys.path.append('.')
+import logging
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import database
+import ledger
+
+
+def new_session():
+    """Чистая база в памяти и пользователь с нулевым балансом"""
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    database.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    user = database.User(telegram_id=1001, username="ledger_test", balance=0.0, balance_kopecks=0)
+    db.add(user)
+    db.commit()
+    return db, user
+
+
+def stored(db, user_id):
+    """(balance_kopecks, balance) прямо из таблицы users"""
+    return db.query(database.User.balance_kopecks, database.User.balance).filter(
+        database.User.id == user_id).one()
+
+
+def test_insufficient_funds():
+    db, user = new_session()
+    assert ledger.credit_sync(db, user.id, 5000, "deposit", "pay-1") == 5000
+    db.commit()
+
+    # Списание больше баланса не находит строку: баланс и журнал не меняются
+    assert ledger.debit_sync(db, user.id, 5001, "purchase", ledger.operation_id("month")) is None
+    db.commit()
+    assert stored(db, user.id) == (5000, 50.0)
+    assert db.query(func.count(database.LedgerEntry.id)).scalar() == 1
+
+    # Ровно на весь баланс - можно
+    assert ledger.debit_sync(db, user.id, 5000, "purchase", ledger.operation_id("month")) == 0
+    db.commit()
+    assert stored(db, user.id) == (0, 0.0)
+    db.close()
+
+
+def test_double_charge_guard():
+    db, user = new_session()
+    assert ledger.credit_sync(db, user.id, 10000, "deposit", "pay-2") == 10000
+    db.commit()
+
+    # Повторное зачисление того же платежа: UNIQUE(reason, reference) отменяет всю транзакцию
+    try:
+        ledger.credit_sync(db, user.id, 10000, "deposit", "pay-2")
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+    else:
+        raise AssertionError("повторное зачисление pay-2 прошло")
+    assert stored(db, user.id) == (10000, 100.0)
+
+    # Та же ссылка с другой причиной - другая операция
+    assert ledger.debit_sync(db, user.id, 2500, "refund", "pay-2") == 7500
+    db.commit()
+    assert db.query(func.count(database.LedgerEntry.id)).scalar() == 2
+    db.close()
+
+
+def test_kopecks_and_balance_in_sync():
+    db, user = new_session()
+    # 0.1 + 0.2 в float - не 0.3; в копейках - ровно 30
+    for rubles in (0.1, 0.2):
+        ledger.credit_sync(db, user.id, ledger.to_kopecks(rubles), "deposit", ledger.operation_id("manual"))
+    db.commit()
+    assert stored(db, user.id) == (30, 0.3)
+    assert ledger.to_kopecks("199.995") == 20000
+    assert ledger.format_rub(12345) == "123.45"
+
+    # Загруженный объект получает новый баланс без перечитывания
+    balance = ledger.debit_sync(db, user.id, 15, "purchase", ledger.operation_id("day"))
+    assert balance == 15
+    assert user.balance_kopecks == 15 and user.balance == 0.15
+    db.commit()
+    assert stored(db, user.id) == (15, 0.15)
+
+    # balance_after в журнале совпадает с балансом после каждой операции
+    after = [row.balance_after for row in db.query(database.LedgerEntry).order_by(database.LedgerEntry.id)]
+    assert after == [10, 30, 15]
+    db.close()
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    print("🧪 Тест журнала баланса:")
+    for check in (test_insufficient_funds, test_double_charge_guard, test_kopecks_and_balance_in_sync):
+        check()
+        print(f"✅ {check.__name__}")
@@ -1,7 +1,10 @@
+import os
 import requests
 import json
 
-API_URL = "https://45.135.182.168:4751/XTx2Eq4Mc4yQxm6nIBEpLw"
+# Для проверки без боевого сервера: python fake_outline_server.py и
+# OUTLINE_TEST_URL=http://127.0.0.1:8081/fake python test_outline_api.py
+API_URL = os.getenv("OUTLINE_TEST_URL", "https://45.135.182.168:4751/XTx2Eq4Mc4yQxm6nIBEpLw")
 
 print("🔧 Тестирование Outline API")
 print("=" * 50)
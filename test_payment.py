@@ -8,6 +8,7 @@ print("🧪 Тест платежной системы:")
 print(f"ЮKassa Shop ID: {config.Config.YOOKASSA_SHOP_ID}")
 
 # Проверка БД
+database.init_db()
 db = database.SessionLocal()
 try:
     # Проверяем таблицы
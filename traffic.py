@@ -0,0 +1,194 @@
+import asyncio
+import logging
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+
+import database
+from outline_cluster import OutlineCluster, get_cluster
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_PER_DAY = 24  # почасовые счетчики
+STORE_CHUNK = 500     # ключей в одном IN (...) при чтении traffic_totals
+
+def empty_buckets() -> bytes:
+    return array('Q', [0] * BUCKETS_PER_DAY).tobytes()
+
+def unpack_buckets(blob: bytes) -> array:
+    """BLOB суток -> array('Q') из 24 счетчиков байт"""
+    buckets = array('Q')
+    buckets.frombytes(blob)
+    return buckets
+
+def format_bytes(value: int) -> str:
+    return f"{value / 1024 ** 3:.2f} ГБ"
+
+class TrafficCollector:
+    """
+    Сбор трафика по ключам: один запрос /metrics/transfer на сервер.
+    Outline отдает накопленные байты, в базу пишутся приращения
+    в почасовые счетчики (одна строка на ключ в сутки). Последние
+    накопленные значения хранятся в traffic_totals в той же транзакции:
+    после перезапуска первое приращение считается от них, а трафик
+    между последним сбором и перезапуском не теряется.
+    """
+
+    def __init__(self, cluster: OutlineCluster = None, session_factory=None):
+        self._cluster = cluster
+        self.session_factory = session_factory or database.async_session  # AsyncSession: единственный писатель SQLite
+        self._last_totals: Dict[Tuple[str, str], int] = {}
+        self._seen_servers = set()
+        self.runs = 0
+        self.collected_at: Optional[datetime] = None
+
+    @property
+    def cluster(self) -> OutlineCluster:
+        return self._cluster or get_cluster()
+
+    async def collect(self):
+        """Собрать метрики со всех серверов и записать приращения"""
+        servers = [s for s in self.cluster.servers.values() if s.healthy]
+        metrics = await asyncio.gather(*(s.api.get_transfer_metrics() for s in servers))
+        now = datetime.utcnow()
+
+        for server, transfer in zip(servers, metrics):
+            if transfer is None:
+                continue
+            if server.id not in self._seen_servers:
+                await self._load_totals(server.id)
+            deltas, changed = self._deltas(server.id, transfer)
+            if not changed:
+                self._seen_servers.add(server.id)
+            elif await self._store(server.id, deltas, changed, now):
+                # Память - только после commit: при ошибке приращения посчитаются в следующий раз
+                self._last_totals.update(((server.id, key_id), total) for key_id, total in changed.items())
+                self._seen_servers.add(server.id)
+
+        self.runs += 1
+        self.collected_at = now
+
+    async def _load_totals(self, server_id: str):
+        """Последние сохраненные счетчики сервера; если они есть - сервер уже собирали"""
+        async with self.session_factory() as db:
+            result = await db.execute(select(database.TrafficTotal.key_id, database.TrafficTotal.total)
+                                      .where(database.TrafficTotal.server_id == server_id))
+            rows = result.all()
+        for key_id, total in rows:
+            self._last_totals[(server_id, key_id)] = total
+        if rows:
+            self._seen_servers.add(server_id)
+
+    def _deltas(self, server_id: str, transfer: Dict[str, int]) -> Tuple[Dict[str, int], Dict[str, int]]:
+        """
+        (приращения с прошлого сбора, изменившиеся накопленные счетчики).
+        Самый первый сбор сервера (и в памяти, и в traffic_totals пусто) только запоминает базу.
+        """
+        first_run = server_id not in self._seen_servers
+
+        deltas = {}
+        changed = {}
+        for key_id, total in transfer.items():
+            previous = self._last_totals.get((server_id, key_id))
+            if previous != total:
+                changed[key_id] = total
+            if previous is None:
+                # Ключ появился после прошлого сбора - весь его трафик новый
+                previous = total if first_run else 0
+            # Outline считает за скользящие 30 дней - сумма может уменьшиться
+            if total > previous:
+                deltas[key_id] = total - previous
+        return deltas, changed
+
+    async def _store(self, server_id: str, deltas: Dict[str, int], changed: Dict[str, int],
+                     now: datetime) -> bool:
+        """Приращения и новые накопленные счетчики - одной транзакцией; True - записано"""
+        day = now.date()
+        hour = now.hour
+        async with self.session_factory() as db:
+            try:
+                rows = {}
+                if deltas:
+                    result = await db.scalars(select(database.TrafficDay).where(
+                        database.TrafficDay.server_id == server_id,
+                        database.TrafficDay.day == day,
+                        database.TrafficDay.key_id.in_(list(deltas))
+                    ))
+                    rows = {row.key_id: row for row in result}
+                for key_id, delta in deltas.items():
+                    row = rows.get(key_id)
+                    if row is None:
+                        row = database.TrafficDay(server_id=server_id, key_id=key_id, day=day,
+                                                  buckets=empty_buckets(), total=0)
+                        db.add(row)
+                    buckets = unpack_buckets(row.buckets)
+                    buckets[hour] += delta
+                    row.buckets = buckets.tobytes()
+                    row.total += delta
+
+                totals = {}
+                keys = list(changed)
+                for start in range(0, len(keys), STORE_CHUNK):
+                    result = await db.scalars(select(database.TrafficTotal).where(
+                        database.TrafficTotal.server_id == server_id,
+                        database.TrafficTotal.key_id.in_(keys[start:start + STORE_CHUNK])
+                    ))
+                    totals.update((row.key_id, row) for row in result)
+                for key_id, total in changed.items():
+                    row = totals.get(key_id)
+                    if row is None:
+                        db.add(database.TrafficTotal(server_id=server_id, key_id=key_id, total=total, updated_at=now))
+                    else:
+                        row.total, row.updated_at = total, now
+                await db.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка записи трафика сервера {server_id}: {e}")
+                await db.rollback()
+                return False
+
+# ===== ЧТЕНИЕ (только БД, без Outline; AsyncSession) =====
+
+async def key_usage(db, server_id: Optional[str], key_id: str, days: int = 30) -> int:
+    """Трафик ключа за последние days суток, байт (server_id=None - старый ключ сервера по умолчанию)"""
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    # Сборщик пишет настоящий id сервера: ключи старых записей без server_id
+    # считаем ключами сервера по умолчанию, как сверка (reconcile._server_filter)
+    result = await db.execute(select(func.coalesce(func.sum(database.TrafficDay.total), 0)).where(
+        database.TrafficDay.server_id == (server_id or get_cluster().default_id),
+        database.TrafficDay.key_id == key_id,
+        database.TrafficDay.day >= since
+    ))
+    return result.scalar()
+
+async def hourly_usage(db, server_id: str, key_id: str, day=None) -> array:
+    """Почасовой трафик ключа за сутки (по умолчанию - сегодня)"""
+    result = await db.execute(select(database.TrafficDay.buckets).where(
+        database.TrafficDay.server_id == server_id,
+        database.TrafficDay.key_id == key_id,
+        database.TrafficDay.day == (day or datetime.utcnow().date())
+    ))
+    blob = result.scalar()
+    return unpack_buckets(blob if blob is not None else empty_buckets())
+
+async def top_consumers(db, days: int = 1, limit: int = 10) -> List[Tuple[str, str, int]]:
+    """Ключи с наибольшим трафиком: [(server_id, key_id, bytes), ...]"""
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    used = func.sum(database.TrafficDay.total)
+    result = await db.execute(
+        select(database.TrafficDay.server_id, database.TrafficDay.key_id, used).where(
+            database.TrafficDay.day >= since
+        ).group_by(database.TrafficDay.server_id, database.TrafficDay.key_id).order_by(used.desc()).limit(limit)
+    )
+    return [tuple(row) for row in result]
+
+_collector: Optional[TrafficCollector] = None
+
+def get_collector() -> TrafficCollector:
+    """Общий сборщик трафика (создается при первом обращении)"""
+    global _collector
+    if _collector is None:
+        _collector = TrafficCollector()
+    return _collector
@@ -0,0 +1,140 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+import config
+import database
+import queries
+
+logger = logging.getLogger(__name__)
+
+class UserSnapshot:
+    """То, что нужно экранам навигации: без ORM-состояния и ленивых связей"""
+    __slots__ = ("id", "telegram_id", "balance", "trial_used", "expires_at")
+
+    def __init__(self, user: database.User, expires_at: float):
+        self.id = user.id
+        self.telegram_id = user.telegram_id
+        self.balance = user.balance
+        self.trial_used = user.trial_used
+        self.expires_at = expires_at
+
+class UserCache:
+    """
+    LRU-кэш снимков пользователей по telegram_id с TTL.
+    Изменения User через ORM сбрасывают запись после commit (см. события ниже);
+    TTL ограничивает устаревание, если строку поменял другой процесс.
+    """
+
+    def __init__(self, max_size: int = None, ttl: float = None):
+        self.max_size = max_size or config.Config.USER_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else config.Config.USER_CACHE_TTL
+        self._items: "OrderedDict[int, UserSnapshot]" = OrderedDict()
+
+        # Метрики
+        self.hits = 0           # запросов к БД сэкономлено
+        self.misses = 0         # снимка не было - читали из БД
+        self.expired = 0        # снимок устарел по TTL
+        self.evictions = 0      # вытеснено по размеру (LRU)
+        self.invalidations = 0  # сброшено после изменения пользователя
+
+    def get(self, telegram_id: int) -> Optional[UserSnapshot]:
+        snapshot = self._items.get(telegram_id)
+        if snapshot is not None and snapshot.expires_at <= time.monotonic():
+            del self._items[telegram_id]
+            self.expired += 1
+            snapshot = None
+        if snapshot is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(telegram_id)
+        self.hits += 1
+        return snapshot
+
+    def put(self, user: database.User) -> UserSnapshot:
+        snapshot = UserSnapshot(user, time.monotonic() + self.ttl)
+        self._items[user.telegram_id] = snapshot
+        self._items.move_to_end(user.telegram_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+        return snapshot
+
+    def invalidate(self, telegram_id: int):
+        if self._items.pop(telegram_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._items)
+        self._items.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def metrics(self) -> Dict:
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+_cache: Optional[UserCache] = None
+
+def get_cache() -> UserCache:
+    """Общий кэш пользователей (создается при первом обращении)"""
+    global _cache
+    if _cache is None:
+        _cache = UserCache()
+    return _cache
+
+async def get_user_snapshot(telegram_id: int) -> Optional[UserSnapshot]:
+    """Снимок пользователя из кэша; при промахе - один SELECT и запись в кэш"""
+    cache = get_cache()
+    snapshot = cache.get(telegram_id)
+    if snapshot is not None:
+        return snapshot
+    async with database.async_session() as db:
+        user = await queries.get_user(db, telegram_id)
+    return cache.put(user) if user else None
+
+# ===== СБРОС ПРИ ИЗМЕНЕНИЯХ =====
+# Пробный период и правки админа меняют User через ORM, баланс - ledger.py:
+# собираем telegram_id измененных строк при flush и сбрасываем их после commit,
+# чтобы параллельный запрос не положил в кэш еще не зафиксированное значение.
+
+def mark_changed(session: Session, telegram_id: int):
+    """Сбросить снимок после commit - для изменений в обход ORM (UPDATE в ledger.py)"""
+    session.info.setdefault("changed_users", set()).add(telegram_id)
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    changed = session.info.setdefault("changed_users", set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, database.User):
+            # Без ленивой загрузки: в async-сессии она недоступна
+            changed.add(inspect(obj).dict.get("telegram_id"))
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+    changed = session.info.pop("changed_users", None)
+    if not changed or _cache is None:
+        return
+    if None in changed:
+        _cache.clear()
+        return
+    for telegram_id in changed:
+        _cache.invalidate(telegram_id)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_users", None)
@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import logging
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -5,9 +7,20 @@ import config
 import random
 import string
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey, func
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, joinedload
+from db_session import SessionScope
+from router import CallbackRouter
+from keyboards import KeyboardCatalog
+from callback_codec import STR, UINT, Spec
+import database
+import counters
+import keyboards
+import ledger
+import queries
+import render_cache
+import outbox
 
 # ===== НАСТРОЙКИ ИЗ CONFIG =====
 ADMIN_IDS = config.Config.ADMIN_IDS
@@ -63,35 +76,31 @@ class VPNKey(Base):
 
 # Подключаемся к БД
 engine = create_engine(config.Config.DATABASE_URL, echo=False)
-Base.metadata.create_all(engine)
 SessionLocal = sessionmaker(bind=engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Одна сессия на апдейт: коммит или откат, соединение всегда возвращается в пул
+db_scope = SessionScope(SessionLocal)
 
 # ===== ФУНКЦИИ =====
 def is_admin(user_id):
     return user_id in ADMIN_IDS
 
-def main_menu(user_id):
+def _build_main_menu(admin, trial_used, locale):
     keyboard = [
         [InlineKeyboardButton("💰 Пополнить баланс", callback_data="deposit")],
         [InlineKeyboardButton("📊 Мой баланс", callback_data="balance")],
         [InlineKeyboardButton("🔑 Мои ключи", callback_data="keys")],
         [InlineKeyboardButton("🛒 Купить тариф", callback_data="tariffs")],
     ]
-    if is_admin(user_id):
+    if admin:
         keyboard.append([InlineKeyboardButton("👑 Админ-панель", callback_data="admin_panel")])
     return InlineKeyboardMarkup(keyboard)
 
-def admin_menu():
-    keyboard = [
+def _build_admin_menu(admin, trial_used, locale, nav=None):
+    keyboard = [nav] if nav else []  # ряд листания списка
+    keyboard += [
         [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users_0")],
+        [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")],
         [InlineKeyboardButton("💳 Платежи", callback_data="admin_payments")],
         [InlineKeyboardButton("🔑 Ключи", callback_data="admin_keys")],
         [InlineKeyboardButton("➕ Добавить баланс", callback_data="admin_add_balance")],
@@ -99,14 +108,18 @@ def admin_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# Меню строятся один раз на вариант и переиспользуются (см. keyboards.KeyboardCatalog)
+menus = KeyboardCatalog({"main": _build_main_menu, "admin": _build_admin_menu})
+
+def main_menu(user_id):
+    return menus.get("main", is_admin(user_id))
+
+def admin_menu(nav=None):
+    # С рядом листания разметка своя на каждую страницу
+    return _build_admin_menu(True, False, None, nav) if nav else menus.get("admin", True)
+
 def get_or_create_user(db, telegram_id, username, full_name):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        user = User(telegram_id=telegram_id, username=username, full_name=full_name)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    return user
+    return queries.upsert_user_sync(db, telegram_id, username, full_name, model=User)
 
 def generate_vpn_key(name):
     password = ''.join(random.choices(string.ascii_letters + string.digits, k=32))
@@ -114,251 +127,293 @@ def generate_vpn_key(name):
     return f"ss://chacha20-ietf-poly1305:{password}@{server}:443/?outline=1#{name}"
 
 # ===== ОСНОВНЫЕ ОБРАБОТЧИКИ =====
-async def start(update: Update, context):
+@db_scope
+async def start(update: Update, context, db):
     """Команда /start"""
-    db = next(get_db())
     user = update.effective_user
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
     
     text = f"👋 Привет, {user.first_name}!\n💰 Баланс: {db_user.balance} руб\n\nВыберите действие:"
     await update.message.reply_text(text, reply_markup=main_menu(user.id))
 
-async def button_handler(update: Update, context):
-    """Обработчик всех кнопок"""
+# ===== МАРШРУТЫ КНОПОК =====
+# Обработчик маршрута: handler(query, context, db, db_user, *аргументы из callback_data)
+routes = CallbackRouter()
+
+ADMIN_PAGE_SIZE = 5  # строк на странице админских списков
+
+# Упакованные кнопки: листание списков - keyboards.ADMIN_*, остальные id постоянные
+ADMIN_USER = Spec(10, "admin_user", UINT)
+ADMIN_ADD_TO = Spec(11, "admin_add_to", UINT)
+BUY = Spec(12, "buy", STR)
+
+def admin_only(handler):
+    """Админские кнопки для остальных пользователей молча игнорируются"""
+    @functools.wraps(handler)
+    async def wrapper(query, *args):
+        if is_admin(query.from_user.id):
+            await handler(query, *args)
+    return wrapper
+
+@db_scope
+async def button_handler(update: Update, context, db):
+    """Обработчик всех кнопок: поиск маршрута по таблице routes"""
     query = update.callback_query
     await query.answer()
-    db = next(get_db())
     user = query.from_user
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
+    await routes.dispatch(query.data, query, context, db, db_user)
+
+# АДМИН КОМАНДЫ
+@routes.exact("admin_panel")
+@admin_only
+async def admin_panel(query, context, db, db_user):
+    await render_cache.edit(query, "👑 **Админ-панель**", parse_mode="Markdown", reply_markup=admin_menu())
+
+@routes.exact("admin_stats")
+@admin_only
+async def admin_stats(query, context, db, db_user):
+    stats = counters.snapshot_sync(db)
+    total_users = stats["users"]
+    total_payments = stats["payments"]
+    total_subs = stats["active_subscriptions"]
+    total_balance = stats["balance_kopecks"] / 100
     
-    # АДМИН КОМАНДЫ
-    if query.data == "admin_panel" and is_admin(user.id):
-        await query.edit_message_text("👑 **Админ-панель**", parse_mode="Markdown", reply_markup=admin_menu())
-        return
+    text = (f"📊 **Статистика бота:**\n\n"
+            f"👥 Пользователей: {total_users}\n"
+            f"💳 Платежей: {total_payments}\n"
+            f"📅 Активных подписок: {total_subs}\n"
+            f"💰 Общий баланс: {total_balance:.2f} руб")
+    text += "\n\n" + "\n".join(render_cache.get_cache().report_lines() + outbox.get_outbox().report_lines())
+    route_lines = routes.report()
+    if route_lines:
+        # В блоке кода имена маршрутов (admin_users_*) не ломают Markdown
+        text += "\n\n🧭 Кнопки (самые медленные):\n```\n" + "\n".join(route_lines) + "\n```"
+    await render_cache.edit(query, text, parse_mode="Markdown", reply_markup=admin_menu())
+
+@routes.exact("admin_users")
+@routes.packed(keyboards.ADMIN_USERS)
+@admin_only
+async def admin_users(query, context, db, db_user, older=True, cursor=None):
+    # Keyset-страница по id: стоимость не зависит от того, как далеко пролистали
+    page = queries.page_sync(db, User, cursor, older, ADMIN_PAGE_SIZE)
+    total = counters.snapshot_sync(db)["users"]
     
-    elif query.data == "admin_stats" and is_admin(user.id):
-        total_users = db.query(User).count()
-        total_payments = db.query(Payment).count()
-        total_subs = db.query(Subscription).filter(Subscription.is_active == True).count()
-        total_balance = db.query(func.sum(User.balance)).scalar() or 0
-        
-        text = (f"📊 **Статистика бота:**\n\n"
-                f"👥 Пользователей: {total_users}\n"
-                f"💳 Платежей: {total_payments}\n"
-                f"📅 Активных подписок: {total_subs}\n"
-                f"💰 Общий баланс: {total_balance:.2f} руб")
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=admin_menu())
-        return
+    text = f"👥 **Пользователи** (всего: {total})\n\n"
+    keyboard = []
+    for u in page.items:
+        text += f"{u.id}. @{u.username or u.full_name} - {u.balance} руб\n"
+        keyboard.append([InlineKeyboardButton(f"👤 {u.id}. {u.username or u.full_name}", 
+                       callback_data=ADMIN_USER.pack(u.id))])
     
-    elif query.data.startswith("admin_users_") and is_admin(user.id):
-        page = int(query.data.split("_")[2])
-        limit = 5
-        users = db.query(User).order_by(User.id).offset(page * limit).limit(limit).all()
-        total = db.query(User).count()
-        
-        text = f"👥 **Пользователи** (стр. {page+1}, всего: {total})\n\n"
-        keyboard = []
-        for u in users:
-            text += f"{u.id}. @{u.username or u.full_name} - {u.balance} руб\n"
-            keyboard.append([InlineKeyboardButton(f"👤 {u.id}. {u.username or u.full_name}", 
-                           callback_data=f"admin_user_{u.id}")])
-        
-        nav = []
-        if page > 0:
-            nav.append(InlineKeyboardButton("◀️ Назад", callback_data=f"admin_users_{page-1}"))
-        if (page + 1) * limit < total:
-            nav.append(InlineKeyboardButton("Вперед ▶️", callback_data=f"admin_users_{page+1}"))
-        if nav:
-            keyboard.append(nav)
+    nav = keyboards.page_buttons(keyboards.ADMIN_USERS, page)
+    if nav:
+        keyboard.append(nav)
+    
+    keyboard.append([InlineKeyboardButton("🏠 Админ-панель", callback_data="admin_panel")])
+    
+    await render_cache.edit(query, text, parse_mode="Markdown", 
+                                reply_markup=InlineKeyboardMarkup(keyboard))
+
+@routes.packed(ADMIN_USER)
+@routes.prefix("admin_user_", int)  # кнопки в старых сообщениях
+@admin_only
+async def admin_user(query, context, db, db_user, user_id):
+    target = db.query(User).filter(User.id == user_id).first()
+    
+    if target:
+        subs = db.query(Subscription).filter(Subscription.user_id == target.id).all()
+        keys = db.query(VPNKey).filter(VPNKey.user_id == target.id).all()
         
-        keyboard.append([InlineKeyboardButton("🏠 Админ-панель", callback_data="admin_panel")])
+        text = (f"👤 **Информация о пользователе:**\n\n"
+                f"ID: {target.id}\n"
+                f"Telegram: {target.telegram_id}\n"
+                f"Username: @{target.username or 'нет'}\n"
+                f"Имя: {target.full_name}\n"
+                f"💰 Баланс: {target.balance} руб\n"
+                f"📅 Регистрация: {target.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+                f"🔑 Ключей: {len(keys)}\n"
+                f"📊 Подписок: {len(subs)}")
         
-        await query.edit_message_text(text, parse_mode="Markdown", 
+        keyboard = [
+            [InlineKeyboardButton("➕ Добавить баланс", callback_data=ADMIN_ADD_TO.pack(target.id))],
+            [InlineKeyboardButton("👥 К списку", callback_data="admin_users")],
+            [InlineKeyboardButton("🏠 Админ-панель", callback_data="admin_panel")]
+        ]
+        await render_cache.edit(query, text, parse_mode="Markdown", 
                                     reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+
+@routes.packed(ADMIN_ADD_TO)
+@routes.prefix("admin_add_to_", int)  # кнопки в старых сообщениях
+@admin_only
+async def admin_add_to(query, context, db, db_user, user_id):
+    context.user_data['admin_adding_to'] = user_id
+    await render_cache.edit(query,
+        "💰 **Добавление баланса**\n\nВведите сумму:",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_panel")]])
+    )
+
+def _user_name(u, user_id):
+    return f"@{u.username}" if u and u.username else f"ID:{user_id}"
+
+@routes.exact("admin_payments")
+@routes.packed(keyboards.ADMIN_PAYMENTS)
+@admin_only
+async def admin_payments(query, context, db, db_user, older=True, cursor=None):
+    # Пользователи - тем же запросом (joinedload), а не запросом на каждую строку
+    page = queries.page_sync(db, Payment, cursor, older, 10, options=[joinedload(Payment.user)])
+    text = "💳 **Платежи:**\n\n"
+    for p in page.items:
+        text += f"• {p.amount} руб - {_user_name(p.user, p.user_id)} - {p.status}\n"
+    await render_cache.edit(query, text, parse_mode="Markdown",
+                                  reply_markup=admin_menu(keyboards.page_buttons(keyboards.ADMIN_PAYMENTS, page)))
+
+@routes.exact("admin_keys")
+@routes.packed(keyboards.ADMIN_KEYS)
+@admin_only
+async def admin_keys(query, context, db, db_user, older=True, cursor=None):
+    page = queries.page_sync(db, VPNKey, cursor, older, 10, options=[joinedload(VPNKey.user)])
+    text = "🔑 **Ключи:**\n\n"
+    for k in page.items:
+        text += f"• {k.name} - {_user_name(k.user, k.user_id)}\n"
+    await render_cache.edit(query, text, parse_mode="Markdown",
+                                  reply_markup=admin_menu(keyboards.page_buttons(keyboards.ADMIN_KEYS, page)))
+
+@routes.exact("admin_add_balance")
+@admin_only
+async def admin_add_balance(query, context, db, db_user):
+    context.user_data['admin_adding'] = True
+    await render_cache.edit(query,
+        "💰 **Добавление баланса**\n\nВведите: `ID_пользователя:сумма`\nПример: `123456789:500`",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_panel")]])
+    )
+
+# ОБЫЧНЫЕ КОМАНДЫ ПОЛЬЗОВАТЕЛЯ
+@routes.exact("main")
+async def show_main(query, context, db, db_user):
+    await render_cache.edit(query,
+        f"📱 **Главное меню**\n💰 Баланс: {db_user.balance} руб",
+        parse_mode="Markdown",
+        reply_markup=main_menu(query.from_user.id)
+    )
+
+@routes.exact("deposit")
+async def deposit(query, context, db, db_user):
+    await render_cache.edit(query,
+        "💰 **Пополнение баланса**\n\nВведите сумму (10-5000 руб):",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main")]])
+    )
+    context.user_data['awaiting_amount'] = True
+
+@routes.exact("balance")
+async def show_balance(query, context, db, db_user):
+    active_subs = db.query(Subscription).filter(
+        Subscription.user_id == db_user.id,
+        Subscription.is_active == True,
+        Subscription.end_date > datetime.utcnow()
+    ).all()
     
-    elif query.data.startswith("admin_user_") and is_admin(user.id):
-        user_id = int(query.data.split("_")[2])
-        target = db.query(User).filter(User.id == user_id).first()
-        
-        if target:
-            subs = db.query(Subscription).filter(Subscription.user_id == target.id).all()
-            keys = db.query(VPNKey).filter(VPNKey.user_id == target.id).all()
-            
-            text = (f"👤 **Информация о пользователе:**\n\n"
-                    f"ID: {target.id}\n"
-                    f"Telegram: {target.telegram_id}\n"
-                    f"Username: @{target.username or 'нет'}\n"
-                    f"Имя: {target.full_name}\n"
-                    f"💰 Баланс: {target.balance} руб\n"
-                    f"📅 Регистрация: {target.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"🔑 Ключей: {len(keys)}\n"
-                    f"📊 Подписок: {len(subs)}")
-            
-            keyboard = [
-                [InlineKeyboardButton("➕ Добавить баланс", callback_data=f"admin_add_to_{target.id}")],
-                [InlineKeyboardButton("👥 К списку", callback_data="admin_users_0")],
-                [InlineKeyboardButton("🏠 Админ-панель", callback_data="admin_panel")]
-            ]
-            await query.edit_message_text(text, parse_mode="Markdown", 
-                                        reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+    text = f"📊 **Ваш баланс:** {db_user.balance} руб\n\n"
+    if active_subs:
+        text += "**Активные подписки:**\n"
+        for sub in active_subs:
+            days = (sub.end_date - datetime.utcnow()).days
+            text += f"• {sub.tariff} - осталось {days} дней\n"
+    else:
+        text += "У вас нет активных подписок."
     
-    elif query.data.startswith("admin_add_to_") and is_admin(user.id):
-        user_id = int(query.data.split("_")[3])
-        context.user_data['admin_adding_to'] = user_id
-        await query.edit_message_text(
-            "💰 **Добавление баланса**\n\nВведите сумму:",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_panel")]])
+    await render_cache.edit(query, text, parse_mode="Markdown", reply_markup=main_menu(query.from_user.id))
+
+@routes.exact("keys")
+async def show_keys(query, context, db, db_user):
+    keys = db.query(VPNKey).filter(VPNKey.user_id == db_user.id).all()
+    if keys:
+        text = "🔑 **Ваши ключи:**\n\n"
+        for i, k in enumerate(keys, 1):
+            text += f"{i}. {k.name} ({k.created_at.strftime('%d.%m.%Y')})\n"
+        text += "\nНапишите номер ключа:"
+        await render_cache.edit(query, text, parse_mode="Markdown", reply_markup=main_menu(query.from_user.id))
+        context.user_data['awaiting_key_number'] = True
+    else:
+        await render_cache.edit(query,
+            "🔑 У вас нет ключей.\nКупите тариф!",
+            reply_markup=main_menu(query.from_user.id)
         )
-        return
+
+@routes.exact("tariffs")
+async def show_tariffs(query, context, db, db_user):
+    text = "🛒 **Тарифы:**\n\n"
+    for tid, t in TARIFFS.items():
+        text += f"• **{t['name']}** - {t['price']} руб ({t['days']} дней)\n"
     
-    elif query.data == "admin_payments" and is_admin(user.id):
-        payments = db.query(Payment).order_by(Payment.created_at.desc()).limit(10).all()
-        text = "💳 **Последние 10 платежей:**\n\n"
-        for p in payments:
-            u = db.query(User).filter(User.id == p.user_id).first()
-            name = f"@{u.username}" if u and u.username else f"ID:{p.user_id}"
-            text += f"• {p.amount} руб - {name} - {p.status}\n"
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=admin_menu())
-        return
+    keyboard = []
+    for tid in TARIFFS.keys():
+        name = TARIFFS[tid]["name"]
+        keyboard.append([InlineKeyboardButton(f"Купить {name}", callback_data=BUY.pack(tid))])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main")])
     
-    elif query.data == "admin_keys" and is_admin(user.id):
-        keys = db.query(VPNKey).order_by(VPNKey.created_at.desc()).limit(10).all()
-        text = "🔑 **Последние 10 ключей:**\n\n"
-        for k in keys:
-            u = db.query(User).filter(User.id == k.user_id).first()
-            name = f"@{u.username}" if u and u.username else f"ID:{k.user_id}"
-            text += f"• {k.name} - {name}\n"
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=admin_menu())
-        return
+    await render_cache.edit(query, text, parse_mode="Markdown", 
+                                reply_markup=InlineKeyboardMarkup(keyboard))
+
+@routes.packed(BUY)
+@routes.prefix("buy_", str)  # кнопки в старых сообщениях
+async def buy(query, context, db, db_user, tariff_id):
+    user = query.from_user
+    tariff = TARIFFS.get(tariff_id)
     
-    elif query.data == "admin_add_balance" and is_admin(user.id):
-        context.user_data['admin_adding'] = True
-        await query.edit_message_text(
-            "💰 **Добавление баланса**\n\nВведите: `ID_пользователя:сумма`\nПример: `123456789:500`",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_panel")]])
+    # Списание одним условным UPDATE: параллельные покупки не уведут баланс в минус
+    if tariff and ledger.debit_sync(db, db_user.id, ledger.to_kopecks(tariff['price']),
+                                    "purchase", ledger.operation_id(tariff_id)) is not None:
+        
+        sub = Subscription(
+            user_id=db_user.id,
+            tariff=tariff['name'],
+            price=tariff['price'],
+            end_date=datetime.utcnow() + timedelta(days=tariff['days'])
         )
-        return
-    
-    # ОБЫЧНЫЕ КОМАНДЫ ПОЛЬЗОВАТЕЛЯ
-    elif query.data == "main":
-        await query.edit_message_text(
-            f"📱 **Главное меню**\n💰 Баланс: {db_user.balance} руб",
+        db.add(sub)
+        
+        key_text = generate_vpn_key(tariff['name'])
+        vpn_key = VPNKey(
+            user_id=db_user.id,
+            key=key_text,
+            name=tariff['name']
+        )
+        db.add(vpn_key)
+        db.commit()
+        
+        await render_cache.edit(query,
+            f"✅ **Покупка успешна!**\n\n"
+            f"Тариф: {tariff['name']}\n"
+            f"Цена: {tariff['price']} руб\n"
+            f"Остаток: {db_user.balance} руб\n\n"
+            f"Ключ отправлен отдельно.",
             parse_mode="Markdown",
             reply_markup=main_menu(user.id)
         )
-    
-    elif query.data == "deposit":
-        await query.edit_message_text(
-            "💰 **Пополнение баланса**\n\nВведите сумму (10-5000 руб):",
+        
+        await outbox.get_outbox().send(
+            context.bot, user.id,
+            f"🔑 **Ваш VPN ключ:**\n\n`{key_text}`\n\nИспользуйте в Outline.",
+            parse_mode="Markdown"
+        )
+    elif tariff:
+        await render_cache.edit(query,
+            f"❌ **Недостаточно средств!**\n\n"
+            f"Нужно: {tariff['price']} руб\n"
+            f"На балансе: {db_user.balance} руб",
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main")]])
+            reply_markup=main_menu(user.id)
         )
-        context.user_data['awaiting_amount'] = True
-    
-    elif query.data == "balance":
-        active_subs = db.query(Subscription).filter(
-            Subscription.user_id == db_user.id,
-            Subscription.is_active == True,
-            Subscription.end_date > datetime.utcnow()
-        ).all()
-        
-        text = f"📊 **Ваш баланс:** {db_user.balance} руб\n\n"
-        if active_subs:
-            text += "**Активные подписки:**\n"
-            for sub in active_subs:
-                days = (sub.end_date - datetime.utcnow()).days
-                text += f"• {sub.tariff} - осталось {days} дней\n"
-        else:
-            text += "У вас нет активных подписок."
-        
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=main_menu(user.id))
-    
-    elif query.data == "keys":
-        keys = db.query(VPNKey).filter(VPNKey.user_id == db_user.id).all()
-        if keys:
-            text = "🔑 **Ваши ключи:**\n\n"
-            for i, k in enumerate(keys, 1):
-                text += f"{i}. {k.name} ({k.created_at.strftime('%d.%m.%Y')})\n"
-            text += "\nНапишите номер ключа:"
-            await query.edit_message_text(text, parse_mode="Markdown", reply_markup=main_menu(user.id))
-            context.user_data['awaiting_key_number'] = True
-        else:
-            await query.edit_message_text(
-                "🔑 У вас нет ключей.\nКупите тариф!",
-                reply_markup=main_menu(user.id)
-            )
-    
-    elif query.data == "tariffs":
-        text = "🛒 **Тарифы:**\n\n"
-        for tid, t in TARIFFS.items():
-            text += f"• **{t['name']}** - {t['price']} руб ({t['days']} дней)\n"
-        
-        keyboard = []
-        for tid in TARIFFS.keys():
-            name = TARIFFS[tid]["name"]
-            keyboard.append([InlineKeyboardButton(f"Купить {name}", callback_data=f"buy_{tid}")])
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main")])
-        
-        await query.edit_message_text(text, parse_mode="Markdown", 
-                                    reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif query.data.startswith("buy_"):
-        tariff_id = query.data.replace("buy_", "")
-        tariff = TARIFFS.get(tariff_id)
-        
-        if tariff and db_user.balance >= tariff['price']:
-            db_user.balance -= tariff['price']
-            
-            sub = Subscription(
-                user_id=db_user.id,
-                tariff=tariff['name'],
-                price=tariff['price'],
-                end_date=datetime.utcnow() + timedelta(days=tariff['days'])
-            )
-            db.add(sub)
-            
-            key_text = generate_vpn_key(tariff['name'])
-            vpn_key = VPNKey(
-                user_id=db_user.id,
-                key=key_text,
-                name=tariff['name']
-            )
-            db.add(vpn_key)
-            db.commit()
-            
-            await query.edit_message_text(
-                f"✅ **Покупка успешна!**\n\n"
-                f"Тариф: {tariff['name']}\n"
-                f"Цена: {tariff['price']} руб\n"
-                f"Остаток: {db_user.balance} руб\n\n"
-                f"Ключ отправлен отдельно.",
-                parse_mode="Markdown",
-                reply_markup=main_menu(user.id)
-            )
-            
-            await context.bot.send_message(
-                chat_id=user.id,
-                text=f"🔑 **Ваш VPN ключ:**\n\n`{key_text}`\n\nИспользуйте в Outline.",
-                parse_mode="Markdown"
-            )
-        elif tariff:
-            await query.edit_message_text(
-                f"❌ **Недостаточно средств!**\n\n"
-                f"Нужно: {tariff['price']} руб\n"
-                f"На балансе: {db_user.balance} руб",
-                parse_mode="Markdown",
-                reply_markup=main_menu(user.id)
-            )
-
-async def handle_message(update: Update, context):
+
+@db_scope
+async def handle_message(update: Update, context, db):
     """Обработчик сообщений"""
     text = update.message.text
     user = update.effective_user
-    db = next(get_db())
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
     
     # АДМИН: Добавление баланса конкретному пользователю
@@ -369,7 +424,7 @@ async def handle_message(update: Update, context):
             target = db.query(User).filter(User.id == target_id).first()
             
             if target:
-                target.balance += amount
+                ledger.credit_sync(db, target.id, ledger.to_kopecks(amount), "admin", ledger.operation_id(f"admin{user.id}"))
                 db.commit()
                 
                 await update.message.reply_text(
@@ -378,13 +433,12 @@ async def handle_message(update: Update, context):
                     reply_markup=admin_menu()
                 )
                 
-                try:
-                    await context.bot.send_message(
-                        chat_id=target.telegram_id,
-                        text=f"💰 Администратор добавил вам {amount} руб\nНовый баланс: {target.balance} руб"
-                    )
-                except:
-                    pass
+                # Через очередь с лимитами; если пользователь заблокировал бота - outbox запишет в лог
+                await outbox.get_outbox().post(
+                    context.bot, target.telegram_id,
+                    f"💰 Администратор добавил вам {amount} руб\nНовый баланс: {target.balance} руб",
+                    priority=outbox.NOTIFY
+                )
             else:
                 await update.message.reply_text("❌ Пользователь не найден", reply_markup=admin_menu())
             
@@ -407,7 +461,7 @@ async def handle_message(update: Update, context):
                     target = db.query(User).filter(User.id == uid).first()
                 
                 if target:
-                    target.balance += amount
+                    ledger.credit_sync(db, target.id, ledger.to_kopecks(amount), "admin", ledger.operation_id(f"admin{user.id}"))
                     db.commit()
                     
                     await update.message.reply_text(
@@ -416,13 +470,12 @@ async def handle_message(update: Update, context):
                         reply_markup=admin_menu()
                     )
                     
-                    try:
-                        await context.bot.send_message(
-                            chat_id=target.telegram_id,
-                            text=f"💰 Администратор добавил вам {amount} руб\nНовый баланс: {target.balance} руб"
-                        )
-                    except:
-                        pass
+                    # Через очередь с лимитами; если пользователь заблокировал бота - outbox запишет в лог
+                    await outbox.get_outbox().post(
+                        context.bot, target.telegram_id,
+                        f"💰 Администратор добавил вам {amount} руб\nНовый баланс: {target.balance} руб",
+                        priority=outbox.NOTIFY
+                    )
                 else:
                     await update.message.reply_text("❌ Пользователь не найден", reply_markup=admin_menu())
             except:
@@ -438,7 +491,7 @@ async def handle_message(update: Update, context):
         try:
             amount = float(text)
             if 10 <= amount <= 5000:
-                db_user.balance += amount
+                ledger.credit_sync(db, db_user.id, ledger.to_kopecks(amount), "deposit", ledger.operation_id("deposit"))
                 db.commit()
                 
                 await update.message.reply_text(
@@ -478,6 +531,11 @@ async def handle_message(update: Update, context):
             reply_markup=main_menu(user.id)
         )
 
+async def post_init(application):
+    """Прогрев после старта: таблицы БД и миграции - не при импорте модуля"""
+    await asyncio.to_thread(Base.metadata.create_all, engine)
+    await asyncio.to_thread(database.init_db)  # баланс в копейках и журнал balance_ledger (миграции)
+
 # ===== ЗАПУСК БОТА =====
 def main():
     logging.basicConfig(level=logging.INFO)
@@ -491,7 +549,7 @@ def main():
     
     try:
         token = config.Config.BOT_TOKEN
-        app = Application.builder().token(token).build()
+        app = Application.builder().token(token).post_init(post_init).build()
         
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CommandHandler("admin", lambda u,c: button_handler(u,c) if is_admin(u.effective_user.id) else u.message.reply_text("⛔ Нет доступа")))
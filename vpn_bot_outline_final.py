@@ -1,85 +1,74 @@
+import asyncio
+import functools
 import logging
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 import config
-import requests
 import random
 import string
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey, func
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from db_session import SessionScope
+from router import CallbackRouter
+from keyboards import KeyboardCatalog
+from callback_codec import STR, Spec
+from outline_cluster import OutlineCluster, OutlineServer
+from outline_health import HealthMonitor
+from key_pool import KeyPool
+import database
+import counters
+import ledger
+import queries
+import render_cache
+import outbox
+
+logger = logging.getLogger(__name__)
 
 # ===== НАСТРОЙКИ =====
 ADMIN_IDS = config.Config.ADMIN_IDS
 TARIFFS = config.Config.TARIFFS
 OUTLINE_API_URL = "https://45.135.182.168:4751/XTx2Eq4Mc4yQxm6nIBEpLw"
 
-# Отключаем предупреждения SSL
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 # ===== REAL OUTLINE API =====
-def test_outline_connection():
-    """Тест подключения к Outline"""
-    try:
-        response = requests.get(f"{OUTLINE_API_URL}/access-keys", verify=False, timeout=10)
-        if response.status_code == 200:
-            keys = response.json().get('accessKeys', [])
-            return True, f"✅ Outline API доступен ({len(keys)} ключей)"
-        else:
-            return False, f"❌ Outline API недоступен (статус: {response.status_code})"
-    except Exception as e:
-        return False, f"❌ Ошибка подключения: {e}"
+# Сервер Outline: зеркало ключей для админ-экранов и circuit breaker
+outline_server = OutlineServer("main", OUTLINE_API_URL)
+outline_mirror = outline_server.mirror
 
-def create_outline_key(name):
-    """Создать ключ в Outline - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
-    try:
-        data = {"name": name}
-        response = requests.post(
-            f"{OUTLINE_API_URL}/access-keys",
-            json=data,
-            verify=False,
-            timeout=10
-        )
-        
-        # Outline возвращает 201 при успешном создании!
-        if response.status_code in [200, 201]:  # Исправлено здесь!
-            key_data = response.json()
-            return {
-                'success': True,
-                'id': key_data['id'],
-                'access_url': key_data['accessUrl'],
-                'port': key_data.get('port'),
-                'method': key_data.get('method', 'chacha20-ietf-poly1305'),
-                'password': key_data.get('password', '')
-            }
-        else:
-            return {
-                'success': False,
-                'error': f"API ошибка: {response.status_code}",
-                'details': response.text[:200]
-            }
-            
-    except Exception as e:
+# Состояние сервера отслеживает фоновая проверка (запускается в post_init)
+outline_monitor = HealthMonitor([outline_server])
+
+async def create_outline_key(name):
+    """Создать ключ в Outline; при разомкнутой цепи сразу возвращает ошибку"""
+    key_data = await outline_server.create_key(name, limit_gb=None)
+    if key_data:
         return {
-            'success': False,
-            'error': f"Ошибка подключения: {str(e)}"
+            'success': True,
+            'id': key_data['id'],
+            'access_url': key_data['accessUrl'],
+            'port': key_data.get('port'),
+            'method': key_data.get('method', 'chacha20-ietf-poly1305'),
+            'password': key_data.get('password', '')
         }
+    if not outline_server.healthy:
+        return {'success': False, 'error': f"Outline недоступен (цепь: {outline_server.breaker.state})"}
+    return {'success': False, 'error': "API ошибка"}
 
-def list_outline_keys():
-    """Список ключей в Outline"""
-    try:
-        response = requests.get(f"{OUTLINE_API_URL}/access-keys", verify=False, timeout=10)
-        if response.status_code == 200:
-            return response.json().get('accessKeys', [])
-        return []
-    except:
-        return []
+def outline_status():
+    """Состояние Outline по данным фоновой проверки"""
+    if outline_server.last_probe_ok is None:
+        return "⏳ Outline API проверяется..."
+    if outline_server.healthy:
+        return f"✅ Outline API доступен ({outline_mirror.count()} ключей)"
+    return f"❌ Outline API недоступен (цепь: {outline_server.breaker.state})"
 
-# Проверяем подключение
-connection_ok, connection_msg = test_outline_connection()
-print(f"📡 {connection_msg}")
+def mirror_status():
+    """Состояние зеркала ключей для админ-экранов"""
+    if outline_mirror.age is None:
+        return "⏳ Ключи Outline еще загружаются"
+    status = "✅" if outline_mirror.last_ok else "⚠️"
+    return f"{status} Ключи Outline обновлены {outline_mirror.age:.0f} сек. назад"
 
 # ===== БАЗА ДАННЫХ =====
 Base = declarative_base()
@@ -129,41 +118,53 @@ class VPNKey(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     user = relationship("User", back_populates="keys")
 
-# Подключаемся к БД
+# Подключаемся к БД (соединение откроется при первом запросе, таблицы создаются в post_init)
 engine = create_engine(config.Config.DATABASE_URL, echo=False)
-Base.metadata.create_all(engine)
 SessionLocal = sessionmaker(bind=engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Одна сессия на апдейт: коммит или откат, соединение всегда возвращается в пул
+db_scope = SessionScope(SessionLocal)
+
+# Пул заранее созданных ключей: покупка не ждет Outline
+key_pool = KeyPool(OutlineCluster([outline_server]))
 
 # ===== ФУНКЦИИ =====
 def is_admin(user_id):
     return user_id in ADMIN_IDS
 
-def main_menu(user_id):
+def _build_main_menu(admin, trial_used, locale):
     keyboard = [
         [InlineKeyboardButton("💰 Пополнить баланс", callback_data="deposit")],
         [InlineKeyboardButton("📊 Мой баланс", callback_data="balance")],
         [InlineKeyboardButton("🔑 Мои ключи", callback_data="keys")],
         [InlineKeyboardButton("🛒 Купить тариф", callback_data="tariffs")],
     ]
-    if is_admin(user_id):
+    if admin:
         keyboard.append([InlineKeyboardButton("👑 Админ-панель", callback_data="admin_panel")])
     return InlineKeyboardMarkup(keyboard)
 
+# Меню строятся один раз на вариант и переиспользуются (см. keyboards.KeyboardCatalog)
+menus = KeyboardCatalog({"main": _build_main_menu})
+
+def main_menu(user_id):
+    return menus.get("main", is_admin(user_id))
+
+# Фоновые задачи со ссылками, чтобы их не собрал GC до завершения
+background_tasks = set()
+
+def _task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Фоновая задача завершилась ошибкой: {task.exception()}")
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
 def get_or_create_user(db, telegram_id, username, full_name):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        user = User(telegram_id=telegram_id, username=username, full_name=full_name)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    return user
+    return queries.upsert_user_sync(db, telegram_id, username, full_name, model=User)
 
 def format_key_monospace(key_text, with_backticks=True):
     """Форматирование ключа в моноширинном виде"""
@@ -174,247 +175,299 @@ def format_key_monospace(key_text, with_backticks=True):
         return f"<pre>{key_text}</pre>"
 
 # ===== ОСНОВНЫЕ ОБРАБОТЧИКИ =====
-async def start(update: Update, context):
-    db = next(get_db())
+@db_scope
+async def start(update: Update, context, db):
     user = update.effective_user
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
     
-    outline_keys = list_outline_keys()
-    
     text = (f"👋 Привет, {user.first_name}!\n"
             f"💰 Баланс: {db_user.balance} руб\n"
-            f"🔐 {connection_msg}\n\n"
+            f"🔐 {outline_status()}\n\n"
             f"Выберите действие:")
     
     await update.message.reply_text(text, reply_markup=main_menu(user.id))
 
-async def button_handler(update: Update, context):
+# ===== МАРШРУТЫ КНОПОК =====
+# Обработчик маршрута: handler(query, context, db, db_user, *аргументы из callback_data)
+routes = CallbackRouter()
+
+BUY = Spec(1, "buy", STR)  # упакованная кнопка покупки; id постоянный
+
+def admin_only(handler):
+    """Админские кнопки для остальных пользователей молча игнорируются"""
+    @functools.wraps(handler)
+    async def wrapper(query, *args):
+        if is_admin(query.from_user.id):
+            await handler(query, *args)
+    return wrapper
+
+@db_scope
+async def button_handler(update: Update, context, db):
+    """Обработчик всех кнопок: поиск маршрута по таблице routes"""
     query = update.callback_query
     await query.answer()
-    db = next(get_db())
     user = query.from_user
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
+    await routes.dispatch(query.data, query, context, db, db_user)
+
+@routes.exact("admin_panel")
+@admin_only
+async def admin_panel(query, context, db, db_user):
+    text = (f"👑 <b>Админ-панель</b>\n\n"
+            f"📊 Outline: {'✅ Работает' if outline_server.healthy else '⚠️ Ошибка'}\n"
+            f"🔑 Ключей в Outline: {outline_mirror.count()}\n"
+            f"👥 Пользователей: {counters.snapshot_sync(db)['users']}\n\n"
+            + "\n".join(outline_monitor.report()))
     
-    if query.data == "admin_panel" and is_admin(user.id):
-        outline_keys = list_outline_keys()
-        text = (f"👑 <b>Админ-панель</b>\n\n"
-                f"📊 Outline: {'✅ Работает' if connection_ok else '⚠️ Ошибка'}\n"
-                f"🔑 Ключей в Outline: {len(outline_keys)}\n"
-                f"👥 Пользователей: {db.query(User).count()}")
-        
-        keyboard = [
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton("🔑 Outline ключи", callback_data="admin_outline_keys")],
-            [InlineKeyboardButton("➕ Добавить баланс", callback_data="admin_add_balance")],
-            [InlineKeyboardButton("🔄 Проверить Outline", callback_data="admin_check_outline")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main")]
-        ]
-        
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+    keyboard = [
+        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton("🔑 Outline ключи", callback_data="admin_outline_keys")],
+        [InlineKeyboardButton("➕ Добавить баланс", callback_data="admin_add_balance")],
+        [InlineKeyboardButton("🔄 Проверить Outline", callback_data="admin_check_outline")],
+        [InlineKeyboardButton("🏠 Главное меню", callback_data="main")]
+    ]
     
-    elif query.data == "admin_check_outline" and is_admin(user.id):
-        connection_ok, msg = test_outline_connection()
-        outline_keys = list_outline_keys()
-        await query.edit_message_text(
-            f"🔄 <b>Проверка Outline:</b>\n\n{msg}\n"
-            f"🔑 Ключей в системе: {len(outline_keys)}",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]])
+    await render_cache.edit(query, text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@routes.exact("admin_check_outline")
+@admin_only
+async def admin_check_outline(query, context, db, db_user):
+    # Обновление и проверка идут в фоне - экран не ждет сети
+    spawn(outline_mirror.refresh())
+    spawn(outline_monitor.probe(outline_server))
+    error = f"\n❌ {outline_mirror.last_error}" if outline_mirror.last_error else ""
+    await render_cache.edit(query,
+        f"🔄 <b>Проверка Outline:</b>\n\n{outline_status()}\n"
+        + "\n".join(outline_monitor.report()) +
+        f"\n{mirror_status()}{error}\n"
+        f"🔑 Ключей в системе: {outline_mirror.count()}",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]])
+    )
+
+@routes.exact("admin_outline_keys")
+@admin_only
+async def admin_outline_keys(query, context, db, db_user):
+    total_keys = outline_mirror.count()
+    text = f"🔑 <b>Ключи в Outline:</b> ({total_keys})\n\n"
+    for k in outline_mirror.latest(10):  # Последние 10 ключей
+        name = k.get('name', 'Без имени') or 'Без имени'
+        port = k.get('port', 'N/A')
+        text += f"• ID:{k.get('id')} - {name} (порт: {port})\n"
+    
+    if total_keys > 10:
+        text += f"\n... и еще {total_keys-10} ключей"
+    
+    await render_cache.edit(query, text, parse_mode="HTML", 
+                                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]))
+
+@routes.exact("admin_stats")
+@admin_only
+async def admin_stats(query, context, db, db_user):
+    stats = counters.snapshot_sync(db)
+    total_users = stats["users"]
+    total_payments = stats["payments"]
+    total_subs = stats["active_subscriptions"]
+    total_balance = stats["balance_kopecks"] / 100
+    
+    text = (f"📊 <b>Статистика бота:</b>\n\n"
+            f"👥 Пользователей: {total_users}\n"
+            f"💳 Платежей: {total_payments}\n"
+            f"📅 Активных подписок: {total_subs}\n"
+            f"💰 Общий баланс: {total_balance:.2f} руб\n"
+            f"🔑 Ключей в Outline: {outline_mirror.count()}\n"
+            f"📡 Outline: {'✅ Работает' if outline_server.healthy else '⚠️ Демо'}\n\n"
+            + "\n".join(db_scope.report()))
+    text += "\n\n" + "\n".join(render_cache.get_cache().report_lines() + outbox.get_outbox().report_lines())
+    route_lines = routes.report()
+    if route_lines:
+        text += "\n\n🧭 Кнопки (самые медленные):\n" + "\n".join(route_lines)
+    
+    await render_cache.edit(query, text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]))
+
+# ОСТАЛЬНЫЕ КОМАНДЫ
+@routes.exact("main")
+async def show_main(query, context, db, db_user):
+    user = query.from_user
+    await render_cache.edit(query,
+        f"📱 <b>Главное меню</b>\n💰 Баланс: {db_user.balance} руб",
+        parse_mode="HTML",
+        reply_markup=main_menu(user.id)
+    )
+
+@routes.exact("deposit")
+async def deposit(query, context, db, db_user):
+    await render_cache.edit(query,
+        "💰 <b>Пополнение баланса</b>\n\nВведите сумму (10-5000 руб):",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main")]])
+    )
+    context.user_data['awaiting_amount'] = True
+
+@routes.exact("balance")
+async def show_balance(query, context, db, db_user):
+    user = query.from_user
+    active_subs = db.query(Subscription).filter(
+        Subscription.user_id == db_user.id,
+        Subscription.is_active == True,
+        Subscription.end_date > datetime.utcnow()
+    ).all()
+    
+    text = f"📊 <b>Ваш баланс:</b> {db_user.balance} руб\n\n"
+    if active_subs:
+        text += "<b>Активные подписки:</b>\n"
+        for sub in active_subs:
+            days = (sub.end_date - datetime.utcnow()).days
+            text += f"• {sub.tariff} - осталось {days} дней\n"
+    else:
+        text += "У вас нет активных подписок."
+    
+    await render_cache.edit(query, text, parse_mode="HTML", reply_markup=main_menu(user.id))
+
+@routes.exact("keys")
+async def show_keys(query, context, db, db_user):
+    user = query.from_user
+    keys = db.query(VPNKey).filter(VPNKey.user_id == db_user.id).all()
+    if keys:
+        text = "🔑 <b>Ваши ключи:</b>\n\n"
+        for i, k in enumerate(keys, 1):
+            created = k.created_at.strftime('%d.%m.%Y')
+            text += f"{i}. {k.name} (создан: {created})\n"
+        text += "\nНапишите номер ключа:"
+        await render_cache.edit(query, text, parse_mode="HTML", reply_markup=main_menu(user.id))
+        context.user_data['awaiting_key_number'] = True
+    else:
+        await render_cache.edit(query,
+            "🔑 У вас нет ключей.\nКупите тариф!",
+            reply_markup=main_menu(user.id)
         )
-        return
+
+@routes.exact("tariffs")
+async def show_tariffs(query, context, db, db_user):
+    text = "🛒 <b>Тарифы:</b>\n\n"
+    for tid, t in TARIFFS.items():
+        text += f"• <b>{t['name']}</b> - {t['price']} руб ({t['days']} дней)\n"
     
-    elif query.data == "admin_outline_keys" and is_admin(user.id):
-        outline_keys = list_outline_keys()
-        text = f"🔑 <b>Ключи в Outline:</b> ({len(outline_keys)})\n\n"
-        for k in outline_keys[-10:]:  # Последние 10 ключей
-            name = k.get('name', 'Без имени') or 'Без имени'
-            port = k.get('port', 'N/A')
-            text += f"• ID:{k.get('id')} - {name} (порт: {port})\n"
-        
-        if len(outline_keys) > 10:
-            text += f"\n... и еще {len(outline_keys)-10} ключей"
-        
-        await query.edit_message_text(text, parse_mode="HTML", 
-                                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]))
-        return
+    keyboard = []
+    for tid in TARIFFS.keys():
+        name = TARIFFS[tid]["name"]
+        keyboard.append([InlineKeyboardButton(f"Купить {name}", callback_data=BUY.pack(tid))])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main")])
     
-    elif query.data == "admin_stats" and is_admin(user.id):
-        total_users = db.query(User).count()
-        total_payments = db.query(Payment).count()
-        total_subs = db.query(Subscription).filter(Subscription.is_active == True).count()
-        total_balance = db.query(func.sum(User.balance)).scalar() or 0
-        
-        outline_keys = list_outline_keys()
-        
-        text = (f"📊 <b>Статистика бота:</b>\n\n"
-                f"👥 Пользователей: {total_users}\n"
-                f"💳 Платежей: {total_payments}\n"
-                f"📅 Активных подписок: {total_subs}\n"
-                f"💰 Общий баланс: {total_balance:.2f} руб\n"
-                f"🔑 Ключей в Outline: {len(outline_keys)}\n"
-                f"📡 Outline: {'✅ Работает' if connection_ok else '⚠️ Демо'}")
-        
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]))
+    await render_cache.edit(query, text, parse_mode="HTML", 
+                                reply_markup=InlineKeyboardMarkup(keyboard))
+
+@routes.packed(BUY)
+@routes.prefix("buy_", str)  # кнопки в старых сообщениях
+async def buy(query, context, db, db_user, tariff_id):
+    user = query.from_user
+    tariff = TARIFFS.get(tariff_id)
+    
+    if not tariff:
+        await render_cache.edit(query, "❌ Тариф не найден", reply_markup=main_menu(user.id))
         return
     
-    # ОСТАЛЬНЫЕ КОМАНДЫ
-    elif query.data == "main":
-        await query.edit_message_text(
-            f"📱 <b>Главное меню</b>\n💰 Баланс: {db_user.balance} руб",
+    async def not_enough():
+        await render_cache.edit(query,
+            f"❌ <b>Недостаточно средств!</b>\n\n"
+            f"Нужно: {tariff['price']} руб\n"
+            f"На балансе: {db_user.balance} руб",
             parse_mode="HTML",
             reply_markup=main_menu(user.id)
         )
     
-    elif query.data == "deposit":
-        await query.edit_message_text(
-            "💰 <b>Пополнение баланса</b>\n\nВведите сумму (10-5000 руб):",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main")]])
-        )
-        context.user_data['awaiting_amount'] = True
+    if db_user.balance < tariff['price']:
+        await not_enough()
+        return
     
-    elif query.data == "balance":
-        active_subs = db.query(Subscription).filter(
-            Subscription.user_id == db_user.id,
-            Subscription.is_active == True,
-            Subscription.end_date > datetime.utcnow()
-        ).all()
-        
-        text = f"📊 <b>Ваш баланс:</b> {db_user.balance} руб\n\n"
-        if active_subs:
-            text += "<b>Активные подписки:</b>\n"
-            for sub in active_subs:
-                days = (sub.end_date - datetime.utcnow()).days
-                text += f"• {sub.tariff} - осталось {days} дней\n"
-        else:
-            text += "У вас нет активных подписок."
-        
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=main_menu(user.id))
+    # Ключ получаем до списания: пишущая транзакция SQLite не должна
+    # оставаться открытой на время обращений к пулу и Outline API
+    key_name = f"{tariff['name']} - user{user.id}"
+    pooled = await key_pool.claim(key_name)
+    if pooled:
+        key_result = {'success': True, 'id': pooled['id'], 'access_url': pooled['accessUrl']}
+    else:
+        key_result = await create_outline_key(key_name)
     
-    elif query.data == "keys":
-        keys = db.query(VPNKey).filter(VPNKey.user_id == db_user.id).all()
-        if keys:
-            text = "🔑 <b>Ваши ключи:</b>\n\n"
-            for i, k in enumerate(keys, 1):
-                created = k.created_at.strftime('%d.%m.%Y')
-                text += f"{i}. {k.name} (создан: {created})\n"
-            text += "\nНапишите номер ключа:"
-            await query.edit_message_text(text, parse_mode="HTML", reply_markup=main_menu(user.id))
-            context.user_data['awaiting_key_number'] = True
-        else:
-            await query.edit_message_text(
-                "🔑 У вас нет ключей.\nКупите тариф!",
-                reply_markup=main_menu(user.id)
-            )
+    if key_result['success']:
+        # Реальный ключ создан
+        key_text = key_result['access_url']
+        key_id_in_outline = key_result['id']
+        key_type = "🔐 РЕАЛЬНЫЙ"
+        key_status = "✅ Этот ключ работает! Используйте в Outline приложении."
+    else:
+        # Демо-ключ (на случай ошибки)
+        password = ''.join(random.choices(string.ascii_letters + string.digits, k=32))
+        key_text = f"ss://chacha20-ietf-poly1305:{password}@45.135.182.168:34554/?outline=1#{key_name}"
+        key_id_in_outline = f"demo_{random.randint(10000, 99999)}"
+        key_type = "⚠️ ДЕМО"
+        key_status = f"⚠️ Не удалось создать реальный ключ: {key_result.get('error', 'Unknown error')}"
     
-    elif query.data == "tariffs":
-        text = "🛒 <b>Тарифы:</b>\n\n"
-        for tid, t in TARIFFS.items():
-            text += f"• <b>{t['name']}</b> - {t['price']} руб ({t['days']} дней)\n"
-        
-        keyboard = []
-        for tid in TARIFFS.keys():
-            name = TARIFFS[tid]["name"]
-            keyboard.append([InlineKeyboardButton(f"Купить {name}", callback_data=f"buy_{tid}")])
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main")])
-        
-        await query.edit_message_text(text, parse_mode="HTML", 
-                                    reply_markup=InlineKeyboardMarkup(keyboard))
+    # Списание, подписка и ключ - одной короткой транзакцией без сетевых вызовов.
+    # Условный UPDATE: параллельные покупки не уведут баланс в минус
+    charged = ledger.debit_sync(db, db_user.id, ledger.to_kopecks(tariff['price']),
+                                "purchase", ledger.operation_id(tariff_id))
+    if charged is None:
+        db.rollback()
+        # Баланс успели потратить параллельно - ключ не выдаем
+        if pooled:
+            await key_pool.release(pooled)
+        elif key_result['success']:
+            await outline_server.delete_key(key_id_in_outline)
+        await not_enough()
+        return
     
-    elif query.data.startswith("buy_"):
-        tariff_id = query.data.replace("buy_", "")
-        tariff = TARIFFS.get(tariff_id)
-        
-        if not tariff:
-            await query.edit_message_text("❌ Тариф не найден", reply_markup=main_menu(user.id))
-            return
-        
-        if db_user.balance < tariff['price']:
-            await query.edit_message_text(
-                f"❌ <b>Недостаточно средств!</b>\n\n"
-                f"Нужно: {tariff['price']} руб\n"
-                f"На балансе: {db_user.balance} руб",
-                parse_mode="HTML",
-                reply_markup=main_menu(user.id)
-            )
-            return
-        
-        # Списание баланса
-        db_user.balance -= tariff['price']
-        
-        # Создаем подписку
-        sub = Subscription(
-            user_id=db_user.id,
-            tariff=tariff['name'],
-            price=tariff['price'],
-            end_date=datetime.utcnow() + timedelta(days=tariff['days'])
-        )
-        db.add(sub)
-        
-        # Создаем VPN ключ через Outline API
-        key_name = f"{tariff['name']} - user{user.id}"
-        key_result = create_outline_key(key_name)
-        
-        if key_result['success']:
-            # Реальный ключ создан
-            key_text = key_result['access_url']
-            key_id_in_outline = key_result['id']
-            key_type = "🔐 РЕАЛЬНЫЙ"
-            key_status = "✅ Этот ключ работает! Используйте в Outline приложении."
-        else:
-            # Демо-ключ (на случай ошибки)
-            password = ''.join(random.choices(string.ascii_letters + string.digits, k=32))
-            key_text = f"ss://chacha20-ietf-poly1305:{password}@45.135.182.168:34554/?outline=1#{key_name}"
-            key_id_in_outline = f"demo_{random.randint(10000, 99999)}"
-            key_type = "⚠️ ДЕМО"
-            key_status = f"⚠️ Не удалось создать реальный ключ: {key_result.get('error', 'Unknown error')}"
-        
-        # Сохраняем в БД
-        vpn_key = VPNKey(
-            user_id=db_user.id,
-            key_id=key_id_in_outline,
-            key=key_text,
-            name=tariff['name']
-        )
-        db.add(vpn_key)
-        db.commit()
-        
-        # Отправляем подтверждение покупки
-        await query.edit_message_text(
-            f"✅ <b>Покупка успешна!</b>\n\n"
-            f"Тариф: {tariff['name']}\n"
-            f"Цена: {tariff['price']} руб\n"
-            f"Остаток: {db_user.balance} руб\n"
-            f"Тип ключа: {key_type}\n\n"
-            f"Ключ отправлен отдельным сообщением.",
-            parse_mode="HTML",
-            reply_markup=main_menu(user.id)
-        )
-        
-        # Отправляем ключ в МОНОШИРИННОМ ФОРМАТЕ
-        key_msg = (f"🔑 <b>Ваш VPN ключ ({key_type}):</b>\n\n"
-                   f"{format_key_monospace(key_text, with_backticks=True)}\n\n"
-                   f"{key_status}")
-        
-        await context.bot.send_message(
-            chat_id=user.id,
-            text=key_msg,
-            parse_mode="Markdown"  # Используем Markdown для ``` моноширинного формата
-        )
+    db.add(Subscription(
+        user_id=db_user.id,
+        tariff=tariff['name'],
+        price=tariff['price'],
+        end_date=datetime.utcnow() + timedelta(days=tariff['days'])
+    ))
+    db.add(VPNKey(
+        user_id=db_user.id,
+        key_id=key_id_in_outline,
+        key=key_text,
+        name=tariff['name']
+    ))
+    db.commit()
+    if key_result['success']:
+        outline_mirror.apply_created({'id': key_id_in_outline, 'name': key_name, 'accessUrl': key_text})
+    
+    # Отправляем подтверждение покупки
+    await render_cache.edit(query,
+        f"✅ <b>Покупка успешна!</b>\n\n"
+        f"Тариф: {tariff['name']}\n"
+        f"Цена: {tariff['price']} руб\n"
+        f"Остаток: {db_user.balance} руб\n"
+        f"Тип ключа: {key_type}\n\n"
+        f"Ключ отправлен отдельным сообщением.",
+        parse_mode="HTML",
+        reply_markup=main_menu(user.id)
+    )
+    
+    # Отправляем ключ в МОНОШИРИННОМ ФОРМАТЕ
+    key_msg = (f"🔑 <b>Ваш VPN ключ ({key_type}):</b>\n\n"
+               f"{format_key_monospace(key_text, with_backticks=True)}\n\n"
+               f"{key_status}")
+    
+    await outbox.get_outbox().send(
+        context.bot, user.id,
+        key_msg,
+        parse_mode="Markdown"  # Используем Markdown для ``` моноширинного формата
+    )
 
-async def handle_message(update: Update, context):
+@db_scope
+async def handle_message(update: Update, context, db):
     """Обработчик сообщений"""
     text = update.message.text
     user = update.effective_user
-    db = next(get_db())
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
     
     if context.user_data.get('awaiting_amount'):
         try:
             amount = float(text)
             if 10 <= amount <= 5000:
-                db_user.balance += amount
+                ledger.credit_sync(db, db_user.id, ledger.to_kopecks(amount), "deposit", ledger.operation_id("deposit"))
                 db.commit()
                 await update.message.reply_text(
                     f"✅ <b>Пополнено {amount} руб!</b>\nНовый баланс: {db_user.balance} руб",
@@ -452,6 +505,14 @@ async def handle_message(update: Update, context):
             reply_markup=main_menu(user.id)
         )
 
+async def post_init(application):
+    """Прогрев после старта: таблицы БД, затем фоновая проверка Outline, зеркало ключей и пул"""
+    await asyncio.to_thread(Base.metadata.create_all, engine)
+    await asyncio.to_thread(database.init_db)  # пул ключей, баланс в копейках (миграции)
+    outline_monitor.start()
+    outline_mirror.start()
+    key_pool.start()
+
 # ===== ЗАПУСК БОТА =====
 def main():
     logging.basicConfig(
@@ -462,14 +523,14 @@ def main():
     print("=" * 60)
     print("🤖 VPN BOT С РЕАЛЬНЫМ OUTLINE API")
     print("=" * 60)
-    print(f"📡 {connection_msg}")
+    print("📡 Outline проверяется в фоне после запуска")
     print(f"🔗 API URL: {OUTLINE_API_URL}")
     print(f"👑 Админы: {ADMIN_IDS}")
     print("=" * 60)
     
     try:
         token = config.Config.BOT_TOKEN
-        app = Application.builder().token(token).build()
+        app = Application.builder().token(token).post_init(post_init).build()
         
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CallbackQueryHandler(button_handler))
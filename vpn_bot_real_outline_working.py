@@ -1,136 +1,40 @@
+import asyncio
+import functools
 import logging
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 import config
-import requests
 import random
 import string
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey, func
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from db_session import SessionScope
+from router import CallbackRouter
+from keyboards import KeyboardCatalog
+from callback_codec import STR, Spec
+import database
+import counters
+import ledger
+import queries
+import render_cache
+import outbox
+from outline_cluster import OutlineServer
+from outline_health import HealthMonitor
 
 # ===== НАСТРОЙКИ =====
 ADMIN_IDS = config.Config.ADMIN_IDS
 TARIFFS = config.Config.TARIFFS
 
 # ===== REAL OUTLINE API =====
-class OutlineManager:
-    def __init__(self, api_url):
-        """
-        Ваш Outline API работает без аутентификации!
-        api_url: https://45.135.182.168:4751/XTx2Eq4Mc4yQxm6nIBEpLw
-        """
-        self.api_url = api_url.rstrip('/')
-        print(f"🔗 Подключение к Outline: {self.api_url}")
-        
-        # Проверяем подключение
-        if self.test_connection():
-            print("✅ Outline API доступен без аутентификации")
-        else:
-            print("⚠️ Outline API недоступен")
-    
-    def test_connection(self):
-        """Проверка подключения к API"""
-        try:
-            response = requests.get(
-                f"{self.api_url}/access-keys",
-                verify=False,  # Игнорируем SSL ошибки
-                timeout=10
-            )
-            return response.status_code == 200
-        except Exception as e:
-            print(f"❌ Ошибка подключения: {e}")
-            return False
-    
-    def create_key(self, name, data_limit_bytes=None):
-        """Создать реальный VPN ключ"""
-        data = {"name": name}
-        if data_limit_bytes:
-            data["data_limit"] = {"bytes": data_limit_bytes}
-        
-        try:
-            response = requests.post(
-                f"{self.api_url}/access-keys",
-                json=data,
-                verify=False,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                key_data = response.json()
-                print(f"✅ Создан реальный ключ: {name}")
-                return {
-                    'id': key_data['id'],
-                    'name': name,
-                    'access_url': key_data['accessUrl'],  # РЕАЛЬНЫЙ ключ!
-                    'password': key_data.get('password', ''),
-                    'port': key_data.get('port', ''),
-                    'method': key_data.get('method', '')
-                }
-            else:
-                print(f"❌ Ошибка создания ключа: {response.status_code}")
-                print(f"Ответ: {response.text[:200]}")
-                return None
-                
-        except Exception as e:
-            print(f"❌ Исключение при создании ключа: {e}")
-            return None
-    
-    def delete_key(self, key_id):
-        """Удалить ключ"""
-        try:
-            response = requests.delete(
-                f"{self.api_url}/access-keys/{key_id}",
-                verify=False,
-                timeout=10
-            )
-            return response.status_code == 204
-        except:
-            return False
-    
-    def list_keys(self):
-        """Получить список всех ключей"""
-        try:
-            response = requests.get(
-                f"{self.api_url}/access-keys",
-                verify=False,
-                timeout=10
-            )
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('accessKeys', [])
-            return []
-        except Exception as e:
-            print(f"❌ Ошибка получения ключей: {e}")
-            return []
-    
-    def get_server_info(self):
-        """Информация о сервере"""
-        try:
-            response = requests.get(
-                f"{self.api_url}/server",
-                verify=False,
-                timeout=10
-            )
-            if response.status_code == 200:
-                return response.json()
-            return None
-        except:
-            return None
-
-# Инициализация Outline
+# Outline API работает без аутентификации - секрет в самом URL
 OUTLINE_API_URL = "https://45.135.182.168:4751/XTx2Eq4Mc4yQxm6nIBEpLw"
-outline = OutlineManager(OUTLINE_API_URL)
-REAL_OUTLINE_AVAILABLE = outline.test_connection()
+outline_server = OutlineServer("main", OUTLINE_API_URL)
 
-if REAL_OUTLINE_AVAILABLE:
-    server_info = outline.get_server_info()
-    if server_info:
-        print(f"📡 Сервер: {server_info.get('name', 'Outline VPN')}")
-        print(f"📍 Местоположение: {server_info.get('location', 'Unknown')}")
-else:
-    print("⚠️ Используем демо-ключи")
+# Доступность сервера отслеживает фоновая проверка с circuit breaker
+# (запускается в post_init, при импорте сеть не трогаем)
+outline_monitor = HealthMonitor([outline_server])
 
 # ===== БАЗА ДАННЫХ =====
 Base = declarative_base()
@@ -180,34 +84,29 @@ class VPNKey(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     user = relationship("User", back_populates="keys")
 
-# Подключаемся к БД
+# Подключаемся к БД (соединение откроется при первом запросе, таблицы создаются в post_init)
 engine = create_engine(config.Config.DATABASE_URL, echo=False)
-Base.metadata.create_all(engine)
 SessionLocal = sessionmaker(bind=engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Одна сессия на апдейт: коммит или откат, соединение всегда возвращается в пул
+db_scope = SessionScope(SessionLocal)
 
 # ===== ФУНКЦИИ =====
 def is_admin(user_id):
     return user_id in ADMIN_IDS
 
-def main_menu(user_id):
+def _build_main_menu(admin, trial_used, locale):
     keyboard = [
         [InlineKeyboardButton("💰 Пополнить баланс", callback_data="deposit")],
         [InlineKeyboardButton("📊 Мой баланс", callback_data="balance")],
         [InlineKeyboardButton("🔑 Мои ключи", callback_data="keys")],
         [InlineKeyboardButton("🛒 Купить тариф", callback_data="tariffs")],
     ]
-    if is_admin(user_id):
+    if admin:
         keyboard.append([InlineKeyboardButton("👑 Админ-панель", callback_data="admin_panel")])
     return InlineKeyboardMarkup(keyboard)
 
-def admin_menu():
+def _build_admin_menu(admin, trial_used, locale):
     keyboard = [
         [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users_0")],
@@ -218,14 +117,17 @@ def admin_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# Меню строятся один раз на вариант и переиспользуются (см. keyboards.KeyboardCatalog)
+menus = KeyboardCatalog({"main": _build_main_menu, "admin": _build_admin_menu})
+
+def main_menu(user_id):
+    return menus.get("main", is_admin(user_id))
+
+def admin_menu():
+    return menus.get("admin", True)
+
 def get_or_create_user(db, telegram_id, username, full_name):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        user = User(telegram_id=telegram_id, username=username, full_name=full_name)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    return user
+    return queries.upsert_user_sync(db, telegram_id, username, full_name, model=User)
 
 def generate_demo_key(name):
     """Генерация демо-ключа (если Outline не доступен)"""
@@ -233,13 +135,13 @@ def generate_demo_key(name):
     return f"ss://chacha20-ietf-poly1305:{password}@45.135.182.168:443/?outline=1#{name}"
 
 # ===== ОСНОВНЫЕ ОБРАБОТЧИКИ =====
-async def start(update: Update, context):
+@db_scope
+async def start(update: Update, context, db):
     """Команда /start"""
-    db = next(get_db())
     user = update.effective_user
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
     
-    outline_status = "✅ РЕАЛЬНЫЙ Outline" if REAL_OUTLINE_AVAILABLE else "⚠️ Демо-режим"
+    outline_status = "✅ РЕАЛЬНЫЙ Outline" if outline_server.healthy else "⚠️ Демо-режим"
     
     text = (f"👋 Привет, {user.first_name}!\n"
             f"💰 Баланс: {db_user.balance} руб\n"
@@ -248,191 +150,237 @@ async def start(update: Update, context):
     
     await update.message.reply_text(text, reply_markup=main_menu(user.id))
 
-async def button_handler(update: Update, context):
-    """Обработчик всех кнопок"""
+# ===== МАРШРУТЫ КНОПОК =====
+# Обработчик маршрута: handler(query, context, db, db_user, *аргументы из callback_data)
+routes = CallbackRouter()
+
+BUY = Spec(1, "buy", STR)  # упакованная кнопка покупки; id постоянный
+
+def admin_only(handler):
+    """Админские кнопки для остальных пользователей молча игнорируются"""
+    @functools.wraps(handler)
+    async def wrapper(query, *args):
+        if is_admin(query.from_user.id):
+            await handler(query, *args)
+    return wrapper
+
+@db_scope
+async def button_handler(update: Update, context, db):
+    """Обработчик всех кнопок: поиск маршрута по таблице routes"""
     query = update.callback_query
     await query.answer()
-    db = next(get_db())
     user = query.from_user
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
+    await routes.dispatch(query.data, query, context, db, db_user)
+
+@routes.exact("admin_panel")
+@admin_only
+async def admin_panel(query, context, db, db_user):
+    await render_cache.edit(query, "👑 **Админ-панель**", parse_mode="Markdown", reply_markup=admin_menu())
+
+@routes.exact("admin_stats")
+@admin_only
+async def admin_stats(query, context, db, db_user):
+    stats = counters.snapshot_sync(db)
+    total_users = stats["users"]
+    total_payments = stats["payments"]
+    total_subs = stats["active_subscriptions"]
+    total_balance = stats["balance_kopecks"] / 100
     
-    # АДМИН КОМАНДЫ
-    if query.data == "admin_panel" and is_admin(user.id):
-        await query.edit_message_text("👑 **Админ-панель**", parse_mode="Markdown", reply_markup=admin_menu())
-        return
+    text = (f"📊 **Статистика бота:**\n\n"
+            f"👥 Пользователей: {total_users}\n"
+            f"💳 Платежей: {total_payments}\n"
+            f"📅 Активных подписок: {total_subs}\n"
+            f"💰 Общий баланс: {total_balance:.2f} руб\n"
+            f"🔑 Ключей в Outline: {outline_server.mirror.count()}\n"
+            f"📡 Outline: {'✅ Работает' if outline_server.healthy else '⚠️ Демо'}\n\n"
+            + "\n".join(outline_monitor.report()))
+    text += "\n\n" + "\n".join(render_cache.get_cache().report_lines() + outbox.get_outbox().report_lines())
+    route_lines = routes.report()
+    if route_lines:
+        # В блоке кода имена маршрутов (buy_*) не ломают Markdown
+        text += "\n\n🧭 Кнопки (самые медленные):\n```\n" + "\n".join(route_lines) + "\n```"
+    await render_cache.edit(query, text, parse_mode="Markdown", reply_markup=admin_menu())
+
+@routes.exact("admin_outline_keys")
+@admin_only
+async def admin_outline_keys(query, context, db, db_user):
+    if outline_server.healthy:
+        total_keys = outline_server.mirror.count()
+        text = f"🔑 **Ключи в Outline:** ({total_keys})\n\n"
+        for k in outline_server.mirror.latest(15):  # Покажем последние 15
+            text += f"• ID:{k.get('id', '?')} - {k.get('name', 'Без имени')}\n"
+        if total_keys > 15:
+            text += f"\n... и еще {total_keys-15} ключей"
+    else:
+        text = "⚠️ Outline API недоступен"
+    await render_cache.edit(query, text, parse_mode="Markdown", reply_markup=admin_menu())
+
+# ОСТАЛЬНЫЕ КОМАНДЫ (как в предыдущем боте, но с реальным Outline)
+@routes.exact("main")
+async def show_main(query, context, db, db_user):
+    user = query.from_user
+    await render_cache.edit(query,
+        f"📱 **Главное меню**\n💰 Баланс: {db_user.balance} руб",
+        parse_mode="Markdown",
+        reply_markup=main_menu(user.id)
+    )
+
+@routes.exact("deposit")
+async def deposit(query, context, db, db_user):
+    await render_cache.edit(query,
+        "💰 **Пополнение баланса**\n\nВведите сумму (10-5000 руб):",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main")]])
+    )
+    context.user_data['awaiting_amount'] = True
+
+@routes.exact("balance")
+async def show_balance(query, context, db, db_user):
+    user = query.from_user
+    active_subs = db.query(Subscription).filter(
+        Subscription.user_id == db_user.id,
+        Subscription.is_active == True,
+        Subscription.end_date > datetime.utcnow()
+    ).all()
     
-    elif query.data == "admin_stats" and is_admin(user.id):
-        total_users = db.query(User).count()
-        total_payments = db.query(Payment).count()
-        total_subs = db.query(Subscription).filter(Subscription.is_active == True).count()
-        total_balance = db.query(func.sum(User.balance)).scalar() or 0
-        
-        outline_keys = outline.list_keys() if REAL_OUTLINE_AVAILABLE else []
-        
-        text = (f"📊 **Статистика бота:**\n\n"
-                f"👥 Пользователей: {total_users}\n"
-                f"💳 Платежей: {total_payments}\n"
-                f"📅 Активных подписок: {total_subs}\n"
-                f"💰 Общий баланс: {total_balance:.2f} руб\n"
-                f"🔑 Ключей в Outline: {len(outline_keys)}\n"
-                f"📡 Outline: {'✅ Работает' if REAL_OUTLINE_AVAILABLE else '⚠️ Демо'}")
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=admin_menu())
-        return
+    text = f"📊 **Ваш баланс:** {db_user.balance} руб\n\n"
+    if active_subs:
+        text += "**Активные подписки:**\n"
+        for sub in active_subs:
+            days = (sub.end_date - datetime.utcnow()).days
+            text += f"• {sub.tariff} - осталось {days} дней\n"
+    else:
+        text += "У вас нет активных подписок."
     
-    elif query.data == "admin_outline_keys" and is_admin(user.id):
-        if REAL_OUTLINE_AVAILABLE:
-            keys = outline.list_keys()
-            text = f"🔑 **Ключи в Outline:** ({len(keys)})\n\n"
-            for k in keys[:15]:  # Покажем первые 15
-                text += f"• ID:{k.get('id', '?')} - {k.get('name', 'Без имени')}\n"
-            if len(keys) > 15:
-                text += f"\n... и еще {len(keys)-15} ключей"
-        else:
-            text = "⚠️ Outline API недоступен"
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=admin_menu())
+    await render_cache.edit(query, text, parse_mode="Markdown", reply_markup=main_menu(user.id))
+
+@routes.exact("keys")
+async def show_keys(query, context, db, db_user):
+    user = query.from_user
+    keys = db.query(VPNKey).filter(VPNKey.user_id == db_user.id).all()
+    if keys:
+        text = "🔑 **Ваши ключи:**\n\n"
+        for i, k in enumerate(keys, 1):
+            text += f"{i}. {k.name} ({k.created_at.strftime('%d.%m.%Y')})\n"
+        text += "\nНапишите номер ключа:"
+        await render_cache.edit(query, text, parse_mode="Markdown", reply_markup=main_menu(user.id))
+        context.user_data['awaiting_key_number'] = True
+    else:
+        await render_cache.edit(query,
+            "🔑 У вас нет ключей.\nКупите тариф!",
+            reply_markup=main_menu(user.id)
+        )
+
+@routes.exact("tariffs")
+async def show_tariffs(query, context, db, db_user):
+    text = "🛒 **Тарифы:**\n\n"
+    for tid, t in TARIFFS.items():
+        text += f"• **{t['name']}** - {t['price']} руб ({t['days']} дней)\n"
+    
+    keyboard = []
+    for tid in TARIFFS.keys():
+        name = TARIFFS[tid]["name"]
+        keyboard.append([InlineKeyboardButton(f"Купить {name}", callback_data=BUY.pack(tid))])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main")])
+    
+    await render_cache.edit(query, text, parse_mode="Markdown", 
+                                reply_markup=InlineKeyboardMarkup(keyboard))
+
+@routes.packed(BUY)
+@routes.prefix("buy_", str)  # кнопки в старых сообщениях
+async def buy(query, context, db, db_user, tariff_id):
+    user = query.from_user
+    tariff = TARIFFS.get(tariff_id)
+    
+    if not tariff:
         return
     
-    # ОСТАЛЬНЫЕ КОМАНДЫ (как в предыдущем боте, но с реальным Outline)
-    elif query.data == "main":
-        await query.edit_message_text(
-            f"📱 **Главное меню**\n💰 Баланс: {db_user.balance} руб",
+    async def not_enough():
+        await render_cache.edit(query,
+            f"❌ **Недостаточно средств!**\n\n"
+            f"Нужно: {tariff['price']} руб\n"
+            f"На балансе: {db_user.balance} руб",
             parse_mode="Markdown",
             reply_markup=main_menu(user.id)
         )
     
-    elif query.data == "deposit":
-        await query.edit_message_text(
-            "💰 **Пополнение баланса**\n\nВведите сумму (10-5000 руб):",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main")]])
-        )
-        context.user_data['awaiting_amount'] = True
+    if db_user.balance < tariff['price']:
+        await not_enough()
+        return
     
-    elif query.data == "balance":
-        active_subs = db.query(Subscription).filter(
-            Subscription.user_id == db_user.id,
-            Subscription.is_active == True,
-            Subscription.end_date > datetime.utcnow()
-        ).all()
-        
-        text = f"📊 **Ваш баланс:** {db_user.balance} руб\n\n"
-        if active_subs:
-            text += "**Активные подписки:**\n"
-            for sub in active_subs:
-                days = (sub.end_date - datetime.utcnow()).days
-                text += f"• {sub.tariff} - осталось {days} дней\n"
+    # Создаем VPN ключ до списания: пишущая транзакция SQLite не должна
+    # оставаться открытой на время запроса к Outline и его повторов
+    key_name = f"{tariff['name']} - user{user.id}"
+    key_data = None
+    if outline_server.healthy:
+        # Реальный ключ через Outline API (при разомкнутой цепи - сразу None)
+        key_data = await outline_server.create_key(key_name, limit_gb=None)
+        if key_data:
+            key_text = key_data['accessUrl']
+            key_id_in_outline = key_data['id']
+            key_type = "🔐 РЕАЛЬНЫЙ"
         else:
-            text += "У вас нет активных подписок."
-        
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=main_menu(user.id))
+            # Если не удалось создать реальный ключ
+            key_text = generate_demo_key(key_name)
+            key_id_in_outline = f"demo_{random.randint(10000, 99999)}"
+            key_type = "⚠️ ДЕМО (ошибка API)"
+    else:
+        # Демо-ключ
+        key_text = generate_demo_key(key_name)
+        key_id_in_outline = f"demo_{random.randint(10000, 99999)}"
+        key_type = "⚠️ ДЕМО"
     
-    elif query.data == "keys":
-        keys = db.query(VPNKey).filter(VPNKey.user_id == db_user.id).all()
-        if keys:
-            text = "🔑 **Ваши ключи:**\n\n"
-            for i, k in enumerate(keys, 1):
-                text += f"{i}. {k.name} ({k.created_at.strftime('%d.%m.%Y')})\n"
-            text += "\nНапишите номер ключа:"
-            await query.edit_message_text(text, parse_mode="Markdown", reply_markup=main_menu(user.id))
-            context.user_data['awaiting_key_number'] = True
-        else:
-            await query.edit_message_text(
-                "🔑 У вас нет ключей.\nКупите тариф!",
-                reply_markup=main_menu(user.id)
-            )
+    # Списание, подписка и ключ - одной короткой транзакцией без сетевых вызовов.
+    # Условный UPDATE: параллельные покупки не уведут баланс в минус
+    charged = ledger.debit_sync(db, db_user.id, ledger.to_kopecks(tariff['price']),
+                                "purchase", ledger.operation_id(tariff_id))
+    if charged is None:
+        db.rollback()
+        # Баланс успели потратить параллельно - созданный ключ не нужен
+        if key_data:
+            await outline_server.delete_key(key_id_in_outline)
+        await not_enough()
+        return
     
-    elif query.data == "tariffs":
-        text = "🛒 **Тарифы:**\n\n"
-        for tid, t in TARIFFS.items():
-            text += f"• **{t['name']}** - {t['price']} руб ({t['days']} дней)\n"
-        
-        keyboard = []
-        for tid in TARIFFS.keys():
-            name = TARIFFS[tid]["name"]
-            keyboard.append([InlineKeyboardButton(f"Купить {name}", callback_data=f"buy_{tid}")])
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main")])
-        
-        await query.edit_message_text(text, parse_mode="Markdown", 
-                                    reply_markup=InlineKeyboardMarkup(keyboard))
+    db.add(Subscription(
+        user_id=db_user.id,
+        tariff=tariff['name'],
+        price=tariff['price'],
+        end_date=datetime.utcnow() + timedelta(days=tariff['days'])
+    ))
+    db.add(VPNKey(
+        user_id=db_user.id,
+        key_id=key_id_in_outline,
+        key=key_text,
+        name=tariff['name']
+    ))
+    db.commit()
     
-    elif query.data.startswith("buy_"):
-        tariff_id = query.data.replace("buy_", "")
-        tariff = TARIFFS.get(tariff_id)
-        
-        if tariff and db_user.balance >= tariff['price']:
-            db_user.balance -= tariff['price']
-            
-            # Создаем подписку
-            sub = Subscription(
-                user_id=db_user.id,
-                tariff=tariff['name'],
-                price=tariff['price'],
-                end_date=datetime.utcnow() + timedelta(days=tariff['days'])
-            )
-            db.add(sub)
-            
-            # Создаем VPN ключ
-            key_name = f"{tariff['name']} - user{user.id}"
-            if REAL_OUTLINE_AVAILABLE:
-                # Реальный ключ через Outline API
-                key_data = outline.create_key(key_name)
-                if key_data:
-                    key_text = key_data['access_url']
-                    key_id_in_outline = key_data['id']
-                    key_type = "🔐 РЕАЛЬНЫЙ"
-                else:
-                    # Если не удалось создать реальный ключ
-                    key_text = generate_demo_key(key_name)
-                    key_id_in_outline = f"demo_{random.randint(10000, 99999)}"
-                    key_type = "⚠️ ДЕМО (ошибка API)"
-            else:
-                # Демо-ключ
-                key_text = generate_demo_key(key_name)
-                key_id_in_outline = f"demo_{random.randint(10000, 99999)}"
-                key_type = "⚠️ ДЕМО"
-            
-            # Сохраняем в БД
-            vpn_key = VPNKey(
-                user_id=db_user.id,
-                key_id=key_id_in_outline,
-                key=key_text,
-                name=tariff['name']
-            )
-            db.add(vpn_key)
-            db.commit()
-            
-            # Отправляем сообщение
-            await query.edit_message_text(
-                f"✅ **Покупка успешна!**\n\n"
-                f"Тариф: {tariff['name']}\n"
-                f"Цена: {tariff['price']} руб\n"
-                f"Остаток: {db_user.balance} руб\n"
-                f"Тип ключа: {key_type}\n\n"
-                f"Ключ отправлен отдельным сообщением.",
-                parse_mode="Markdown",
-                reply_markup=main_menu(user.id)
-            )
-            
-            # Отправляем ключ
-            key_msg = f"🔑 **Ваш VPN ключ ({key_type}):**\n\n`{key_text}`\n\n"
-            if "РЕАЛЬНЫЙ" in key_type:
-                key_msg += "✅ Этот ключ работает! Используйте в Outline приложении."
-            else:
-                key_msg += "⚠️ Это демо-ключ. Реальный ключ не был создан."
-            
-            await context.bot.send_message(
-                chat_id=user.id,
-                text=key_msg,
-                parse_mode="Markdown"
-            )
-        elif tariff:
-            await query.edit_message_text(
-                f"❌ **Недостаточно средств!**\n\n"
-                f"Нужно: {tariff['price']} руб\n"
-                f"На балансе: {db_user.balance} руб",
-                parse_mode="Markdown",
-                reply_markup=main_menu(user.id)
-            )
+    # Отправляем сообщение
+    await render_cache.edit(query,
+        f"✅ **Покупка успешна!**\n\n"
+        f"Тариф: {tariff['name']}\n"
+        f"Цена: {tariff['price']} руб\n"
+        f"Остаток: {db_user.balance} руб\n"
+        f"Тип ключа: {key_type}\n\n"
+        f"Ключ отправлен отдельным сообщением.",
+        parse_mode="Markdown",
+        reply_markup=main_menu(user.id)
+    )
+    
+    # Отправляем ключ
+    key_msg = f"🔑 **Ваш VPN ключ ({key_type}):**\n\n`{key_text}`\n\n"
+    if "РЕАЛЬНЫЙ" in key_type:
+        key_msg += "✅ Этот ключ работает! Используйте в Outline приложении."
+    else:
+        key_msg += "⚠️ Это демо-ключ. Реальный ключ не был создан."
+    
+    await outbox.get_outbox().send(
+        context.bot, user.id,
+        key_msg,
+        parse_mode="Markdown"
+    )
 
 # Остальные обработчики (handle_message и админские) остаются как в предыдущем боте
 # Для простоты я пропущу их, но они должны быть как в vpn_bot_final_complete.py
@@ -440,7 +388,7 @@ async def button_handler(update: Update, context):
 print("=" * 60)
 print("🤖 VPN BOT С РЕАЛЬНЫМ OUTLINE API")
 print("=" * 60)
-print(f"📡 Outline: {'✅ ПОДКЛЮЧЕН' if REAL_OUTLINE_AVAILABLE else '⚠️ ДЕМО-РЕЖИМ'}")
+print("📡 Outline: проверяется в фоне после запуска")
 print(f"🔗 API URL: {OUTLINE_API_URL}")
 print(f"👑 Админы: {ADMIN_IDS}")
 print("=" * 60)
@@ -448,18 +396,18 @@ print("=" * 60)
 # Дальше нужно добавить остальные обработчики из предыдущего бота
 # Для экономии времени, давайте создадим упрощенную версию
 
-async def handle_message(update: Update, context):
+@db_scope
+async def handle_message(update: Update, context, db):
     """Упрощенный обработчик сообщений"""
     text = update.message.text
     user = update.effective_user
-    db = next(get_db())
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
     
     if context.user_data.get('awaiting_amount'):
         try:
             amount = float(text)
             if 10 <= amount <= 5000:
-                db_user.balance += amount
+                ledger.credit_sync(db, db_user.id, ledger.to_kopecks(amount), "deposit", ledger.operation_id("deposit"))
                 db.commit()
                 await update.message.reply_text(
                     f"✅ Пополнено {amount} руб!\nНовый баланс: {db_user.balance} руб",
@@ -494,12 +442,19 @@ async def handle_message(update: Update, context):
             reply_markup=main_menu(user.id)
         )
 
+async def post_init(application):
+    """Прогрев после старта: таблицы БД, затем фоновая проверка Outline и обновление списка ключей"""
+    await asyncio.to_thread(Base.metadata.create_all, engine)
+    await asyncio.to_thread(database.init_db)  # миграции: баланс в копейках и журнал balance_ledger
+    outline_monitor.start()
+    outline_server.mirror.start()
+
 def main():
     logging.basicConfig(level=logging.INFO)
     
     try:
         token = config.Config.BOT_TOKEN
-        app = Application.builder().token(token).build()
+        app = Application.builder().token(token).post_init(post_init).build()
         
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CallbackQueryHandler(button_handler))
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -5,7 +6,10 @@ import config
 import random
 import string
 from datetime import datetime, timedelta
-from database import get_db, User, Subscription, VPNKey
+from database import SessionLocal, init_db, User, Subscription, VPNKey
+from db_session import SessionScope
+import ledger
+import queries
 
 logging.basicConfig(level=logging.INFO)
 
@@ -15,6 +19,9 @@ print("=" * 60)
 
 TARIFFS = config.Config.TARIFFS
 
+# Одна сессия на апдейт: коммит или откат, соединение всегда возвращается в пул
+db_scope = SessionScope(SessionLocal)
+
 def main_menu():
     keyboard = [
         [InlineKeyboardButton("💰 Пополнить баланс", callback_data="deposit")],
@@ -27,19 +34,7 @@ def main_menu():
 
 def get_or_create_user(db, telegram_id, username, full_name):
     """Получить или создать пользователя"""
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        user = User(
-            telegram_id=telegram_id,
-            username=username,
-            full_name=full_name,
-            balance=0.0
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-        print(f"✅ Создан новый пользователь: {user.id}")
-    return user
+    return queries.upsert_user_sync(db, telegram_id, username, full_name, model=User)
 
 def generate_vpn_key(name):
     """Генерация демо VPN ключа"""
@@ -48,9 +43,9 @@ def generate_vpn_key(name):
     server = random.choice(servers)
     return f"ss://chacha20-ietf-poly1305:{password}@{server}:443/?outline=1#{name}"
 
-async def start(update: Update, context):
+@db_scope
+async def start(update: Update, context, db):
     """Команда /start"""
-    db = next(get_db())
     user = update.effective_user
     
     # Создаем/получаем пользователя в БД
@@ -63,11 +58,11 @@ async def start(update: Update, context):
         reply_markup=main_menu()
     )
 
-async def button_handler(update: Update, context):
+@db_scope
+async def button_handler(update: Update, context, db):
     """Обработчик кнопок"""
     query = update.callback_query
     await query.answer()
-    db = next(get_db())
     user = query.from_user
     
     # Получаем пользователя
@@ -143,55 +138,7 @@ async def button_handler(update: Update, context):
         tariff = TARIFFS.get(tariff_id)
         
         if tariff:
-            # Проверяем баланс
-            if db_user.balance >= tariff['price']:
-                # Списание денег
-                db_user.balance -= tariff['price']
-                
-                # Создаем подписку
-                subscription = Subscription(
-                    user_id=db_user.id,
-                    tariff=tariff['name'],
-                    price=tariff['price'],
-                    start_date=datetime.utcnow(),
-                    end_date=datetime.utcnow() + timedelta(days=tariff['days']),
-                    is_active=True
-                )
-                db.add(subscription)
-                
-                # Генерируем VPN ключ
-                vpn_key = generate_vpn_key(tariff['name'])
-                
-                # Сохраняем ключ в БД
-                vpn_key_record = VPNKey(
-                    user_id=db_user.id,
-                    key_id=f"key_{user.id}_{int(datetime.utcnow().timestamp())}",
-                    key=vpn_key,
-                    name=tariff['name']
-                )
-                db.add(vpn_key_record)
-                
-                db.commit()
-                
-                # Отправляем подтверждение
-                await query.edit_message_text(
-                    f"✅ **Покупка успешна!**\n\n"
-                    f"Тариф: {tariff['name']}\n"
-                    f"Цена: {tariff['price']} руб\n"
-                    f"Срок: {tariff['days']} дней\n"
-                    f"Остаток баланса: {db_user.balance} руб\n\n"
-                    f"Ключ отправлен отдельным сообщением.",
-                    parse_mode="Markdown",
-                    reply_markup=main_menu()
-                )
-                
-                # Отправляем ключ
-                await context.bot.send_message(
-                    chat_id=user.id,
-                    text=f"🔑 **Ваш VPN ключ:**\n\n`{vpn_key}`\n\nИспользуйте в Outline приложении.",
-                    parse_mode="Markdown"
-                )
-            else:
+            async def not_enough():
                 await query.edit_message_text(
                     f"❌ **Недостаточно средств!**\n\n"
                     f"Нужно: {tariff['price']} руб\n"
@@ -200,6 +147,62 @@ async def button_handler(update: Update, context):
                     parse_mode="Markdown",
                     reply_markup=main_menu()
                 )
+            
+            # Проверяем баланс
+            if db_user.balance < tariff['price']:
+                await not_enough()
+                return
+            
+            # Ключ готовим до списания - как в остальных vpn_bot_* скриптах
+            vpn_key = generate_vpn_key(tariff['name'])
+            
+            # Списание, подписка и ключ - одной короткой транзакцией.
+            # Условный UPDATE: параллельные покупки не уведут баланс в минус
+            charged = ledger.debit_sync(db, db_user.id, ledger.to_kopecks(tariff['price']),
+                                        "purchase", ledger.operation_id(tariff_id))
+            if charged is None:
+                # Баланс успели потратить параллельно; демо-ключ нигде не создан - освобождать нечего
+                db.rollback()
+                await not_enough()
+                return
+            
+            # Создаем подписку
+            db.add(Subscription(
+                user_id=db_user.id,
+                tariff=tariff['name'],
+                price=tariff['price'],
+                start_date=datetime.utcnow(),
+                end_date=datetime.utcnow() + timedelta(days=tariff['days']),
+                is_active=True
+            ))
+            
+            # Сохраняем ключ в БД
+            db.add(VPNKey(
+                user_id=db_user.id,
+                key_id=f"key_{user.id}_{int(datetime.utcnow().timestamp())}",
+                key=vpn_key,
+                name=tariff['name']
+            ))
+            db.commit()
+            
+            # Отправляем подтверждение
+            await query.edit_message_text(
+                f"✅ **Покупка успешна!**\n\n"
+                f"Тариф: {tariff['name']}\n"
+                f"Цена: {tariff['price']} руб\n"
+                f"Срок: {tariff['days']} дней\n"
+                f"Остаток баланса: {db_user.balance} руб\n\n"
+                f"Ключ отправлен отдельным сообщением.",
+                parse_mode="Markdown",
+                reply_markup=main_menu()
+            )
+            
+            # Отправляем ключ
+            await context.bot.send_message(
+                chat_id=user.id,
+                text=f"🔑 **Ваш VPN ключ:**\n\n`{vpn_key}`\n\nИспользуйте в Outline приложении.",
+                parse_mode="Markdown"
+            )
     
     elif query.data == "support":
         await query.edit_message_text(
@@ -210,11 +213,11 @@ async def button_handler(update: Update, context):
             reply_markup=main_menu()
         )
 
-async def handle_message(update: Update, context):
+@db_scope
+async def handle_message(update: Update, context, db):
     """Обработчик сообщений"""
     text = update.message.text
     user = update.effective_user
-    db = next(get_db())
     
     db_user = get_or_create_user(db, user.id, user.username, user.full_name)
     
@@ -222,8 +225,8 @@ async def handle_message(update: Update, context):
         try:
             amount = float(text)
             if 10 <= amount <= 5000:
-                # Пополняем баланс
-                db_user.balance += amount
+                # Пополняем баланс через журнал: копейки, balance_ledger и счетчики
+                ledger.credit_sync(db, db_user.id, ledger.to_kopecks(amount), "deposit", ledger.operation_id("deposit"))
                 db.commit()
                 
                 await update.message.reply_text(
@@ -267,12 +270,16 @@ async def handle_message(update: Update, context):
             reply_markup=main_menu()
         )
 
+async def post_init(application):
+    """Проверка схемы БД после старта, а не при импорте"""
+    await asyncio.to_thread(init_db)
+
 def main():
     try:
         token = config.Config.BOT_TOKEN
         print(f"🚀 Запуск бота с БД...")
         
-        app = Application.builder().token(token).build()
+        app = Application.builder().token(token).post_init(post_init).build()
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CallbackQueryHandler(button_handler))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))